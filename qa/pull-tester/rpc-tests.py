@@ -18,6 +18,12 @@ than:
       with '-extended' and '-extended-only' too, to print subsets.
     - `-win`: signal that this is running in a Windows environment, and we
       should run the tests.
+    - `-jobs=N`: run N tests at a time, longest first, each with its own
+      ports and a log file
+    - `-regression-threshold=X`: report tests that took more than X times
+      (default 1.5) as long as they typically do on this host
+    - `-timings-export=FILE`: write the history of test durations to FILE as
+      CSV, do not run
     - `--coverage`: this generates a basic coverage report for the RPC
       interface.
 
@@ -29,6 +35,7 @@ For a description of arguments recognized by test scripts, see
 """
 import pdb
 import os
+import platform
 import time
 import shutil
 import sys
@@ -39,6 +46,7 @@ import re
 sys.path.append("qa/pull-tester/")
 from tests_config import *
 from test_classes import RpcTest, Disabled, Skip
+from test_timings import TimingDB, current_commit, REGRESSION_THRESHOLD
 
 BOLD = ("","")
 if os.name == 'posix':
@@ -48,6 +56,15 @@ if os.name == 'posix':
 
 RPC_TESTS_DIR = SRCDIR + '/qa/rpc-tests/'
 
+# How long each test took in previous runs (see test_timings.py)
+TEST_TIMINGS_FILE = BUILDDIR + '/qa/pull-tester/test_timings.jsonl'
+
+# Tests run in parallel get separate port ranges through this environment
+# variable (see p2p_port() in qa/rpc-tests/test_framework/util.py)
+PORT_OFFSET_ENV = "RPC_TESTS_PORT_OFFSET"
+PORTS_PER_JOB = 50
+MAX_JOBS = 19  # util.py's port ranges are 990 ports wide
+
 #If imported values are not defined then set to zero (or disabled)
 if 'ENABLE_WALLET' not in vars():
     ENABLE_WALLET=0
@@ -133,7 +150,8 @@ for o in opts | double_opts:
             print(bad_opt_str % o)
             bad_opts_found.append(o)
     elif o.startswith('-'):
-        if o not in private_single_opts:
+        if (o not in private_single_opts
+                and not re.match("-(jobs=[0-9]+|regression-threshold=[0-9.]+|timings-export=.+)$", o)):
             print(bad_opt_str % o)
             bad_opts_found.append(o)
             print("Run with -h to get help on usage.")
@@ -247,6 +265,10 @@ def show_wrapper_options():
           "                        run ONLY the extended tests")
     print("  -list / --list        only list test names")
     print("  -win / --win          signal running on Windows and run those tests")
+    print("  -jobs=N               run N tests in parallel, output to per-test logs")
+    print("  -regression-threshold=X\n" + \
+          "                        flag tests taking X times their usual duration")
+    print("  -timings-export=FILE  export the test duration history as CSV")
     print("  -f / -force-enable / --force-enable\n" + \
           "                        attempt to run disabled/skipped tests")
     print("  -h / -help / --help   print this help")
@@ -262,6 +284,22 @@ def runtests():
     tests_to_run = []
 
     force_enable = option_passed('force-enable') or '-f' in opts
+    jobs = 1
+    regression_threshold = REGRESSION_THRESHOLD
+    timings = TimingDB(TEST_TIMINGS_FILE)
+    for o in opts:
+        if o.startswith('-jobs='):
+            jobs = int(o[len('-jobs='):])
+        elif o.startswith('-regression-threshold='):
+            regression_threshold = float(o[len('-regression-threshold='):])
+        elif o.startswith('-timings-export='):
+            with open(o[len('-timings-export='):], 'w', newline='') as f:
+                timings.export_csv(f)
+            print("Exported %d test timings" % len(timings.records))
+            sys.exit(0)
+    if jobs > MAX_JOBS:
+        print("At most %d jobs are supported, using that many" % MAX_JOBS)
+        jobs = MAX_JOBS
     run_only_extended = option_passed('only-extended') or option_passed('extended-only')
 
     if option_passed('list'):
@@ -347,6 +385,18 @@ def runtests():
             tests_to_run = trimmed_tests_to_run
 
         # now run the tests
+        durations = {}
+        if jobs > 1 and not showHelp:
+            unique_tests = []
+            for t in tests_to_run:
+                if str(t) in [str(u) for u in unique_tests]:
+                    print("Skipping extended test name %s - already executed in regular\n" % t)
+                else:
+                    unique_tests.append(t)
+            tests_to_run = []
+            run_parallel(unique_tests, jobs, flags, timings.durations(platform.node()), durations,
+                         execution_time, test_passed, test_failure_info)
+
         p = re.compile(" -h| --help| -help")
         for t in tests_to_run:
             scriptname=re.sub(".py$", "", str(t).split(' ')[0])
@@ -386,7 +436,8 @@ def runtests():
                 if showHelp:
                     sys.exit(0)
                 else:
-                    execution_time[fullscriptcmd] = int(time.time() - time0)
+                    durations[fullscriptcmd] = time.time() - time0
+                    execution_time[fullscriptcmd] = int(durations[fullscriptcmd])
                     print("Duration: %s s\n" % execution_time[fullscriptcmd])
 
             else:
@@ -418,6 +469,8 @@ def runtests():
                                                                        len(test_passed)))
             print("%d test(s) disabled / %d test(s) skipped due to platform" % (len(disabled), len(skipped)))
 
+            record_timings(timings, durations, test_passed, jobs, regression_threshold)
+
         # signal that tests have failed using exit code
         if list(test_passed.values()).count(False):
             sys.exit(1)
@@ -426,6 +479,76 @@ def runtests():
         print("No rpc tests to run. Wallet, utils, and bitcoind must all be enabled")
 
 
+def record_timings(timings, durations, test_passed, jobs, threshold):
+    """
+    Report the tests that passed but took much longer than usual on this
+    host, then add this run's durations to the history
+    """
+    host = platform.node()
+    passed = {t: d for t, d in durations.items() if test_passed.get(t)}
+    slow = timings.regressions(passed, host, threshold)
+    if slow:
+        print()
+        print("Tests slower than %.1f times their usual duration on this host:" % threshold)
+        for t, seconds, typical in slow:
+            print("  %-48s %7.1f s, usually %7.1f s" % (t, seconds, typical))
+    commit = current_commit(SRCDIR)
+    try:
+        for t in sorted(durations.keys()):
+            timings.record(t, durations[t], test_passed.get(t, False), commit, host, jobs)
+    except IOError as e:
+        print("Could not save test timings: %s" % e)
+
+def run_parallel(tests, jobs, flags, expected, durations, execution_time, test_passed, test_failure_info):
+    """
+    Run tests jobs at a time, starting with the ones expected (by their usual
+    durations) to take longest, and tests never timed before them.  Each job
+    has its own range of ports, and each test writes its output to a log
+    file, which is shown if it fails.  Only the logs of failed tests are
+    kept, and the log directory is removed if every test passed.
+    """
+    queue = sorted(tests, key=lambda t: -expected.get(str(t), float('inf')))
+    logdir = tempfile.mkdtemp(prefix="rpc-tests-logs")
+    print("Running %d tests, %d at a time, logs in %s\n" % (len(queue), jobs, logdir))
+    free_slots = list(range(jobs))
+    running = {}  # slot: (test, process, log file, start time)
+    while queue or running:
+        while queue and free_slots:
+            t = queue.pop(0)
+            slot = free_slots.pop(0)
+            env = dict(os.environ)
+            env[PORT_OFFSET_ENV] = str(slot * PORTS_PER_JOB)
+            log = open(os.path.join(logdir, re.sub("[^A-Za-z0-9_.-]+", "_", str(t)) + ".log"), "w")
+            print("Running testscript %s%s%s ..." % (bold[1], t, bold[0]))
+            process = subprocess.Popen(RPC_TESTS_DIR + repr(t) + flags, shell=True,
+                                       stdout=log, stderr=subprocess.STDOUT, env=env)
+            running[slot] = (t, process, log, time.time())
+        time.sleep(0.1)
+        for slot, (t, process, log, time0) in list(running.items()):
+            if process.poll() is None:
+                continue
+            del running[slot]
+            free_slots.append(slot)
+            log.close()
+            name = str(t)
+            durations[name] = time.time() - time0
+            execution_time[name] = int(durations[name])
+            test_passed[name] = process.returncode == 0
+            if test_passed[name]:
+                print("%s passed, duration: %s s" % (name, execution_time[name]))
+                os.remove(log.name)
+            else:
+                test_failure_info[name] = subprocess.CalledProcessError(process.returncode, repr(t))
+                print("%s%s%s FAILED with status %d, duration: %s s, log %s:" % (bold[1], name, bold[0],
+                      process.returncode, execution_time[name], log.name))
+                with open(log.name) as f:
+                    print("".join(f.readlines()[-40:]))
+    if os.listdir(logdir):
+        print("Logs of the failed tests are in %s" % logdir)
+    else:
+        os.rmdir(logdir)
+
+
 class RPCCoverage(object):
     """
     Coverage reporting utilities for pull-tester.
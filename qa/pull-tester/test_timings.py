@@ -0,0 +1,115 @@
+# Copyright (c) 2017 The Bitcoin Unlimited developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+History of RPC test durations, kept by rpc-tests.py across runs
+
+Every run appends one JSON object per test to a file, with the commit it
+ran on and the host it ran on.  The history orders parallel runs longest
+first, flags tests that got much slower than they used to be on the same
+host, and can be exported as CSV for plotting.
+
+>>> import os, tempfile
+>>> db = TimingDB(os.path.join(tempfile.mkdtemp(), "timings.jsonl"))
+>>> for seconds in (10, 12, 11):
+...     db.record("wallet.py", seconds, True, commit="abc", host="h1")
+>>> db.record("wallet.py", 100, False, commit="abc", host="h1")
+>>> db.typical("wallet.py", "h1")
+11
+>>> db.typical("wallet.py", "h2") is None
+True
+>>> db.regressions({"wallet.py": 20, "rest.py": 5}, "h1")
+[('wallet.py', 20, 11)]
+>>> db.regressions({"wallet.py": 12}, "h1")
+[]
+>>> TimingDB(db.path).durations("h1")
+{'wallet.py': 11}
+"""
+
+import csv
+import json
+import os
+import platform
+import subprocess
+import time
+
+# A test regressed if it took this many times its typical duration...
+REGRESSION_THRESHOLD = 1.5
+# ...and at least this many seconds longer
+REGRESSION_MIN_SECONDS = 2
+
+# The typical duration of a test is the median of this many recent passing runs
+HISTORY_RUNS = 5
+
+CSV_FIELDS = ["time", "test", "seconds", "passed", "commit", "host", "platform", "jobs"]
+
+
+def current_commit(srcdir):
+    """The commit srcdir has checked out, or None if that cannot be found"""
+    try:
+        return subprocess.check_output(["git", "-C", srcdir, "rev-parse", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2
+
+
+class TimingDB(object):
+    ''' Test durations, stored as JSON lines in a file '''
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.records.append(json.loads(line))
+                    except ValueError:
+                        pass  # a line cut short by an interrupted run
+
+    def record(self, test, seconds, passed, commit=None, host=None, jobs=1):
+        ''' add one test run to the history '''
+        r = {"time": int(time.time()), "test": test, "seconds": seconds, "passed": passed,
+             "commit": commit, "host": host if host is not None else platform.node(),
+             "platform": platform.platform(), "jobs": jobs}
+        self.records.append(r)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(r, sort_keys=True) + "\n")
+
+    def typical(self, test, host):
+        ''' median duration of the test's recent passing runs on host, None if there are none '''
+        runs = [r["seconds"] for r in self.records if r["test"] == test and r["host"] == host and r["passed"]]
+        if not runs:
+            return None
+        return median(runs[-HISTORY_RUNS:])
+
+    def durations(self, host):
+        ''' typical duration on host of every test that has passed there '''
+        tests = set(r["test"] for r in self.records if r["host"] == host and r["passed"])
+        return {t: self.typical(t, host) for t in tests}
+
+    def regressions(self, results, host, threshold=REGRESSION_THRESHOLD, min_seconds=REGRESSION_MIN_SECONDS):
+        '''
+        (test, seconds, typical seconds) for every test in results ({test: seconds},
+        not yet recorded) that took much longer than it typically does on host
+        '''
+        slow = []
+        for test, seconds in sorted(results.items()):
+            typical = self.typical(test, host)
+            if typical is not None and seconds > typical * threshold and seconds - typical >= min_seconds:
+                slow.append((test, seconds, typical))
+        return slow
+
+    def export_csv(self, f):
+        ''' write the whole history to the file object f as CSV '''
+        writer = csv.DictWriter(f, CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for r in self.records:
+            writer.writerow(r)
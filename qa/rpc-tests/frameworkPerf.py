@@ -0,0 +1,676 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Unlimited developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Micro-benchmarks for the python test framework itself.
+
+These do not need a bitcoind; they measure how fast the framework can
+produce and consume p2p data so that the framework does not become the
+bottleneck when large blocks are pushed through it.
+
+Run all benchmarks:        qa/rpc-tests/frameworkPerf.py
+Run selected benchmarks:   qa/rpc-tests/frameworkPerf.py deserialize merkle
+
+Timings are taken with test_framework.benchmark, so they are written to
+BENCHOUT.json and BENCHOUT.csv in the same format as txPerf's, and can be
+compared with an earlier run with --baseline.  Each optimization is measured
+next to the code it replaced: the impl parameter tells them apart.
+"""
+import contextlib
+import decimal
+import gc
+import json
+import optparse
+import os
+import shutil
+import socket
+import sys
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+from codecs import encode
+from io import BytesIO, StringIO
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from test_framework.nodemessages import *
+from test_framework.mininode import NodeConn, NodeConnBase, NodeConnCB, NetworkThread
+from test_framework.authproxy import EncodeDecimal, JSONStreamReader
+from test_framework.storage import available_backends, open_storage
+from test_framework.benchmark import Benchmark
+
+
+def make_block(ntx=2000, nin=2, nout=2):
+    """Build a synthetic block of ntx transactions (not valid, just realistically shaped)"""
+    block = CBlock()
+    block.nBits = 0x207fffff
+    for i in range(ntx):
+        tx = CTransaction()
+        for j in range(nin):
+            tx.vin.append(CTxIn(COutPoint(random.getrandbits(256), j), os.urandom(107), 0xffffffff))
+        for j in range(nout):
+            tx.vout.append(CTxOut(random.randint(0, 21000000 * COIN), os.urandom(25)))
+        block.vtx.append(tx)
+    return block
+
+
+# The per field BytesIO/struct.unpack deserializer that BufferReader replaced,
+# kept here as the baseline to compare against.
+def legacy_compact_size(f):
+    nit = struct.unpack("<B", f.read(1))[0]
+    if nit == 253:
+        nit = struct.unpack("<H", f.read(2))[0]
+    elif nit == 254:
+        nit = struct.unpack("<I", f.read(4))[0]
+    elif nit == 255:
+        nit = struct.unpack("<Q", f.read(8))[0]
+    return nit
+
+
+def legacy_uint256(f):
+    r = 0
+    for i in range(8):
+        t = struct.unpack("<I", f.read(4))[0]
+        r += t << (i * 32)
+    return r
+
+
+def legacy_deser_block(data):
+    f = BytesIO(data)
+    block = CBlock()
+    block.nVersion = struct.unpack("<i", f.read(4))[0]
+    block.hashPrevBlock = legacy_uint256(f)
+    block.hashMerkleRoot = legacy_uint256(f)
+    block.nTime = struct.unpack("<I", f.read(4))[0]
+    block.nBits = struct.unpack("<I", f.read(4))[0]
+    block.nNonce = struct.unpack("<I", f.read(4))[0]
+    for i in range(legacy_compact_size(f)):
+        tx = CTransaction()
+        tx.nVersion = struct.unpack("<i", f.read(4))[0]
+        for j in range(legacy_compact_size(f)):
+            txin = CTxIn()
+            txin.prevout = COutPoint()
+            txin.prevout.hash = legacy_uint256(f)
+            txin.prevout.n = struct.unpack("<I", f.read(4))[0]
+            txin.scriptSig = f.read(legacy_compact_size(f))
+            txin.nSequence = struct.unpack("<I", f.read(4))[0]
+            tx.vin.append(txin)
+        for j in range(legacy_compact_size(f)):
+            txout = CTxOut()
+            txout.nValue = struct.unpack("<q", f.read(8))[0]
+            txout.scriptPubKey = f.read(legacy_compact_size(f))
+            tx.vout.append(txout)
+        tx.nLockTime = struct.unpack("<I", f.read(4))[0]
+        block.vtx.append(tx)
+    return block
+
+
+def legacy_ser_compact_size(l):
+    if len(l) < 253:
+        return struct.pack("B", len(l))
+    elif len(l) < 0x10000:
+        return struct.pack("<BH", 253, len(l))
+    elif len(l) < 0x100000000:
+        return struct.pack("<BI", 254, len(l))
+    return struct.pack("<BQ", 255, len(l))
+
+
+def legacy_ser_uint256(u):
+    rs = b""
+    for i in range(8):
+        rs += struct.pack("<I", u & 0xFFFFFFFF)
+        u >>= 32
+    return rs
+
+
+def legacy_ser_block(block):
+    """The bytes concatenating serializer that serialize_into() replaced"""
+    r = b""
+    r += struct.pack("<i", block.nVersion)
+    r += legacy_ser_uint256(block.hashPrevBlock)
+    r += legacy_ser_uint256(block.hashMerkleRoot)
+    r += struct.pack("<I", block.nTime)
+    r += struct.pack("<I", block.nBits)
+    r += struct.pack("<I", block.nNonce)
+    r += legacy_ser_compact_size(block.vtx)
+    for tx in block.vtx:
+        t = b""
+        t += struct.pack("<i", tx.nVersion)
+        t += legacy_ser_compact_size(tx.vin)
+        for txin in tx.vin:
+            i = b""
+            i += legacy_ser_uint256(txin.prevout.hash)
+            i += struct.pack("<I", txin.prevout.n)
+            i += legacy_ser_compact_size(txin.scriptSig) + txin.scriptSig
+            i += struct.pack("<I", txin.nSequence)
+            t += i
+        t += legacy_ser_compact_size(tx.vout)
+        for txout in tx.vout:
+            o = b""
+            o += struct.pack("<q", int(txout.nValue))
+            o += legacy_ser_compact_size(txout.scriptPubKey) + txout.scriptPubKey
+            t += o
+        t += struct.pack("<I", tx.nLockTime)
+        r += t
+    return r
+
+
+def measure(bench, name, fn, repetitions=5, warmup=1, **params):
+    """bench.measure() with the garbage collector off, as the timeit module
+    does, to keep collections out of the numbers"""
+    gcold = gc.isenabled()
+    gc.disable()
+    try:
+        return bench.measure(name, fn, warmup=warmup, repetitions=repetitions, **params)
+    finally:
+        if gcold:
+            gc.enable()
+
+
+def bench_deserialize(bench):
+    data = make_block().serialize()
+    check = CBlock()
+    check.deserialize(BufferReader(data))
+    assert check.serialize() == data
+
+    assert legacy_deser_block(data).serialize() == data
+
+    def legacy():
+        legacy_deser_block(data)
+
+    def bytesio():
+        CBlock().deserialize(BytesIO(data))
+
+    def bufreader():
+        CBlock().deserialize(BufferReader(data))
+
+    def from_msg():
+        msg_block().deserialize(BufferReader(memoryview(data)))
+
+    print("deserialize %d byte block with %d transactions" % (len(data), len(check.vtx)))
+    measure(bench, "deserialize", legacy, impl="legacy", txs=len(check.vtx))
+    measure(bench, "deserialize", bytesio, impl="BytesIO", txs=len(check.vtx))
+    measure(bench, "deserialize", bufreader, impl="BufferReader", txs=len(check.vtx))
+    measure(bench, "deserialize", from_msg, impl="msg_block", txs=len(check.vtx))
+
+
+def bench_serialize(bench):
+    for ntx in (2000, 16000):
+        block = make_block(ntx)
+        data = block.serialize()
+        assert legacy_ser_block(block) == data
+
+        def legacy():
+            legacy_ser_block(block)
+
+        def serialize():
+            block.serialize()
+
+        def into():
+            block.serialize_into(bytearray())
+
+        print("serialize %d byte block with %d transactions" % (len(data), ntx))
+        measure(bench, "serialize", legacy, 3, impl="legacy", txs=ntx)
+        measure(bench, "serialize", serialize, 3, impl="serialize", txs=ntx)
+        measure(bench, "serialize", into, 3, impl="serialize_into", txs=ntx)
+
+
+def legacy_tx_serialize(tx):
+    """CTransaction.serialize() before the serialization was cached"""
+    buf = bytearray()
+    buf += struct.pack("<i", tx.nVersion)
+    ser_vector_into(buf, tx.vin)
+    ser_vector_into(buf, tx.vout)
+    buf += struct.pack("<I", tx.nLockTime)
+    return bytes(buf)
+
+
+def legacy_tx_calc_sha256(tx):
+    """CTransaction.calc_sha256() before the serialization was cached: the hash
+    string was recomputed from a fresh serialization on every call"""
+    if tx.sha256 is None:
+        tx.sha256 = uint256_from_str(hash256(legacy_tx_serialize(tx)))
+    tx.hash = encode(hash256(legacy_tx_serialize(tx))[::-1], 'hex_codec').decode('ascii')
+
+
+def bench_txcache(bench):
+    block = make_block()
+    block.hashMerkleRoot = block.calc_merkle_root()
+    data = block.serialize()
+
+    def legacy_merkle():
+        for tx in block.vtx:
+            legacy_tx_calc_sha256(tx)
+        block.calc_merkle_root()
+
+    def merkle():
+        block.calc_merkle_root()
+
+    def legacy_serialize():
+        buf = bytearray(CBlockHeader.serialize_into(block, bytearray()))
+        buf += ser_compact_size(len(block.vtx))
+        for tx in block.vtx:
+            buf += legacy_tx_serialize(tx)
+        assert buf == data
+
+    def serialize():
+        block.serialize()
+
+    def serialize_after_edit():
+        block.vtx[0].nLockTime = 0  # any change drops every cached serialization
+        block.serialize()
+
+    print("hash and serialize a %d byte block with %d transactions" % (len(data), len(block.vtx)))
+    ntx = len(block.vtx)
+    measure(bench, "txcache_merkle", legacy_merkle, impl="legacy", txs=ntx)
+    measure(bench, "txcache_merkle", merkle, impl="cached", txs=ntx)
+    measure(bench, "txcache_serialize", legacy_serialize, impl="legacy", txs=ntx)
+    measure(bench, "txcache_serialize", serialize_after_edit, impl="after_edit", txs=ntx)
+    measure(bench, "txcache_serialize", serialize, impl="cached", txs=ntx)
+
+
+def legacy_merkle_root(block):
+    """CBlock.calc_merkle_root() before the tree was kept between calls"""
+    hashes = []
+    for tx in block.vtx:
+        tx.calc_sha256()
+        hashes.append(ser_uint256(tx.sha256))
+    while len(hashes) > 1:
+        newhashes = []
+        for i in range(0, len(hashes), 2):
+            i2 = min(i + 1, len(hashes) - 1)
+            newhashes.append(hash256(hashes[i] + hashes[i2]))
+        hashes = newhashes
+    if hashes:
+        return uint256_from_str(hashes[0])
+    return 0
+
+
+def bench_merkle(bench):
+    ntx = 1000
+    txs = make_block(ntx).vtx
+    for tx in txs:
+        tx.rehash()
+
+    # what p2p-fullblocktest's add_transactions_to_block does: grow the block
+    # one transaction at a time and recompute the root after each append
+    def legacy():
+        block = CBlock()
+        for tx in txs:
+            block.vtx.append(tx)
+            block.hashMerkleRoot = legacy_merkle_root(block)
+
+    def incremental():
+        block = CBlock()
+        for tx in txs:
+            block.vtx.append(tx)
+            block.hashMerkleRoot = block.calc_merkle_root()
+
+    block = CBlock()
+    block.vtx = txs[:]
+    root = block.calc_merkle_root()
+    assert root == legacy_merkle_root(block)
+    assert merkle_root_from_branch(ser_uint256(txs[7].sha256), block.get_merkle_branch(7), 7) == root
+
+    def tweak():
+        block.vtx[ntx // 2] = txs[len(block.vtx) % ntx]
+        block.calc_merkle_root()
+
+    print("grow a block to %d transactions, recomputing the merkle root after each" % ntx)
+    measure(bench, "merkle_grow", legacy, 1, warmup=0, impl="legacy", txs=ntx)
+    measure(bench, "merkle_grow", incremental, 1, warmup=0, impl="MerkleTree", txs=ntx)
+    print("replace one transaction in a %d transaction block" % ntx)
+    measure(bench, "merkle_replace", lambda: legacy_merkle_root(block), impl="legacy", txs=ntx)
+    measure(bench, "merkle_replace", tweak, impl="MerkleTree", txs=ntx)
+
+
+def bench_solve(bench):
+    n = 200000
+    header = CBlock()
+    header.nBits = 0x03000001  # a target of 0: no nonce will ever meet it
+
+    def legacy():
+        # CBlock.solve() before NonceSearch: re-pack and hash the whole header
+        target = uint256_from_compact(header.nBits)
+        header.nNonce = 0
+        header.rehash()
+        while header.sha256 > target and header.nNonce < n - 1:
+            header.nNonce += 1
+            header.rehash()
+
+    print("try %d nonces" % n)
+    measure(bench, "solve", legacy, 1, warmup=0, impl="legacy", nonces=n, processes=1)
+    header.nNonce = 0
+    for processes in sorted(set((1, 2, os.cpu_count() or 1))):
+        search = NonceSearch(header, processes)
+        assert search.search(n) is None and search.hashes == n
+        # the time the workers spent hashing, without process startup
+        bench.result("solve", impl="NonceSearch", nonces=n, processes=processes).samples.append(search.elapsed)
+
+    header.nBits = 0x1f00ffff  # ~65536 hashes per block
+    with bench.timer("solve_block", nbits="0x%08x" % header.nBits, processes=os.cpu_count() or 1):
+        search = header.solve(os.cpu_count() or 1)
+    assert header.sha256 <= uint256_from_compact(header.nBits)
+    print("solved 0x%08x with %d hashes at %.0f hashes/s" % (header.nBits, search.hashes, search.hashes_per_second()))
+
+
+def frame(message, network="regtest"):
+    """Wire format of message, as NodeConn.send_message() produces it"""
+    data = message.serialize()
+    return (NodeConn.MAGIC_BYTES[network] + message.command + b"\x00" * (12 - len(message.command)) +
+            struct.pack("<I", len(data)) + hash256(data)[:4] + data)
+
+
+class CountingCB(NodeConnCB):
+    def __init__(self):
+        NodeConnCB.__init__(self)
+        self.count = 0
+        self.nbytes = 0
+
+    def deliver(self, conn, message):
+        self.count += 1
+
+
+class DetachedNodeConn(NodeConnBase):
+    """A NodeConn without a socket: data is fed in with inject_data(), and
+    what it would send is dropped"""
+    def __init__(self, callback):
+        with contextlib.redirect_stdout(StringIO()):  # NodeConnBase prints every connect
+            NodeConnBase.__init__(self, "127.0.0.1", 0, None, callback)
+
+    def send_data(self, data):
+        pass
+
+
+class LegacyNodeConn(DetachedNodeConn):
+    """DetachedNodeConn with the bytes receive buffer that was re-sliced after every message"""
+
+    def __init__(self, callback):
+        DetachedNodeConn.__init__(self, callback)
+        self.recvbuf = b""
+
+    def inject_data(self, buffer):
+        self.recvbuf += buffer
+        self.got_data()
+
+    def got_data(self):
+        while True:
+            if len(self.recvbuf) < 4:
+                return
+            if self.recvbuf[:4] != self.MAGIC_BYTES[self.network]:
+                raise ValueError("got garbage %s" % repr(self.recvbuf))
+            if len(self.recvbuf) < 4 + 12 + 4 + 4:
+                return
+            command = self.recvbuf[4:4 + 12].split(b"\x00", 1)[0]
+            msglen = struct.unpack("<i", self.recvbuf[4 + 12:4 + 12 + 4])[0]
+            checksum = self.recvbuf[4 + 12 + 4:4 + 12 + 4 + 4]
+            if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                return
+            msg = self.recvbuf[4 + 12 + 4 + 4:4 + 12 + 4 + 4 + msglen]
+            if checksum != hash256(msg)[:4]:
+                raise ValueError("got bad checksum " + repr(self.recvbuf))
+            self.recvbuf = self.recvbuf[4 + 12 + 4 + 4 + msglen:]
+            t = self.messagemap[command]()
+            t.deserialize(BufferReader(msg))
+            self.got_message(t)
+
+
+def bench_recv(bench):
+    # recorded traffic: a burst of inv and tx messages around a few large blocks
+    relay = []
+    for i in range(4):
+        block = make_block(2000)
+        for tx in block.vtx[:500]:
+            relay.append(frame(msg_inv([CInv(1, random.getrandbits(256))])))
+            relay.append(frame(msg_tx(tx)))
+        relay.append(frame(msg_block(block)))
+    # and a long run of tiny messages, where framing dominates decoding
+    pings = [frame(msg_ping(i)) for i in range(20000)]
+
+    def feed(cls, data, nmsgs, chunk):
+        def run():
+            cb = CountingCB()
+            conn = cls(cb)
+            for i in range(0, len(data), chunk):
+                conn.inject_data(data[i:i + chunk])
+            assert cb.count == nmsgs, cb.count
+        return run
+
+    for name, msgs in (("relay", relay), ("ping", pings)):
+        data = b"".join(msgs)
+        print("receive %d %s messages, %d bytes" % (len(msgs), name, len(data)))
+        for chunk in (8192, 65536, len(data)):
+            measure(bench, "recv", feed(LegacyNodeConn, data, len(msgs), chunk), 3,
+                    impl="legacy", traffic=name, chunk=chunk)
+            measure(bench, "recv", feed(DetachedNodeConn, data, len(msgs), chunk), 3,
+                    impl="recvoff", traffic=name, chunk=chunk)
+
+
+def legacy_wait_until(predicate, attempts=float('inf'), timeout=float('inf')):
+    """wait_until() before it waited on mininode_cond: poll every 50ms"""
+    attempt = 0
+    elapsed = 0
+    while attempt < attempts and elapsed < timeout:
+        with mininode_lock:
+            if predicate():
+                return True
+        attempt += 1
+        elapsed += 0.05
+        time.sleep(0.05)
+    return False
+
+
+def bench_wait_until(bench):
+    # a network thread delivers a message 1ms after the test thread starts
+    # waiting for it, as in every comptool sync step
+    rounds = 20
+
+    def roundtrips(wait):
+        def run():
+            for i in range(rounds):
+                state = {"delivered": False}
+
+                def deliver():
+                    time.sleep(0.001)
+                    with mininode_lock:
+                        state["delivered"] = True
+                        mininode_cond.notify_all()
+                t = threading.Thread(target=deliver)
+                t.start()
+                assert wait(lambda: state["delivered"], timeout=10)
+                t.join()
+        return run
+
+    print("%d waits for a message delivered after 1ms" % rounds)
+    measure(bench, "wait_until", roundtrips(legacy_wait_until), 1, impl="legacy", rounds=rounds)
+    measure(bench, "wait_until", roundtrips(wait_until), 1, impl="mininode_cond", rounds=rounds)
+
+
+class PingCountCB(NodeConnCB):
+    def __init__(self, lock=None):
+        NodeConnCB.__init__(self, lock)
+        self.count = 0
+
+    def on_ping(self, conn, message):
+        self.count += 1
+
+
+def serve_pings(server, nconns, data):
+    # a peer that, for each of nconns connections, reads the version message,
+    # sends data and closes its side once the other end has closed
+    def handle(sock):
+        sock.recv(65536)
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        while sock.recv(65536):
+            pass
+        sock.close()
+    for i in range(nconns):
+        sock, addr = server.accept()
+        threading.Thread(target=handle, args=(sock,)).start()
+
+
+def bench_locks(bench):
+    # Every NodeConn callback runs on the one NetworkThread, so a lock per
+    # callback cannot make delivery itself any faster.  What it changes is
+    # whether the network thread waits for a test thread that holds
+    # mininode_lock, here for 1ms out of every 2ms, as a test does that
+    # polls or inspects callback state while blocks are delivered.
+    nmsgs = 2000
+    nconns = 4
+    data = b"".join(frame(msg_ping(i)) for i in range(nmsgs))
+
+    def drive(private):
+        def run():
+            server = socket.socket()
+            server.bind(("127.0.0.1", 0))
+            server.listen(nconns)
+            port = server.getsockname()[1]
+            peer = threading.Thread(target=serve_pings, args=(server, nconns, data))
+            peer.start()
+            cbs = [PingCountCB(threading.RLock() if private else None) for i in range(nconns)]
+            with contextlib.redirect_stdout(StringIO()):  # NodeConn prints every connect
+                conns = [NodeConn("127.0.0.1", port, None, cb) for cb in cbs]
+            network = NetworkThread()
+            done = threading.Event()
+
+            def busy_test_thread():
+                while not done.is_set():
+                    with mininode_lock:
+                        time.sleep(0.001)
+                    time.sleep(0.001)
+            busy = threading.Thread(target=busy_test_thread)
+            busy.start()
+            network.start()
+            network.join()
+            done.set()
+            busy.join()
+            peer.join()
+            server.close()
+            assert all(cb.count == nmsgs for cb in cbs), [cb.count for cb in cbs]
+        return run
+
+    print("%d connections through NetworkThread, %d pings each, while a test thread"
+          " holds mininode_lock half the time" % (nconns, nmsgs))
+    measure(bench, "locks", drive(False), 3, impl="mininode_lock", conns=nconns, msgs=nmsgs)
+    measure(bench, "locks", drive(True), 3, impl="per_callback", conns=nconns, msgs=nmsgs)
+
+
+def peak_memory(fn):
+    """Return the most memory fn had allocated at any one time"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_jsondecode(bench):
+    # a getrawmempool true response, as AuthServiceProxy receives it
+    ntx = 20000
+    mempool = {}
+    for i in range(ntx):
+        mempool["%064x" % random.getrandbits(256)] = {
+            "size": 226, "fee": 0.0000226, "modifiedfee": 0.0000226, "time": 1500000000 + i,
+            "height": 1000, "startingpriority": 12345.6789, "currentpriority": 12345.6789,
+            "descendantcount": 1, "descendantsize": 226, "descendantfees": 2260,
+            "depends": ["%064x" % random.getrandbits(256)]}
+    data = json.dumps({"result": mempool, "error": None, "id": 1}).encode()
+
+    # _get_response() before debug logging was made conditional
+    def legacy():
+        responsedata = data.decode('utf8')
+        response = json.loads(responsedata, parse_float=decimal.Decimal)
+        json.dumps(response["result"], default=EncodeDecimal)
+
+    def loads():
+        json.loads(data, parse_float=decimal.Decimal)
+
+    def stream():
+        reader = JSONStreamReader(BytesIO(data))
+        for key in reader.keys():
+            if key == "result":
+                for txid, entry in reader.elements():
+                    pass
+            else:
+                reader.value()
+
+    print("decode a %d byte getrawmempool true response with %d entries" % (len(data), ntx))
+    # peak memory is not a timing, so it goes in the metadata of the results
+    peaks = bench.metadata.setdefault("jsondecode_peak_bytes", {})
+    for impl, fn in (("legacy", legacy), ("json.loads", loads), ("JSONStreamReader", stream)):
+        measure(bench, "jsondecode", fn, 3, impl=impl, entries=ntx)
+        peaks[impl] = peak_memory(fn)
+        print("%-16s %8.2f MB peak" % (impl, peaks[impl] / 1e6))
+
+
+def bench_storage(bench):
+    # blocks of 1 to 32MB through every comptool storage backend this Python has;
+    # about 64MB is written per size, and read back in a different order
+    backends = sorted(available_backends())
+    print("storage backends: %s" % " ".join(backends))
+    for mb in (1, 2, 4, 8, 16, 32):
+        size = mb << 20
+        count = max(2, 64 // mb)
+        value = os.urandom(size)
+        keys = [random.getrandbits(256) for i in range(count)]
+        order = sorted(keys)
+        for name in backends:
+            d = tempfile.mkdtemp()
+            try:
+                db = open_storage(name, os.path.join(d, "blocks"))
+                with bench.timer("storage_put", backend=name, mb=mb, count=count):
+                    for k in keys:
+                        db.put(k, value)
+                with bench.timer("storage_get", backend=name, mb=mb, count=count):
+                    for k in order:
+                        assert len(db.get(k)) == size
+                db.close()
+            finally:
+                shutil.rmtree(d)
+
+
+BENCHMARKS = {
+    "deserialize": bench_deserialize,
+    "jsondecode": bench_jsondecode,
+    "locks": bench_locks,
+    "merkle": bench_merkle,
+    "recv": bench_recv,
+    "serialize": bench_serialize,
+    "solve": bench_solve,
+    "storage": bench_storage,
+    "txcache": bench_txcache,
+    "wait_until": bench_wait_until,
+}
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("--benchout", dest="benchout", default="frameworkPerf",
+                      help="Write the timings to BENCHOUT.json and BENCHOUT.csv (default: %default)")
+    parser.add_option("--baseline", dest="baseline", default=None,
+                      help="Compare the timings against this earlier BENCHOUT.json")
+    (options, names) = parser.parse_args()
+    names = names or sorted(BENCHMARKS.keys())
+    for n in names:
+        if n not in BENCHMARKS:
+            parser.error("unknown benchmark %s, choose from: %s" % (n, " ".join(sorted(BENCHMARKS.keys()))))
+
+    bench = Benchmark("frameworkPerf")
+    for n in names:
+        BENCHMARKS[n](bench)
+    print()
+    baseline = Benchmark.load(options.baseline) if options.baseline else None
+    bench.report(baseline)
+    bench.write_json(options.benchout + ".json")
+    bench.write_csv(options.benchout + ".csv")
+    print("Results written to %s.json and %s.csv" % (options.benchout, options.benchout))
+    if baseline:
+        for r, old, new in bench.regressions(baseline):
+            print("REGRESSION %s %s: median %f s, baseline %f s" % (r.name, r.params, new, old))
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,13 @@ class FullBlockTest(ComparisonTestFramework):
 
     ''' Can either run this test as 1 node with expected answers, or two and compare them. 
         Change the "outcome" variable from each TestInstance object to only do the comparison. '''
+
+    # get_tests() only reads the genesis hash from the node, so comptool may
+    # replay its blocks from a file (see test_framework/testvectors.py) and
+    # send them ahead without waiting for each outcome (see --pipeline)
+    cache_test_vectors = True
+    pipeline_test_blocks = True
+
     def __init__(self):
         self.num_nodes = 1
         self.block_heights = {}
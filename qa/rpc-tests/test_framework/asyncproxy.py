@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Unlimited developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+asyncio JSON-RPC client, the coroutine counterpart of AuthServiceProxy.
+
+    proxy = AsyncServiceProxy(url)
+    count = await proxy.getblockcount()
+    counts = await call_all([proxy0, proxy1, proxy2], "getblockcount")
+
+It encodes Decimal parameters and parses floats as Decimal exactly as
+authproxy does, and raises the same JSONRPCException.  Connections are kept
+alive and reused, several per server so that concurrent calls do not wait
+for each other.
+
+Test code that is not itself asynchronous uses rpc_all(nodes, method, ...),
+which issues the call to all nodes at once from a background event loop and
+returns the results in node order.
+"""
+import asyncio
+import base64
+import decimal
+import json
+import logging
+import ssl
+import threading
+import urllib.parse as urlparse
+
+from .authproxy import JSONRPCException, EncodeDecimal, HTTP_TIMEOUT, USER_AGENT
+from .coverage import AuthServiceProxyWrapper
+
+log = logging.getLogger("BitcoinRPC")
+
+
+class AsyncServiceProxy(object):
+    __id_count = 0
+
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, ensure_ascii=True, connections=None):
+        self.__service_url = service_url
+        self._service_name = service_name
+        self.__timeout = timeout
+        self.ensure_ascii = ensure_ascii
+        self.__url = urlparse.urlparse(service_url)
+        authpair = ("%s:%s" % (self.__url.username, self.__url.password)).encode('utf8')
+        self.__auth_header = 'Basic ' + base64.b64encode(authpair).decode('ascii')
+        # idle (reader, writer) pairs, shared with the method proxies
+        self.__connections = connections if connections is not None else []
+        self.__methods = {}
+
+    def __getattr__(self, name):
+        if (name.startswith('__') and name.endswith('__')) or name.startswith('_AsyncServiceProxy__'):
+            # Python internal stuff, or our own attributes before __init__ has set them
+            raise AttributeError
+        try:
+            return self.__methods[name]
+        except KeyError:
+            pass
+        if self._service_name is not None:
+            fullname = "%s.%s" % (self._service_name, name)
+        else:
+            fullname = name
+        proxy = AsyncServiceProxy(self.__service_url, fullname, self.__timeout, self.ensure_ascii, self.__connections)
+        return self.__methods.setdefault(name, proxy)
+
+    async def __call__(self, *args):
+        AsyncServiceProxy.__id_count += 1
+        call_id = AsyncServiceProxy.__id_count
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-%s-> %s %s" % (call_id, self._service_name,
+                                       json.dumps(args, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
+        postdata = json.dumps({'version': '1.1',
+                               'method': self._service_name,
+                               'params': args,
+                               'id': call_id}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
+        response = await self._request(postdata.encode('utf-8'))
+        if response['error'] is not None:
+            raise JSONRPCException(response['error'])
+        elif 'result' not in response:
+            raise JSONRPCException({
+                'code': -343, 'message': 'missing JSON-RPC result'})
+        else:
+            return response['result']
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        while self.__connections:
+            reader, writer, owner = self.__connections.pop()
+            # connections belong to the loop that opened them
+            if owner is loop and not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        port = self.__url.port
+        if self.__url.scheme == 'https':
+            return await asyncio.open_connection(self.__url.hostname, port or 443, ssl=ssl.create_default_context())
+        return await asyncio.open_connection(self.__url.hostname, port or 80)
+
+    async def _request(self, postdata):
+        # One retry: a kept-alive connection may have been closed by the server
+        for attempt in (0, 1):
+            reader, writer = await self._connect()
+            try:
+                status, headers, body = await asyncio.wait_for(self._exchange(reader, writer, postdata),
+                                                               self.__timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if attempt:
+                    raise
+                continue
+            except:
+                writer.close()
+                raise
+            if headers.get('connection', '').lower() == 'close':
+                writer.close()
+            else:
+                self.__connections.append((reader, writer, asyncio.get_running_loop()))
+            return self._decode(status, headers, body)
+
+    async def _exchange(self, reader, writer, postdata):
+        request = ("POST %s HTTP/1.1\r\n"
+                   "Host: %s\r\n"
+                   "User-Agent: %s\r\n"
+                   "Authorization: %s\r\n"
+                   "Content-type: application/json\r\n"
+                   "Content-Length: %d\r\n\r\n" % (self.__url.path or "/", self.__url.hostname, USER_AGENT,
+                                                   self.__auth_header, len(postdata)))
+        writer.write(request.encode('latin-1') + postdata)
+        await writer.drain()
+        status_line = await reader.readuntil(b"\r\n")
+        parts = status_line.decode('latin-1').split(None, 2)
+        if len(parts) < 2:
+            raise ConnectionResetError("bad HTTP status line %r" % status_line)
+        status = (int(parts[1]), parts[2].strip() if len(parts) > 2 else "")
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            key, _, value = line.decode('latin-1').partition(":")
+            headers[key.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readuntil(b"\r\n")
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        else:
+            headers['connection'] = 'close'
+            body = await reader.read()
+        return status, headers, body
+
+    def _decode(self, status, headers, body):
+        if headers.get('content-type') != 'application/json':
+            raise JSONRPCException({
+                'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % status})
+        response = json.loads(body, parse_float=decimal.Decimal)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("<-- " + body.decode('utf8'))
+        return response
+
+    async def close(self):
+        while self.__connections:
+            reader, writer, owner = self.__connections.pop()
+            writer.close()
+
+
+async def call_all(proxies, method, *args, return_exceptions=False):
+    """Call method(*args) on every proxy concurrently; the results in proxy order.
+
+    Like asyncio.gather, the first JSONRPCException is raised, unless
+    return_exceptions is set and the exceptions are returned as results.
+    """
+    return await asyncio.gather(*[getattr(p, method)(*args) for p in proxies],
+                                return_exceptions=return_exceptions)
+
+
+async def gather_calls(calls, return_exceptions=False):
+    """Run a list of (proxy, method, args) calls concurrently; the results in order"""
+    return await asyncio.gather(*[getattr(p, method)(*args) for (p, method, args) in calls],
+                                return_exceptions=return_exceptions)
+
+
+# Event loop in a background thread for rpc_all(), with one AsyncServiceProxy
+# (and so one set of kept-alive connections) per url and timeout.
+rpc_loop = None
+rpc_loop_lock = threading.Lock()
+async_proxies = {}
+
+
+def get_rpc_loop():
+    global rpc_loop
+    with rpc_loop_lock:
+        if rpc_loop is None:
+            rpc_loop = asyncio.new_event_loop()
+            t = threading.Thread(target=rpc_loop.run_forever, name="rpc event loop")
+            t.daemon = True
+            t.start()
+        return rpc_loop
+
+
+def async_proxy(node):
+    """The AsyncServiceProxy for the server a (sync) node proxy talks to, with
+    the same timeout, or None if the proxy does not record its url (see
+    util.get_rpc_proxy)"""
+    # a bare AuthServiceProxy answers any attribute with a method proxy
+    url = getattr(node, "url", None)
+    if not isinstance(url, str):
+        return None
+    timeout = getattr(node, "timeout", None)
+    if not isinstance(timeout, (int, float)):
+        timeout = HTTP_TIMEOUT
+    with rpc_loop_lock:
+        proxy = async_proxies.get((url, timeout))
+        if proxy is None:
+            proxy = async_proxies[(url, timeout)] = AsyncServiceProxy(url, timeout=timeout)
+        return proxy
+
+
+def rpc_all(nodes, method, *args, return_exceptions=False):
+    """Call method(*args) on all nodes at once and return the results in order.
+
+    nodes are the usual synchronous proxies; all of them are asked
+    concurrently, so this takes one round trip of wall clock time rather
+    than one per node.  Falls back to calling them one by one if a proxy
+    does not know its url.  With return_exceptions, every node is called
+    even if some fail, and their exceptions are returned in place of results.
+    """
+    proxies = [async_proxy(n) for n in nodes]
+    if None in proxies:
+        results = []
+        for n in nodes:
+            try:
+                results.append(getattr(n, method)(*args))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+    future = asyncio.run_coroutine_threadsafe(call_all(proxies, method, *args, return_exceptions=return_exceptions),
+                                              get_rpc_loop())
+    results = future.result()
+    for n in nodes:
+        # keep the RPC coverage log complete
+        if isinstance(n, AuthServiceProxyWrapper):
+            n._record(method)
+    return results
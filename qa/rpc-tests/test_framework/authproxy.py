@@ -5,13 +5,16 @@ Copyright 2011 Jeff Garzik
 AuthServiceProxy has the following improvements over python-jsonrpc's
 ServiceProxy class:
 
-- HTTP connections persist for the life of the AuthServiceProxy object
-(if server supports HTTP/1.1)
+- HTTP connections persist (if server supports HTTP/1.1) in a thread-safe
+pool shared by all proxies for the same server, so one proxy can be used
+from several threads at once
 - sends protocol 'version', per JSON-RPC 1.1
 - sends proper, incrementing 'id'
 - sends Basic HTTP authentication headers
 - parses all JSON numbers that look like floats as Decimal
 - uses standard Python json lib
+- batches calls: with proxy.batch() as b: ... (see RPCBatch)
+- streams large results: for tx in proxy.getrawmempool.stream(True): ...
 
 Previous copyright, from python-jsonrpc/jsonrpc/proxy.py:
 
@@ -39,9 +42,14 @@ try:
 except ImportError:
     import httplib
 import base64
+import codecs
 import decimal
+import itertools
 import json
 import logging
+import re
+import select
+import threading
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -51,6 +59,17 @@ USER_AGENT = "AuthServiceProxy/0.1"
 
 HTTP_TIMEOUT = 30
 
+# Calls per HTTP request when a batch is sent
+BATCH_CHUNK_SIZE = 500
+
+# Idle connections kept per server, and how many may be in use at once
+# (bitcoind's default -rpcworkqueue is 16)
+POOL_SIZE = 8
+POOL_MAX_CONNECTIONS = 16
+
+# Bytes read from the socket at a time by stream()
+STREAM_CHUNK_SIZE = 1 << 16
+
 log = logging.getLogger("BitcoinRPC")
 
 class JSONRPCException(Exception):
@@ -66,20 +85,210 @@ def EncodeDecimal(o):
         return str(o)
     raise TypeError(repr(o) + " is not JSON serializable")
 
+class JSONStreamReader(object):
+    """
+    Decode JSON from a binary file object (such as an HTTP response) piece by
+    piece, reading only as much as the next value needs.  Floats are parsed
+    as Decimal.
+
+    >>> from io import BytesIO
+    >>> r = JSONStreamReader(BytesIO(b'{"result": [1, 0.1, {"a": null}], "id": 7}'), chunk_size=3)
+    >>> for key in r.keys():
+    ...     print(key, list(r.elements()) if key == "result" else r.value())
+    result [1, Decimal('0.1'), {'a': None}]
+    id 7
+    >>> list(JSONStreamReader(BytesIO(b' {"x": [], "y": 2.50} ')).elements())
+    [('x', []), ('y', Decimal('2.50'))]
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    DELIMITERS = ' \t\n\r,:]}'
+
+    def __init__(self, fp, parse_float=decimal.Decimal, chunk_size=STREAM_CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder(parse_float=parse_float)
+        self.utf8 = codecs.getincrementaldecoder('utf8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        """Append up to size more bytes of input to the buffer, dropping what
+        has been consumed; False at the end of the input"""
+        if self.eof:
+            return False
+        data = self.fp.read(size)
+        self.eof = not data
+        self.buf = self.buf[self.pos:] + self.utf8.decode(data, final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """The next character that is not whitespace, '' at the end of the input"""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill(self.chunk_size):
+                return ''
+
+    def expect(self, chars):
+        """Consume the next character, which must be one of chars"""
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("expected one of %r at %r" % (chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decode the next complete value"""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number cut short by the end of the buffer ("1" of "1.5")
+                # parses, so also check that what follows can end a value
+                if self.eof or (end < len(self.buf) and self.buf[end] in self.DELIMITERS):
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill(size)
+            # read ahead geometrically so a large value is not rescanned once per chunk
+            size = max(size, len(self.buf))
+
+    def keys(self):
+        """Iterate over the keys of the next object.  The caller reads each
+        key's value (with value() or elements()) before asking for the next."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """Iterate over the items of the next array, or the (key, value)
+        pairs of the next object, decoding one at a time"""
+        if self.peek() == '{':
+            for key in self.keys():
+                yield key, self.value()
+            return
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent HTTP/1.1 connections to one RPC server.
+
+    At most max_connections are in use at once (acquire() waits up to the
+    HTTP timeout for one to be released) and up to size idle connections are
+    kept for reuse.  An idle connection that the server has closed in the
+    meantime is detected when it is handed out and replaced.
+    """
+    def __init__(self, url, timeout=HTTP_TIMEOUT, size=POOL_SIZE, max_connections=POOL_MAX_CONNECTIONS):
+        self.url = url
+        self.port = 80 if url.port is None else url.port
+        self.timeout = timeout
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.created = 0
+        self.reused = 0
+
+    def new_connection(self):
+        if self.url.scheme == 'https':
+            return httplib.HTTPSConnection(self.url.hostname, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.url.hostname, self.port, timeout=self.timeout)
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise JSONRPCException({
+                'code': -342, 'message': 'timed out waiting for a connection to %s' % self.url.hostname})
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    self.created += 1
+                    return self.new_connection()
+                if self.healthy(conn):
+                    self.reused += 1
+                    return conn
+                conn.close()
+        except:
+            self.slots.release()
+            raise
+
+    @staticmethod
+    def healthy(conn):
+        if conn.sock is None:
+            return True  # http.client connects on the next request
+        try:
+            # nothing is due on an idle connection, so if it is readable the
+            # server has closed it (or it is out of step)
+            return not select.select([conn.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    def release(self, conn, reusable=True):
+        try:
+            if reusable:
+                with self.lock:
+                    if len(self.idle) < self.size:
+                        self.idle.append(conn)
+                        conn = None
+            if conn is not None:
+                conn.close()
+        finally:
+            self.slots.release()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(url, timeout=HTTP_TIMEOUT):
+    """The ConnectionPool shared by all proxies for this server and timeout"""
+    key = (url.scheme, url.hostname, url.port, timeout)
+    with connection_pools_lock:
+        pool = connection_pools.get(key)
+        if pool is None:
+            pool = connection_pools[key] = ConnectionPool(url, timeout)
+        return pool
+
+
 class AuthServiceProxy(object):
-    __id_count = 0
+    __id_counter = itertools.count(1)
 
     # ensure_ascii: escape unicode as \uXXXX, passed to json.dumps
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True):
+    # pool: the ConnectionPool to use, by default the one shared by every proxy for this server
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True, pool=None):
         self.__timeout = timeout
         self.__service_url = service_url
         self._service_name = service_name
         self.ensure_ascii = ensure_ascii # can be toggled on the fly by tests
         self.__url = urlparse.urlparse(service_url)
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
         (user, passwd) = (self.__url.username, self.__url.password)
         try:
             user = user.encode('utf8')
@@ -91,76 +300,103 @@ class AuthServiceProxy(object):
             pass
         authpair = user + b':' + passwd
         self.__auth_header = b'Basic ' + base64.b64encode(authpair)
+        self.__headers = {'Host': self.__url.hostname,
+                          'User-Agent': USER_AGENT,
+                          'Authorization': self.__auth_header,
+                          'Content-type': 'application/json'}
+        # method proxies handed out by __getattr__, created once per name
+        self.__methods = {}
 
-        if connection:
-            # Callables re-use the connection of the original proxy
-            self.__conn = connection
-        elif self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  timeout=timeout)
+        if pool is not None:
+            self.__pool = pool
+        elif connection:
+            # A private pool around the given connection
+            self.__pool = ConnectionPool(self.__url, timeout, size=1, max_connections=1)
+            self.__pool.idle.append(connection)
         else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 timeout=timeout)
+            self.__pool = get_connection_pool(self.__url, timeout)
+
     def reconnect(self):
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
+        self.__pool.clear()
 
-        if self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  timeout=self.__timeout)
-        else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 timeout=self.__timeout)
+    @property
+    def timeout(self):
+        """The HTTP timeout of calls through this proxy, in seconds"""
+        return self.__timeout
 
     def __getattr__(self, name):
-        if name.startswith('__') and name.endswith('__'):
-            # Python internal stuff
+        if (name.startswith('__') and name.endswith('__')) or name.startswith('_AuthServiceProxy__'):
+            # Python internal stuff, or our own attributes before __init__ has set them
             raise AttributeError
+        try:
+            return self.__methods[name]
+        except KeyError:
+            pass
         if self._service_name is not None:
-            name = "%s.%s" % (self._service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+            fullname = "%s.%s" % (self._service_name, name)
+        else:
+            fullname = name
+        proxy = AuthServiceProxy(self.__service_url, fullname, self.__timeout, pool=self.__pool)
+        return self.__methods.setdefault(name, proxy)
 
-    def _request(self, method, path, postdata):
+    def _send(self, method, path, postdata):
         '''
-        Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
-        This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
+        Do a HTTP request on a pooled connection and return the connection and
+        the (unread) response; the caller releases the connection.  If a
+        kept-alive connection turns out to have been closed by the server
+        before the request could be sent, retry once on a new one.  Once the
+        request is sent it is never repeated: the server may have executed
+        it (think sendtoaddress or generate) even if no response arrives.
         '''
-        headers = {'Host': self.__url.hostname,
-                   'User-Agent': USER_AGENT,
-                   'Authorization': self.__auth_header,
-                   'Content-type': 'application/json'}
+        retry = True
         while 1:
-          try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
-          except httplib.CannotSendRequest as e:
-            print("Cannot send request:", str(e))
-            self.reconnect()
-          except httplib.BadStatusLine as e:
-            if e.line == "''": # if connection was closed, try again
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
-            else:
+            conn = self.__pool.acquire()
+            try:
+                conn.request(method, path, postdata, self.__headers)
+            except (httplib.CannotSendRequest, BrokenPipeError, ConnectionResetError):
+                self.__pool.release(conn, reusable=False)
+                if not retry:
+                    raise
+                retry = False
+                continue
+            except:
+                self.__pool.release(conn, reusable=False)
                 raise
-          except (BrokenPipeError, ConnectionResetError):
-            # Python 3.5+ raises this instead of BadStatusLine when the connection was reset
-            self.__conn.close()
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
+            try:
+                http_response = self._get_http_response(conn)
+            except:
+                self.__pool.release(conn, reusable=False)
+                raise
+            return conn, http_response
 
-    def __call__(self, *args):
-        AuthServiceProxy.__id_count += 1
+    def _request(self, method, path, postdata):
+        conn, http_response = self._send(method, path, postdata)
+        try:
+            response = self._get_response(http_response)
+        except:
+            self.__pool.release(conn, reusable=False)
+            raise
+        self.__pool.release(conn)
+        return response
 
-        log.debug("-%s-> %s %s"%(AuthServiceProxy.__id_count, self._service_name,
-                                 json.dumps(args, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
+    def _postdata(self, call_id, args):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-%s-> %s %s"%(call_id, self._service_name,
+                                     json.dumps(args, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
         postdata = json.dumps({'version': '1.1',
                                'method': self._service_name,
                                'params': args,
-                               'id': AuthServiceProxy.__id_count}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        response = self._request('POST', self.__url.path, postdata.encode('utf-8'))
+                               'id': call_id}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
+        return postdata.encode('utf-8')
+
+    def _next_id(self):
+        return next(AuthServiceProxy.__id_counter)
+
+    def __call__(self, *args):
+        call_id = self._next_id()
+
+        postdata = self._postdata(call_id, args)
+        response = self._request('POST', self.__url.path, postdata)
         if response['error'] is not None:
             raise JSONRPCException(response['error'])
         elif 'result' not in response:
@@ -171,11 +407,70 @@ class AuthServiceProxy(object):
 
     def _batch(self, rpc_call_list):
         postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        log.debug("--> "+postdata)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("--> "+postdata)
         return self._request('POST', self.__url.path, postdata.encode('utf-8'))
 
-    def _get_response(self):
-        http_response = self.__conn.getresponse()
+    def batch(self, chunk_size=BATCH_CHUNK_SIZE, observer=None):
+        """
+        Collect calls and send them as JSON-RPC batches, for example:
+
+            with node.batch() as b:
+                addrs = [b.getnewaddress() for i in range(1000)]
+            addrs = [a.result() for a in addrs]
+
+        The calls are sent when the with block ends (or on execute()), at most
+        chunk_size per HTTP request.
+        """
+        return RPCBatch(self, chunk_size, observer)
+
+    def stream(self, *args):
+        """
+        Call this method and decode its result while it is being received,
+        one element at a time: yields the items of an array result or the
+        (key, value) pairs of an object result (any other result is yielded
+        on its own).  For example:
+
+            for txid, entry in node.getrawmempool.stream(True):
+                ...
+
+        Only one element is held in memory at a time, rather than the
+        complete response text and its decoded copy.  The connection is busy
+        until the iteration ends.
+        """
+        call_id = self._next_id()
+        postdata = self._postdata(call_id, args)
+        conn, http_response = self._send('POST', self.__url.path, postdata)
+        reusable = False
+        try:
+            reader = JSONStreamReader(http_response)
+            response = {}
+            streamed = False
+            count = 0
+            for key in reader.keys():
+                if key == 'result' and reader.peek() in ('[', '{'):
+                    streamed = True
+                    for item in reader.elements():
+                        count += 1
+                        yield item
+                else:
+                    response[key] = reader.value()
+            http_response.read()
+            reusable = True
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("<-%s- %d items" % (response.get("id"), count))
+            if response.get('error') is not None:
+                raise JSONRPCException(response['error'])
+            elif not streamed:
+                if 'result' not in response:
+                    raise JSONRPCException({
+                        'code': -343, 'message': 'missing JSON-RPC result'})
+                yield response['result']
+        finally:
+            self.__pool.release(conn, reusable)
+
+    def _get_http_response(self, conn):
+        http_response = conn.getresponse()
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
@@ -184,11 +479,119 @@ class AuthServiceProxy(object):
         if content_type != 'application/json':
             raise JSONRPCException({
                 'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (http_response.status, http_response.reason)})
+        return http_response
 
-        responsedata = http_response.read().decode('utf8')
+    def _get_response(self, http_response):
+        # json decodes the utf-8 bytes itself, without a str copy of the body
+        responsedata = http_response.read()
         response = json.loads(responsedata, parse_float=decimal.Decimal)
-        if "error" in response and response["error"] is None:
-            log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
-        else:
-            log.debug("<-- "+responsedata)
+        if log.isEnabledFor(logging.DEBUG):
+            if "error" in response and response["error"] is None:
+                log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
+            else:
+                log.debug("<-- "+responsedata.decode('utf8'))
         return response
+
+
+class RPCFuture(object):
+    """The outcome of one call in an RPCBatch"""
+    def __init__(self, method, params, call_id):
+        self.method = method
+        self.params = params
+        self.id = call_id
+        self._response = None
+
+    def done(self):
+        return self._response is not None
+
+    def set_response(self, response):
+        self._response = response
+
+    def exception(self):
+        """The JSONRPCException for this call, or None if it succeeded"""
+        if self._response is None:
+            raise JSONRPCException({
+                'code': -344, 'message': '%s called before its batch was executed' % self.method})
+        if self._response.get('error') is not None:
+            return JSONRPCException(self._response['error'])
+        if 'result' not in self._response:
+            return JSONRPCException({
+                'code': -343, 'message': 'missing JSON-RPC result'})
+        return None
+
+    def result(self):
+        """The result of this call; raises its JSONRPCException if it failed"""
+        e = self.exception()
+        if e is not None:
+            raise e
+        return self._response['result']
+
+
+class RPCBatch(object):
+    """Calls queued on an AuthServiceProxy to be sent as JSON-RPC batches.
+
+    Attribute access returns a callable that queues a call and returns its
+    RPCFuture.  Use AuthServiceProxy.batch() to create one.
+    """
+    def __init__(self, proxy, chunk_size=BATCH_CHUNK_SIZE, observer=None):
+        self._proxy = proxy
+        self._chunk_size = chunk_size
+        self._observer = observer
+        self._calls = []
+        self._executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        if self._proxy._service_name is not None:
+            name = "%s.%s" % (self._proxy._service_name, name)
+        def queue(*args):
+            return self.call(name, *args)
+        return queue
+
+    def call(self, method, *args):
+        """Queue method(*args), returning the RPCFuture for it"""
+        future = RPCFuture(method, args, self._proxy._next_id())
+        self._calls.append(future)
+        return future
+
+    def __len__(self):
+        return len(self._calls)
+
+    def execute(self):
+        """Send all queued calls, in order, and return their futures"""
+        calls, self._calls = self._calls, []
+        self._executed.extend(calls)
+        for start in range(0, len(calls), self._chunk_size):
+            chunk = calls[start:start + self._chunk_size]
+            responses = self._proxy._batch({'version': '1.1',
+                                            'method': c.method,
+                                            'params': c.params,
+                                            'id': c.id} for c in chunk)
+            if not isinstance(responses, list):
+                # the whole request failed, e.g. it could not be parsed
+                error = responses.get('error') or {'code': -342, 'message': 'non-batch response to a batch request'}
+                for c in chunk:
+                    c.set_response({'error': error})
+                continue
+            by_id = dict((r.get('id'), r) for r in responses)
+            for c in chunk:
+                c.set_response(by_id.get(c.id, {'error': None}))
+                if self._observer is not None:
+                    self._observer(c.method)
+        return calls
+
+    def results(self):
+        """Send any queued calls and return the results of all calls made
+        through this batch in order, raising the first failed call's
+        JSONRPCException"""
+        self.execute()
+        return [c.result() for c in self._executed]
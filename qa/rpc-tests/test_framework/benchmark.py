@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Unlimited developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Timing harness for performance tests such as txPerf.py
+
+A Benchmark collects named measurements, each identified by its name and
+parameters (for example the number of inputs and outputs of a transaction).
+Operations that can be repeated are run a few times untimed to warm up and
+then timed repeatedly; operations that change state, like generating a
+block, are timed once per call with timer().  All times come from
+time.perf_counter, a monotonic clock.
+
+Results are written as JSON (the schema is described by SCHEMA) or CSV, and
+can be compared against a previous JSON file to find regressions:
+
+    bench = Benchmark("txPerf")
+    bench.measure("signrawtransaction", lambda: node.signrawtransaction(tx), inputs=10, outputs=2)
+    with bench.timer("generate", txs=1):
+        node.generate(1)
+    bench.write_json("txPerf.json")
+    for result, old, new in bench.regressions(Benchmark.load("baseline.json")):
+        ...
+
+>>> ticks = iter(range(0, 100, 2))
+>>> bench = Benchmark("example", clock=lambda: next(ticks))
+>>> r = bench.measure("op", lambda: None, warmup=1, repetitions=3, size=10)
+>>> r.samples
+[2, 2, 2]
+>>> with bench.timer("op", size=20):
+...     pass
+>>> bench.results[("op", (("size", 20),))].samples
+[2]
+>>> sorted(bench.results[("op", (("size", 10),))].stats().items())
+[('count', 3), ('max', 2), ('mean', 2.0), ('median', 2), ('min', 2), ('p90', 2.0), ('p99', 2.0), ('stdev', 0.0)]
+"""
+import csv
+import json
+import math
+import platform
+import time
+from contextlib import contextmanager
+
+SCHEMA = {
+    "schema": "bitcoinunlimited-benchmark",
+    "version": 1,
+    "fields": {
+        "suite": "name of the Benchmark",
+        "metadata": "host, platform, python version and start time of the run, plus anything the caller added",
+        "results": "list of {name, params, unit, samples, stats, error}; samples in seconds",
+        "stats": "count, min, max, mean, median, p90, p99, stdev of the samples",
+    }
+}
+
+CSV_FIELDS = ["suite", "name", "params", "count", "min", "median", "mean", "p90", "p99", "max", "stdev", "error"]
+
+# A measurement regressed if its median grew by more than this fraction
+REGRESSION_TOLERANCE = 0.2
+
+
+def percentile(samples, p):
+    """
+    The p'th percentile of samples, interpolating between the nearest ranks
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2.5
+    >>> percentile([5, 1, 3], 100)
+    5
+    """
+    s = sorted(samples)
+    if not s:
+        return None
+    k = (len(s) - 1) * p / 100.0
+    lo = int(math.floor(k))
+    hi = int(math.ceil(k))
+    if lo == hi:
+        return s[lo]
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+class BenchmarkResult(object):
+    """The samples taken for one name and set of parameters"""
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.samples = []
+        self.error = None
+
+    def stats(self):
+        s = self.samples
+        if not s:
+            return {"count": 0}
+        mean = sum(s) / len(s)
+        return {"count": len(s), "min": min(s), "max": max(s), "mean": mean,
+                "median": percentile(s, 50), "p90": percentile(s, 90), "p99": percentile(s, 99),
+                "stdev": math.sqrt(sum((x - mean) ** 2 for x in s) / len(s))}
+
+    def as_dict(self):
+        return {"name": self.name, "params": self.params, "unit": "s", "samples": self.samples,
+                "stats": self.stats(), "error": self.error}
+
+
+class Benchmark(object):
+    """A set of timed measurements, see the module documentation"""
+    def __init__(self, suite, clock=time.perf_counter, **metadata):
+        self.suite = suite
+        self.clock = clock
+        self.metadata = {"host": platform.node(), "platform": platform.platform(),
+                         "python": platform.python_version(), "time": int(time.time())}
+        self.metadata.update(metadata)
+        self.results = {}  # (name, sorted params): BenchmarkResult
+
+    def result(self, name, **params):
+        """The BenchmarkResult for name and params, created if needed"""
+        key = (name, tuple(sorted(params.items())))
+        if key not in self.results:
+            self.results[key] = BenchmarkResult(name, params)
+        return self.results[key]
+
+    def measure(self, name, fn, warmup=1, repetitions=5, **params):
+        """Call fn warmup times, then time repetitions calls to it"""
+        r = self.result(name, **params)
+        for i in range(warmup):
+            fn()
+        for i in range(repetitions):
+            start = self.clock()
+            fn()
+            r.samples.append(self.clock() - start)
+        return r
+
+    @contextmanager
+    def timer(self, name, **params):
+        """Time the with block as one sample"""
+        r = self.result(name, **params)
+        start = self.clock()
+        yield r
+        r.samples.append(self.clock() - start)
+
+    def error(self, name, error, **params):
+        """Record that a measurement could not be taken"""
+        r = self.result(name, **params)
+        r.error = str(error)
+        return r
+
+    def as_dict(self):
+        return {"schema": SCHEMA["schema"], "version": SCHEMA["version"], "suite": self.suite,
+                "metadata": self.metadata, "results": [r.as_dict() for r in self.results.values()]}
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+    def write_csv(self, filename):
+        with open(filename, "w", newline="") as f:
+            writer = csv.DictWriter(f, CSV_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            for r in self.results.values():
+                row = r.stats()
+                row.update({"suite": self.suite, "name": r.name, "error": r.error,
+                            "params": json.dumps(r.params, sort_keys=True)})
+                writer.writerow(row)
+
+    @staticmethod
+    def load(filename):
+        """Read a Benchmark back from write_json() output"""
+        with open(filename) as f:
+            data = json.load(f)
+        if data.get("schema") != SCHEMA["schema"] or data.get("version") != SCHEMA["version"]:
+            raise ValueError("%s is not a version %d benchmark file" % (filename, SCHEMA["version"]))
+        bench = Benchmark(data["suite"])
+        bench.metadata = data["metadata"]
+        for d in data["results"]:
+            r = bench.result(d["name"], **d["params"])
+            r.samples = d["samples"]
+            r.error = d["error"]
+        return bench
+
+    def regressions(self, baseline, tolerance=REGRESSION_TOLERANCE):
+        """
+        (result, baseline median, median) for each measurement whose median is
+        more than tolerance slower than in the baseline Benchmark
+        """
+        slow = []
+        for key, r in sorted(self.results.items()):
+            base = baseline.results.get(key)
+            if base is None or not base.samples or not r.samples:
+                continue
+            old, new = base.stats()["median"], r.stats()["median"]
+            if new > old * (1 + tolerance):
+                slow.append((r, old, new))
+        return slow
+
+    def report(self, baseline=None):
+        """Print a table of the results, with the change from baseline if given"""
+        print("%-24s %-40s %10s %10s %10s %8s" % ("name", "params", "median ms", "p90 ms", "max ms", "change"))
+        for key, r in sorted(self.results.items()):
+            params = " ".join("%s=%s" % kv for kv in key[1])
+            if r.error is not None:
+                print("%-24s %-40s %s" % (r.name, params, r.error))
+                continue
+            s = r.stats()
+            if not s["count"]:
+                continue
+            change = ""
+            base = baseline.results.get(key) if baseline is not None else None
+            if base is not None and base.samples:
+                change = "%+7.1f%%" % ((s["median"] / base.stats()["median"] - 1) * 100)
+            print("%-24s %-40s %10.3f %10.3f %10.3f %8s" % (r.name, params, s["median"] * 1000, s["p90"] * 1000,
+                                                            s["max"] * 1000, change))
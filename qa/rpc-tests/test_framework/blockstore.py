@@ -6,135 +6,323 @@
 
 from .mininode import *
 from io import BytesIO
-import dbm.ndbm
+from .storage import open_storage
+from collections import OrderedDict
+import threading
+
+# Default size of the decoded object cache of a BlockStore or TxStore, in
+# serialized bytes
+DEFAULT_CACHE_BYTES = 64 << 20
+
+class ObjectCache(object):
+    """
+    Least recently used cache of decoded blocks or transactions, each with
+    its wire message (a msg_serialized), bounded by the total serialized
+    size of what it holds.  Objects bigger than the whole cache are not kept.
+    Safe to use from the test and the network threads at once.
+
+    >>> cache = ObjectCache(10)
+    >>> cache.put(1, "a", msg_serialized(b"tx", b"12345"))
+    >>> cache.put(2, "b", msg_serialized(b"tx", b"12345"))
+    >>> cache.get(1)[0]
+    'a'
+    >>> cache.put(3, "c", msg_serialized(b"tx", b"123"))  # evicts 2
+    >>> cache.get(2) is None, cache.size, cache.stats()
+    (True, 8, {'hits': 1, 'misses': 1, 'entries': 2, 'bytes': 8})
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # hash: (object, msg_serialized)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """(object, msg_serialized) for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, obj, message):
+        size = len(message.data)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1].data)
+            self.entries[key] = (obj, message)
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, (evicted, evicted_msg) = self.entries.popitem(last=False)
+                self.size -= len(evicted_msg.data)
+
+    def invalidate(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1].data)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
+
+def get_skip_height(height):
+    """Height of the ancestor a header at height keeps a skip pointer to (as in CBlockIndex::GetSkipHeight)"""
+    if height < 2:
+        return 0
+    # clear the lowest set bit, twice for odd heights, to jump further
+    if height & 1:
+        n = height - 1
+        n &= n - 1
+        return (n & (n - 1)) + 1
+    return height & (height - 1)
+
+class HeaderChain(object):
+    """
+    Index of every header seen, with its height (counted from the first
+    header whose parent is unknown), its parent and a skip pointer to a
+    much older ancestor, plus the list of hashes by height of the chain
+    ending at the current tip.  Ancestors of the tip are found by indexing
+    that list, ancestors of other headers by following skip pointers, in
+    O(log n) steps.
+    """
+    def __init__(self):
+        self.headers = {}  # hash: CBlockHeader
+        self.height = {}   # hash: height
+        self.skip = {}     # hash: hash of the ancestor at get_skip_height(height), or None
+        self.chain = []    # hashes of the current chain, by height
+        self.tip = None
+
+    def __contains__(self, blockhash):
+        return blockhash in self.headers
+
+    def add(self, header):
+        blockhash = header.sha256
+        if blockhash in self.headers:
+            self.headers[blockhash] = header
+            return
+        parent = header.hashPrevBlock
+        if parent in self.headers:
+            height = self.height[parent] + 1
+            self.skip[blockhash] = self.ancestor(parent, get_skip_height(height))
+        else:
+            height = 0
+            self.skip[blockhash] = None
+        self.headers[blockhash] = header
+        self.height[blockhash] = height
+
+    def on_chain(self, blockhash):
+        height = self.height.get(blockhash)
+        return height is not None and height < len(self.chain) and self.chain[height] == blockhash
+
+    def set_tip(self, blockhash):
+        """Make the chain end at blockhash, which must have been added"""
+        # walk back to the fork point; a header at height 0 starts a chain
+        branch = []
+        walk = blockhash
+        while walk is not None and not self.on_chain(walk):
+            branch.append(walk)
+            walk = self.parent(walk)
+        if walk is None:
+            self.chain = []
+        else:
+            del self.chain[self.height[walk] + 1:]
+        branch.reverse()
+        self.chain.extend(branch)
+        self.tip = blockhash
+
+    def parent(self, blockhash):
+        """Hash of the parent of blockhash if it is known, otherwise None"""
+        if self.height.get(blockhash, 0) == 0:
+            return None
+        return self.headers[blockhash].hashPrevBlock
+
+    def ancestor(self, blockhash, height):
+        """Hash of the ancestor of blockhash at height, None if there is none"""
+        h = self.height.get(blockhash)
+        if h is None or height > h or height < 0:
+            return None
+        if self.on_chain(blockhash):
+            return self.chain[height]
+        # as CBlockIndex::GetAncestor: take the skip pointer unless it jumps
+        # past height, or the parent's skip pointer would get closer to it
+        walk = blockhash
+        while h > height:
+            h_skip = get_skip_height(h)
+            h_skip_prev = get_skip_height(h - 1)
+            skip = self.skip[walk]
+            if skip is not None and (h_skip == height or
+                                     (h_skip > height and not (h_skip_prev < h_skip - 2 and h_skip_prev >= height))):
+                walk = skip
+                h = h_skip
+            else:
+                walk = self.headers[walk].hashPrevBlock
+                h -= 1
+            if self.on_chain(walk):
+                return self.chain[height]
+        return walk
+
+    def branch(self, blockhash, start_height, count):
+        """Headers of at most count ancestors of blockhash (counting itself), from start_height up"""
+        end = min(self.height[blockhash], start_height + count - 1)
+        if self.on_chain(blockhash):
+            return [self.headers[x] for x in self.chain[start_height:end + 1]]
+        result = []
+        walk = self.ancestor(blockhash, end)
+        for h in range(end, start_height - 1, -1):
+            result.append(self.headers[walk])
+            walk = self.headers[walk].hashPrevBlock
+        result.reverse()
+        return result
 
 class BlockStore(object):
-    def __init__(self, datadir):
-        self.blockDB = dbm.ndbm.open(datadir + "/blocks", 'c')
+    def __init__(self, datadir, cache_bytes=DEFAULT_CACHE_BYTES, backend=None):
+        self.blockDB = open_storage(backend, datadir + "/blocks")
         self.currentBlock = 0
-        self.headers_map = dict()
+        self.header_chain = HeaderChain()
+        self.cache = ObjectCache(cache_bytes)
     
     def close(self):
         self.blockDB.close()
 
+    # Blocks come out of the cache when they can.  The same CBlock is
+    # handed to every caller, so it must not be changed.
     def get(self, blockhash):
-        serialized_block = None
-        try:
-            serialized_block = self.blockDB[repr(blockhash)]
-        except KeyError:
+        entry = self.get_entry(blockhash)
+        return entry[0] if entry is not None else None
+
+    def has_block(self, blockhash):
+        return blockhash in self.blockDB
+
+    def get_entry(self, blockhash):
+        entry = self.cache.get(blockhash)
+        if entry is not None:
+            return entry
+        serialized_block = self.blockDB.get(blockhash)
+        if serialized_block is None:
             return None
-        f = BytesIO(serialized_block)
+        f = BufferReader(serialized_block)
         ret = CBlock()
         ret.deserialize(f)
         ret.calc_sha256()
-        return ret
+        message = msg_serialized(msg_block.command, serialized_block, ret)
+        self.cache.put(blockhash, ret, message)
+        return (ret, message)
 
     def get_header(self, blockhash):
-        try:
-            return self.headers_map[blockhash]
-        except KeyError:
-            return None
+        return self.header_chain.headers.get(blockhash)
 
-    # Note: this pulls full blocks out of the database just to retrieve
-    # the headers -- perhaps we could keep a separate data structure
-    # to avoid this overhead.
+    # Headers come from the header index, never from the blocks on disk.
+    # The response starts at the newest ancestor of the tip in the locator
+    # (or at the oldest known ancestor) and includes that header.
     def headers_for(self, locator, hash_stop, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
-        current_block_header = self.get_header(current_tip)
-        if current_block_header is None:
+        index = self.header_chain
+        if current_tip not in index:
             return None
 
-        response = msg_headers()
-        headersList = [ current_block_header ]
+        start = 0
+        for h in locator.vHave:
+            height = index.height.get(h)
+            if height is not None and height > start and index.ancestor(current_tip, height) == h:
+                start = height
         maxheaders = 2000
-        while (headersList[0].sha256 not in locator.vHave):
-            prevBlockHash = headersList[0].hashPrevBlock
-            prevBlockHeader = self.get_header(prevBlockHash)
-            if prevBlockHeader is not None:
-                headersList.insert(0, prevBlockHeader)
-            else:
+        headersList = index.branch(current_tip, start, maxheaders)
+        response = msg_headers()
+        response.headers = headersList
+        for i, header in enumerate(headersList):
+            if header.sha256 == hash_stop:
+                response.headers = headersList[:i+1]
                 break
-        headersList = headersList[:maxheaders] # truncate if we have too many
-        hashList = [x.sha256 for x in headersList]
-        index = len(headersList)
-        if (hash_stop in hashList):
-            index = hashList.index(hash_stop)+1
-        response.headers = headersList[:index]
         return response
 
     def add_block(self, block):
         block.calc_sha256()
-        try:
-            self.blockDB[repr(block.sha256)] = bytes(block.serialize())
-        except TypeError as e:
-            print("Unexpected error: ", sys.exc_info()[0], e.args)
+        self.cache.invalidate(block.sha256)
+        self.blockDB.put(block.sha256, block.serialize())
         self.currentBlock = block.sha256
-        self.headers_map[block.sha256] = CBlockHeader(block)
+        self.header_chain.add(CBlockHeader(block))
+        self.header_chain.set_tip(block.sha256)
 
     def add_header(self, header):
-        self.headers_map[header.sha256] = header
+        self.header_chain.add(header)
 
     def get_blocks(self, inv):
         responses = []
         for i in inv:
             if (i.type == 2): # MSG_BLOCK
-                block = self.get(i.hash)
-                if block is not None:
-                    responses.append(msg_block(block))
+                entry = self.get_entry(i.hash)
+                if entry is not None:
+                    responses.append(entry[1])
         return responses
 
+    # The parent of the tip, then its ancestors at exponentially growing
+    # distances, ending with the parent of the oldest known ancestor.
     def get_locator(self, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
+        index = self.header_chain
         r = []
-        counter = 0
-        step = 1
-        lastBlock = self.get(current_tip)
-        while lastBlock is not None:
-            r.append(lastBlock.hashPrevBlock)
-            for i in range(step):
-                lastBlock = self.get(lastBlock.hashPrevBlock)
-                if lastBlock is None:
+        if current_tip in index:
+            height = index.height[current_tip]
+            step = 1
+            while height >= 0:
+                blockhash = index.ancestor(current_tip, height)
+                r.append(index.headers[blockhash].hashPrevBlock)
+                if height == 0:
                     break
-            counter += 1
-            if counter > 10:
-                step *= 2
+                height = max(height - step, 0)
+                if len(r) > 10:
+                    step *= 2
         locator = CBlockLocator()
         locator.vHave = r
         return locator
 
 class TxStore(object):
-    def __init__(self, datadir):
-        self.txDB = dbm.ndbm.open(datadir + "/transactions", 'c')
+    def __init__(self, datadir, cache_bytes=DEFAULT_CACHE_BYTES, backend=None):
+        self.txDB = open_storage(backend, datadir + "/transactions")
+        self.cache = ObjectCache(cache_bytes)
 
     def close(self):
         self.txDB.close()
 
+    # As BlockStore.get, the transaction may be shared and must not be changed
     def get(self, txhash):
-        serialized_tx = None
-        try:
-            serialized_tx = self.txDB[repr(txhash)]
-        except KeyError:
+        entry = self.get_entry(txhash)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, txhash):
+        entry = self.cache.get(txhash)
+        if entry is not None:
+            return entry
+        serialized_tx = self.txDB.get(txhash)
+        if serialized_tx is None:
             return None
-        f = BytesIO(serialized_tx)
+        f = BufferReader(serialized_tx)
         ret = CTransaction()
         ret.deserialize(f)
         ret.calc_sha256()
-        return ret
+        message = msg_serialized(msg_tx.command, serialized_tx, ret)
+        self.cache.put(txhash, ret, message)
+        return (ret, message)
 
     def add_transaction(self, tx):
         tx.calc_sha256()
-        try:
-            self.txDB[repr(tx.sha256)] = bytes(tx.serialize())
-        except TypeError as e:
-            print("Unexpected error: ", sys.exc_info()[0], e.args)
+        self.cache.invalidate(tx.sha256)
+        self.txDB.put(tx.sha256, tx.serialize())
 
     def get_transactions(self, inv):
         responses = []
         for i in inv:
             if (i.type == 1): # MSG_TX
-                tx = self.get(i.hash)
-                if tx is not None:
-                    responses.append(msg_tx(tx))
+                entry = self.get_entry(i.hash)
+                if entry is not None:
+                    responses.append(entry[1])
         return responses
@@ -1,4 +1,5 @@
 from .nodemessages import *
+from .nodemessages import _U8, _U16, _U32, _U64
 
 
 class msg_buversion(object):
@@ -9,13 +10,15 @@ class msg_buversion(object):
         pass
 
     def deserialize(self, f):
-        self.addrFromPort = struct.unpack("<H", f.read(2))[0]
+        self.addrFromPort = read_struct(f, _U16)[0]
         return self
 
+    def serialize_into(self, buf):
+        buf += _U16.pack(self.addrFromPort)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<H", self.addrFromPort)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_buversion(addrFromPort=%d)" % (self.addrFromPort)
@@ -30,9 +33,11 @@ class msg_buverack(object):
     def deserialize(self, f):
         return self
 
+    def serialize_into(self, buf):
+        return buf
+
     def serialize(self):
-        r = b""
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_buverack()"
@@ -45,13 +50,15 @@ class QHash(object):
         self.hash = shortHash
 
     def deserialize(self, f):
-        self.hash = struct.unpack("<Q", f.read(8))[0]
+        self.hash = read_struct(f, _U64)[0]
         return self
 
+    def serialize_into(self, buf):
+        buf += _U64.pack(self.hash)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.hash)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "QHash(0x%016x)" % (self.hash)
@@ -67,10 +74,12 @@ class Hash(object):
         self.hash = deser_uint256(f)
         return self
 
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.hash)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __str__(self):
         return "%064x" % self.hash
@@ -91,12 +100,14 @@ class CXThinBlock(CBlockHeader):
         self.vMissingTx = deser_vector(f, CTransaction)
         return self
 
+    def serialize_into(self, buf):
+        super(CXThinBlock, self).serialize_into(buf)
+        ser_vector_into(buf, self.vTxHashes)
+        ser_vector_into(buf, self.vMissingTx)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += super(CXThinBlock, self).serialize()
-        r += ser_vector(self.vTxHashes)
-        r += ser_vector(self.vMissingTx)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def summary(self):
         s = []
@@ -144,12 +155,14 @@ class CThinBlock(CBlockHeader):
         self.vMissingTx = deser_vector(f, CTransaction)
         return self
 
+    def serialize_into(self, buf):
+        super(self.__class__, self).serialize_into(buf)
+        ser_vector_into(buf, self.vTxHashes)
+        ser_vector_into(buf, self.vMissingTx)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += super(self.__class__, self).serialize()
-        r += ser_vector(self.vTxHashes)
-        r += ser_vector(self.vMissingTx)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __str__(self):
         return "CThinBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vTxHashes_len=%d vMissingTx_len=%d)" \
@@ -176,18 +189,20 @@ class CBloomFilter:
 
     def deserialize(self, f):
         self.vData = deser_string(f)
-        self.nHashFuncs = struct.unpack("<I", f.read(4))[0]
-        self.nTweak = struct.unpack("<I", f.read(4))[0]
-        self.nFlags = struct.unpack("<B", f.read(1))[0]
+        self.nHashFuncs = read_struct(f, _U32)[0]
+        self.nTweak = read_struct(f, _U32)[0]
+        self.nFlags = read_struct(f, _U8)[0]
         return self
 
+    def serialize_into(self, buf):
+        buf += ser_string(self.vData)
+        buf += _U32.pack(self.nHashFuncs)
+        buf += _U32.pack(self.nTweak)
+        buf += _U8.pack(self.nFlags)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += ser_string(f, self.vData)
-        r += struct.pack("<I", self.nHashFuncs)
-        r += struct.pack("<I", self.nTweak)
-        r += struct.pack("<B", self.nFlags)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "%s(vData=%s)" % (self.__class__.__name__, self.vData)
@@ -206,8 +221,11 @@ class msg_thinblock(object):
         self.block.deserialize(f)
         return self
 
+    def serialize_into(self, buf):
+        return self.block.serialize_into(buf)
+
     def serialize(self):
-        return self.block.serialize()
+        return bytes(self.serialize_into(bytearray()))
 
     def __str__(self):
         return "msg_thinblock(block=%s)" % (str(self.block))
@@ -229,8 +247,11 @@ class msg_xthinblock(object):
         self.block.deserialize(f)
         return self
 
+    def serialize_into(self, buf):
+        return self.block.serialize_into(buf)
+
     def serialize(self):
-        return self.block.serialize()
+        return bytes(self.serialize_into(bytearray()))
 
     def __str__(self):
         return "msg_xthinblock(block=%s)" % (str(self.block))
@@ -251,8 +272,8 @@ class msg_Xb(object):
         self.block = block
 
     def deserialize(self, f):
-        self.msgType = struct.unpack("<B", f.read(1))[0]
-        self.hops = struct.unpack("<B", f.read(1))[0]
+        self.msgType = read_struct(f, _U8)[0]
+        self.hops = read_struct(f, _U8)[0]
         if self.msgType == EXPEDITED_MSG_XTHIN:
             self.block = CXThinBlock()
             self.block.deserialize(f)
@@ -260,13 +281,15 @@ class msg_Xb(object):
             self.block = None
         return self
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.msgType)
-        r += struct.pack("<B", self.hops)
+    def serialize_into(self, buf):
+        buf += _U8.pack(self.msgType)
+        buf += _U8.pack(self.hops)
         if self.msgType == EXPEDITED_MSG_XTHIN:
-            r += self.block.serialize()
-        return r
+            self.block.serialize_into(buf)
+        return buf
+
+    def serialize(self):
+        return bytes(self.serialize_into(bytearray()))
 
     def __str__(self):
         return "msg_Xb(block=%s)" % (str(self.block))
@@ -289,11 +312,13 @@ class msg_get_xthin(object):
         self.filter.deserialize(f)
         return self
 
+    def serialize_into(self, buf):
+        self.inv.serialize_into(buf)
+        self.filter.serialize_into(buf)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += self.inv.serialize()
-        r += self.filter.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "%s(inv=%s,filter=%s)" % (self.__class__.__name__, repr(self.inv), repr(self.filter))
@@ -310,10 +335,12 @@ class msg_filterload(object):
         self.filter.deserialize(f)
         return self
 
+    def serialize_into(self, buf):
+        self.filter.serialize_into(buf)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += self.filter.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "%s(filter=%s)" % (self.__class__.__name__, repr(self.filter))
@@ -329,10 +356,12 @@ class msg_filteradd(object):
         self.filter = deser_string(f)
         return self
 
+    def serialize_into(self, buf):
+        buf += ser_string(self.filter)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += ser_string(f, self.filter)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "%s(filteradd=%s)" % (self.__class__.__name__, repr(self.filter))
@@ -347,9 +376,11 @@ class msg_filterclear(object):
     def deserialize(self, f):
         return self
 
+    def serialize_into(self, buf):
+        return buf
+
     def serialize(self):
-        r = b""
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_filterclear()"
@@ -367,11 +398,13 @@ class msg_get_xblocktx(object):
         self.setCheapHashesToRequest = deser_vector(f, QHash)
         return self
 
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.blockhash)
+        ser_vector_into(buf, self.setCheapHashesToRequest)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_vector(self.setCheapHashesToRequest)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "%s(blockhash=%s,qhash=%s)" % (self.__class__.__name__, repr(self.blockhash), repr(self.setCheapHashesToRequest))
@@ -388,13 +421,15 @@ class msg_req_xpedited(object):
         self.options = options
 
     def deserialize(self, f):
-        self.options = struct.unpack("<Q", f.read(8))[0]
+        self.options = read_struct(f, _U64)[0]
         return self
 
+    def serialize_into(self, buf):
+        buf += _U64.pack(self.options)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.options)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "%s(0x%x)" % (self.__class__.__name__, self.options)
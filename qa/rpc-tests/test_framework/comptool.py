@@ -25,6 +25,10 @@ generator that returns TestInstance objects.  See below for definition.
 
 global mininode_lock
 
+# Most blocks TestManager keeps in flight when pipelining; a node asks a peer
+# for at most MAX_BLOCKS_IN_TRANSIT_PER_PEER (16) blocks at once
+MAX_PIPELINE = 16
+
 class RejectResult(object):
     '''
     Outcome that expects rejection of a transaction or block.
@@ -159,13 +163,46 @@ class TestInstance(object):
 
 class TestManager(object):
 
-    def __init__(self, testgen, datadir):
+    # backend: the storage.BACKENDS name of where to keep the blocks and
+    # transactions.  If None, the --storage option of the test (testgen is
+    # usually a ComparisonTestFramework) decides, or storage.DEFAULT_BACKEND.
+    # pipeline: how many blocks may be in flight at once (see run()); if None
+    # the --pipeline option decides, by default 1, one block at a time.  Only
+    # generators that set pipeline_test_blocks are pipelined: get_tests()
+    # runs on while earlier blocks are still in flight, so a generator that
+    # looks at or acts on the nodes between yields must not be.
+    # vector_cache: directory of recorded test vectors (see testvectors.py),
+    # used only if testgen sets cache_test_vectors; if None the
+    # --vector-cache option decides, and "" turns the cache off.
+    def __init__(self, testgen, datadir, backend=None, pipeline=None, vector_cache=None):
+        options = getattr(testgen, "options", None)
+        if backend is None:
+            backend = getattr(options, "storage", None)
+        if pipeline is None:
+            pipeline = getattr(options, "pipeline", None) or 1
+        if vector_cache is None:
+            vector_cache = getattr(options, "vector_cache", None)
         self.test_generator = testgen
+        self.vector_cache   = None
+        if vector_cache and getattr(testgen, "cache_test_vectors", False):
+            from .testvectors import TestVectorCache  # it imports this module
+            self.vector_cache = TestVectorCache(vector_cache, getattr(options, "vector_seed", 0) or 0)
         self.connections    = []
         self.test_nodes     = []
-        self.block_store    = BlockStore(datadir)
-        self.tx_store       = TxStore(datadir)
+        self.block_store    = BlockStore(datadir, backend=backend)
+        self.tx_store       = TxStore(datadir, backend=backend)
         self.ping_counter   = 1
+        if not getattr(testgen, "pipeline_test_blocks", False):
+            pipeline = 1
+        self.pipeline       = min(max(1, pipeline), MAX_PIPELINE)
+        # The block that every node was last seen to have as its tip, as the
+        # test expected, or None if that is not known
+        self.confirmed_tip  = None
+
+    def test_instances(self):
+        if self.vector_cache is not None:
+            return self.vector_cache.test_instances(self.test_generator)
+        return self.test_generator.get_tests()
 
     def add_all_connections(self, nodes):
         for i in range(len(nodes)):
@@ -317,12 +354,106 @@ class TestManager(object):
                     return False
             return True
 
+    def store_block(self, block):
+        # Add to shared block_store, set as current block
+        # If there was an open getdata request for the block
+        # previously, and we didn't have an entry in the
+        # block_store, then immediately deliver, because the
+        # node wouldn't send another getdata request while
+        # the earlier one is outstanding.
+        first_block_with_hash = True
+        if self.block_store.has_block(block.sha256):
+            first_block_with_hash = False
+        with mininode_lock:
+            self.block_store.add_block(block)
+            for c in self.connections:
+                if first_block_with_hash and block.sha256 in c.cb.block_request_map and c.cb.block_request_map[block.sha256] == True:
+                    # There was a previous request for this block hash
+                    # Most likely, we delivered a header for this block
+                    # but never had the block to respond to the getdata
+                    c.send_message(msg_block(block))
+                else:
+                    c.cb.block_request_map[block.sha256] = False
+
+    # Pipelining: a test instance whose blocks every node must accept, each
+    # becoming the new tip, is sent without waiting for the outcome as long
+    # as the first block builds on the tip every node was last seen to have
+    # and every further block on the one before it.  Once the last such block
+    # is the tip of every node, all of them must have been the tip in turn,
+    # so checking that block (and that none was rejected) gives the same
+    # answer as checking each one.  Anything else first waits for the
+    # blocks in flight and then runs one object at a time as before.
+    def can_pipeline(self, test_instance, in_flight):
+        if self.pipeline <= 1 or not test_instance.sync_every_block or not test_instance.blocks_and_transactions:
+            return False
+        prev = in_flight[-1][0] if in_flight else self.confirmed_tip
+        for test_obj in test_instance.blocks_and_transactions:
+            b = test_obj[0]
+            if not isinstance(b, CBlock) or test_obj[1] is not True:
+                return False
+            if len(test_obj) >= 3 and test_obj[2] != b.sha256:
+                return False
+            if prev is None or b.hashPrevBlock != prev:
+                return False
+            prev = b.sha256
+        return True
+
+    # Wait for the pipelined blocks and check their outcomes in order
+    def check_pipeline(self, in_flight):
+        if not in_flight:
+            return
+        def blocks_requested():
+            return all(node.block_request_map.get(h) for node in self.test_nodes for h, n in in_flight)
+        wait_until(blocks_requested, attempts=20*len(in_flight))
+        last_hash, last_test = in_flight[-1]
+        with mininode_lock:
+            for blockhash, test_number in in_flight:
+                for c in self.connections:
+                    if not c.cb.block_request_map.get(blockhash):
+                        raise AssertionError("Not all nodes requested block %064x (test %d)" % (blockhash, test_number))
+                    if blockhash in c.cb.block_reject_map:
+                        print("Node ", c.addr, " rejected block %064x with %s" % (blockhash, c.cb.block_reject_map[blockhash]))
+                        raise AssertionError("Test failed at test %d" % test_number)
+        self.sync_blocks(last_hash, len(in_flight))
+        if not self.check_results(last_hash, True):
+            # report the first block that did not make it into the chain of every node
+            chain = self.block_store.header_chain
+            failed = last_test
+            with mininode_lock:
+                for c in self.connections:
+                    best = c.cb.bestblockhash
+                    for blockhash, test_number in in_flight:
+                        if best not in chain or chain.ancestor(best, chain.height[blockhash]) != blockhash:
+                            failed = min(failed, test_number)
+                            break
+            raise AssertionError("Test failed at test %d" % failed)
+        for blockhash, test_number in in_flight[:-1]:
+            print("Test %d: PASS (pipelined)" % test_number)
+        print("Test %d: PASS" % last_test, [ c.rpc.getblockcount() for c in self.connections ])
+        self.confirmed_tip = last_hash
+        del in_flight[:]
+
+    # With a pipeline, blocks that are expected to extend the tip are sent
+    # up to TestManager.pipeline at a time (see can_pipeline)
     def run(self):
         # Wait until verack is received
         self.wait_for_verack()
 
         test_number = 1
-        for test_instance in self.test_generator.get_tests():
+        in_flight = []  # (block hash, test number) of pipelined blocks not yet checked
+        for test_instance in self.test_instances():
+            if self.can_pipeline(test_instance, in_flight):
+                for test_obj in test_instance.blocks_and_transactions:
+                    block = test_obj[0]
+                    self.store_block(block)
+                    [ c.cb.send_inv(block) for c in self.connections ]
+                    in_flight.append((block.sha256, test_number))
+                if len(in_flight) >= self.pipeline:
+                    self.check_pipeline(in_flight)
+                test_number += 1
+                continue
+            self.check_pipeline(in_flight)
+
             # We use these variables to keep track of the last block
             # and last transaction in the tests, which are used
             # if we're not syncing on every block or every tx.
@@ -344,25 +475,7 @@ class TestManager(object):
                     if len(test_obj) >= 3:
                         tip = test_obj[2]
 
-                    # Add to shared block_store, set as current block
-                    # If there was an open getdata request for the block
-                    # previously, and we didn't have an entry in the
-                    # block_store, then immediately deliver, because the
-                    # node wouldn't send another getdata request while
-                    # the earlier one is outstanding.
-                    first_block_with_hash = True
-                    if self.block_store.get(block.sha256) is not None:
-                        first_block_with_hash = False
-                    with mininode_lock:
-                        self.block_store.add_block(block)
-                        for c in self.connections:
-                            if first_block_with_hash and block.sha256 in c.cb.block_request_map and c.cb.block_request_map[block.sha256] == True:
-                                # There was a previous request for this block hash
-                                # Most likely, we delivered a header for this block
-                                # but never had the block to respond to the getdata
-                                c.send_message(msg_block(block))
-                            else:
-                                c.cb.block_request_map[block.sha256] = False
+                    self.store_block(block)
                     # Either send inv's to each node and sync, or add
                     # to invqueue for later inv'ing.
                     if (test_instance.sync_every_block):
@@ -370,6 +483,7 @@ class TestManager(object):
                         self.sync_blocks(block.sha256, 1)
                         if (not self.check_results(tip, outcome)):
                             raise AssertionError("Test failed at test %d" % test_number)
+                        self.confirmed_tip = tip if outcome is True else None
                     else:
                         invqueue.append(CInv(2, block.sha256))
                 elif isinstance(b_or_t, CBlockHeader):
@@ -405,6 +519,7 @@ class TestManager(object):
                 self.sync_blocks(block.sha256, len(test_instance.blocks_and_transactions))
                 if (not self.check_results(tip, block_outcome)):
                     raise AssertionError("Block test failed at test %d" % test_number)
+                self.confirmed_tip = tip if block_outcome is True else None
             if (not test_instance.sync_every_tx and tx is not None):
                 if len(invqueue) > 0:
                     [ c.send_message(msg_inv(invqueue)) for c in self.connections ]
@@ -416,6 +531,8 @@ class TestManager(object):
             print("Test %d: PASS" % test_number, [ c.rpc.getblockcount() for c in self.connections ])
             test_number += 1
 
+        self.check_pipeline(in_flight)
+        print("Block cache:", self.block_store.cache.stats(), "transaction cache:", self.tx_store.cache.stats())
         [ c.disconnect_node() for c in self.connections ]
         self.wait_for_disconnections()
         self.block_store.close()
@@ -47,18 +47,40 @@ class AuthServiceProxyWrapper(object):
 
         """
         return_val = self.auth_service_proxy_instance.__call__(*args, **kwargs)
-        rpc_method = self.auth_service_proxy_instance._service_name
+        self._record(self.auth_service_proxy_instance._service_name)
 
+        return return_val
+
+    def batch(self, *args, **kwargs):
+        """
+        Delegates to AuthServiceProxy.batch(), recording each RPC method
+        once its batch has been sent.
+
+        """
+        kwargs['observer'] = self._record
+        return self.auth_service_proxy_instance.batch(*args, **kwargs)
+
+    def stream(self, *args):
+        """
+        Delegates to AuthServiceProxy.stream(), recording the RPC method.
+
+        """
+        self._record(self.auth_service_proxy_instance._service_name)
+        return self.auth_service_proxy_instance.stream(*args)
+
+    def _record(self, rpc_method):
         if self.coverage_logfile:
             with open(self.coverage_logfile, 'a+') as f:
                 f.write("%s\n" % rpc_method)
 
-        return return_val
-
     @property
     def url(self):
         return self.auth_service_proxy_instance.url
 
+    @property
+    def timeout(self):
+        return self.auth_service_proxy_instance.timeout
+
 
 def get_filename(dirname, n_node):
     """
@@ -85,6 +85,23 @@ def _check_result(val, func, args):
 ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
 ssl.EC_KEY_new_by_curve_name.errcheck = _check_result
 
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+
+def low_s_signature(der_sig):
+    """Replace s with n - s in a DER signature if s is in the upper half of
+    the order, as the node's standardness rules (SCRIPT_VERIFY_LOW_S) demand"""
+    r_size = der_sig[3]
+    s_size = der_sig[5 + r_size]
+    s = int.from_bytes(der_sig[6 + r_size:6 + r_size + s_size], 'big')
+    if s <= SECP256K1_ORDER_HALF:
+        return der_sig
+    s = SECP256K1_ORDER - s
+    s_bytes = s.to_bytes((s.bit_length() + 8) // 8, 'big')  # room for a 0 sign byte
+    r_part = der_sig[2:4 + r_size]
+    body = r_part + bytes([0x02, len(s_bytes)]) + s_bytes
+    return bytes([0x30, len(body)]) + body
+
 class CECKey(object):
     """Wrapper around OpenSSL's EC_KEY"""
 
@@ -147,7 +164,7 @@ class CECKey(object):
         r = self.get_raw_ecdh_key(other_pubkey)
         return kdf(r)
 
-    def sign(self, hash):
+    def sign(self, hash, low_s=False):
         # FIXME: need unit tests for below cases
         if not isinstance(hash, bytes):
             raise TypeError('Hash must be bytes instance; got %r' % hash.__class__)
@@ -159,7 +176,10 @@ class CECKey(object):
         mb_sig = ctypes.create_string_buffer(sig_size0.value)
         result = ssl.ECDSA_sign(0, hash, len(hash), mb_sig, ctypes.byref(sig_size0), self.k)
         assert 1 == result
-        return mb_sig.raw[:sig_size0.value]
+        der_sig = mb_sig.raw[:sig_size0.value]
+        if low_s:
+            der_sig = low_s_signature(der_sig)
+        return der_sig
 
     def verify(self, hash, sig):
         """Verify a DER signature"""
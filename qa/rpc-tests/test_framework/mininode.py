@@ -12,6 +12,7 @@
 # found in the mini-node branch of http://github.com/jgarzik/pynode.
 #
 # NodeConn: an object which manages p2p connectivity to a bitcoin node
+# NetworkThread: runs the asyncio event loop that drives all NodeConns
 # NodeConnCB: a base class that describes the interface for receiving
 #             callbacks with network messages from a NodeConn
 # CBlock, CTransaction, CBlockHeader, CTxIn, CTxOut, etc....:
@@ -24,7 +25,11 @@
 import pdb
 import struct
 import socket
-import asyncore
+import asyncio
+try:
+    import asyncore  # removed in python 3.12
+except ImportError:
+    asyncore = None
 import time
 import sys
 import random
@@ -33,7 +38,7 @@ from io import BytesIO
 from codecs import encode
 import hashlib
 from threading import RLock
-from threading import Thread
+from threading import Thread, current_thread
 import logging
 import copy
 
@@ -46,50 +51,68 @@ MAX_INV_SZ = 50000
 MAX_BLOCK_SIZE = 1000000
 
 
-# Keep our own socket map for asyncore, so that we can track disconnects
+# Keep our own socket map for asyncore (AsyncoreNodeConn), so that we can track disconnects
 # ourselves (to workaround an issue with closing an asyncore socket when
 # using select)
 mininode_socket_map = dict()
 
+# Message header: magic, command, payload length and (from protocol version 209
+# on) the payload checksum
+_MSGHEADER = struct.Struct("<4s12si4s")
+_MSGHEADER_NOCHECKSUM = struct.Struct("<4s12si")
+
 # This is what a callback should look like for NodeConn
 # Reimplement the on_* functions to provide handling for events
 class NodeConnCB(object):
-    def __init__(self):
+    def __init__(self, lock=None):
         self.verack_received = False
         # deliver_sleep_time is helpful for debugging race conditions in p2p
         # tests; it causes message delivery to sleep for the specified time
-        # before acquiring the global lock and delivering the next message.
+        # before acquiring the lock and delivering the next message.
         self.deliver_sleep_time = None
+        # lock is held while the on_* handlers run, and by the test thread
+        # while it reads what they recorded.  By default it is the global
+        # mininode_lock, which keeps tests that take mininode_lock themselves
+        # correct.  A callback that is only accessed through its own lock
+        # (e.g. NodeConnCB(threading.RLock()), read under cb.lock and waited
+        # on with cb.wait_until()) no longer contends with other connections.
+        if lock is None or lock is mininode_lock:
+            self.lock = mininode_lock
+            self.cond = mininode_cond
+        else:
+            self.lock = lock
+            self.cond = Condition(lock)
 
     def set_deliver_sleep_time(self, value):
-        with mininode_lock:
+        with self.lock:
             self.deliver_sleep_time = value
 
     def get_deliver_sleep_time(self):
-        with mininode_lock:
+        with self.lock:
             return self.deliver_sleep_time
 
-    # Spin until verack message is received from the node.
+    def wait_until(self, predicate, attempts=float('inf'), timeout=float('inf')):
+        """wait_until() for predicates over this callback's state"""
+        return wait_until(predicate, attempts, timeout, self.cond)
+
+    # Wait until verack message is received from the node.
     # Tests may want to use this as a signal that the test can begin.
     # This can be called from the testing thread, so it needs to acquire the
-    # global lock.
+    # lock.
     def wait_for_verack(self):
-        while True:
-            with mininode_lock:
-                if self.verack_received:
-                    return
-            time.sleep(0.05)
+        self.wait_until(lambda: self.verack_received)
 
     def deliver(self, conn, message):
         deliver_sleep = self.get_deliver_sleep_time()
         if deliver_sleep is not None:
             time.sleep(deliver_sleep)
-        with mininode_lock:
+        with self.lock:
             fn = 'on_' + message.command.decode('ascii')
             try:
                 getattr(self, fn)(conn, message)
             except:
                 print("ERROR delivering %s (%s) to %s" % (repr(message), sys.exc_info()[0], fn))
+            self.cond.notify_all()
 
     def on_version(self, conn, message):
         if message.nVersion >= 209:
@@ -144,8 +167,8 @@ class NodeConnCB(object):
 
 
 class SingleNodeConnCB(NodeConnCB):
-    def __init__(self):
-        NodeConnCB.__init__(self)
+    def __init__(self, lock=None):
+        NodeConnCB.__init__(self, lock)
         self.connection = None
         self.ping_counter = 1
         self.last_pong = msg_pong()
@@ -165,7 +188,7 @@ class SingleNodeConnCB(NodeConnCB):
         def received_pong():
             return (self.last_pong.nonce == self.ping_counter)
         self.send_message(msg_ping(nonce=self.ping_counter))
-        success = wait_until(received_pong, timeout)
+        success = self.wait_until(received_pong, timeout=timeout)
         self.ping_counter += 1
         return success
 
@@ -185,11 +208,13 @@ class MsgAnnotater:
         self.idx += 1
         return msg
 
-# The actual NodeConn class
-# This class provides an interface for a p2p connection to a specified node
+# NodeConnBase holds everything about a p2p connection that does not depend on
+# how the bytes are moved: the message framing, parsing and the dispatch to the
+# NodeConnCB.  NodeConn moves them with asyncio, AsyncoreNodeConn (the original
+# implementation, only where asyncore still exists) with asyncore.
 
 
-class NodeConn(asyncore.dispatcher):
+class NodeConnBase(object):
     messagemap = dupdate({
         b"version": msg_version,
         b"verack": msg_verack,
@@ -217,13 +242,15 @@ class NodeConn(asyncore.dispatcher):
     }
 
     def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=1):
-        asyncore.dispatcher.__init__(self, map=mininode_socket_map)
         self.log = logging.getLogger("NodeConn(%s:%d)" % (dstaddr, dstport))
         self.dstaddr = dstaddr
         self.dstport = dstport
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        # guards sendbuf and the transport, which the test thread and the
+        # network thread both use
+        self.sendlock = RLock()
         self.sendbuf = b""
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self.recvoff = 0
         self.ver_send = 209
         self.ver_recv = 209
         self.last_sent = 0
@@ -232,6 +259,7 @@ class NodeConn(asyncore.dispatcher):
         self.cb = callback
         self.disconnect = False
         self.curIndex = 0
+        self.rpc = rpc
         # stuff version msg into sendbuf
         vt = msg_version()
         vt.nServices = services
@@ -242,31 +270,10 @@ class NodeConn(asyncore.dispatcher):
         self.send_message(vt, True)
         print('MiniNode: Connecting to Bitcoin Node IP # ' + dstaddr + ':'
               + str(dstport))
-        try:
-            self.connect((dstaddr, dstport))
-        except:
-            self.handle_close()
-        self.rpc = rpc
 
     def show_debug_msg(self, msg):
         self.log.debug(msg)
 
-    def handle_connect(self):
-        self.show_debug_msg("MiniNode: Connected & Listening: \n")
-        self.state = "connected"
-
-    def handle_close(self):
-        self.show_debug_msg("MiniNode: Closing Connection to %s:%d... "
-                            % (self.dstaddr, self.dstport))
-        self.state = "closed"
-        self.recvbuf = b""
-        self.sendbuf = b""
-        try:
-            self.close()
-        except:
-            pass
-        self.cb.on_close(self)
-
     def parse_messages(self, buffer):
         if not type(buffer) == type(b""):  # if not a buffer its a file
             buffer = buffer.read()
@@ -282,87 +289,77 @@ class NodeConn(asyncore.dispatcher):
         self.recvbuf += buffer
         self.got_data()
 
-    def handle_read(self):
-        try:
-            t = self.recv(8192)
-            if len(t) > 0:
-                self.recvbuf += t
-                self.got_data()
-        except:
-            pass
-
-    def readable(self):
-        return True
-
-    def writable(self):
-        with mininode_lock:
-            length = len(self.sendbuf)
-        return (length > 0)
-
-    def handle_write(self):
-        with mininode_lock:
-            try:
-                sent = self.send(self.sendbuf)
-            except:
-                self.handle_close()
-                return
-            self.sendbuf = self.sendbuf[sent:]
-
     def got_data(self):
-        self.recvBufLen = len(self.recvbuf)
+        # recvbuf is only ever appended to; recvoff marks how much of it has
+        # been parsed.  The parsed prefix is dropped once it is at least half
+        # of the buffer (see compact_recvbuf), rather than copying the rest of
+        # the buffer after every message or every read.
+        buf = self.recvbuf
+        magic = self.MAGIC_BYTES[self.network]
+        if self.ver_recv < 209:
+            hdr = _MSGHEADER_NOCHECKSUM
+        else:
+            hdr = _MSGHEADER
         try:
             while True:
-                nowLen = len(self.recvbuf)
-                self.curIndex += (self.recvBufLen - nowLen)
-                self.recvBufLen = nowLen
-                if nowLen < 4:
+                off = self.recvoff
+                if len(buf) - off < 4:
+                    return
+                if not buf.startswith(magic, off):
+                    raise ValueError("got garbage %s" % repr(bytes(buf[off:])))
+                if len(buf) - off < hdr.size:
+                    return
+                fields = hdr.unpack_from(buf, off)
+                command = fields[1].split(b"\x00", 1)[0]
+                msglen = fields[2]
+                end = off + hdr.size + msglen
+                if len(buf) < end:
                     return
-                if self.recvbuf[:4] != self.MAGIC_BYTES[self.network]:
-                    raise ValueError("got garbage %s" % repr(self.recvbuf))
-                if self.ver_recv < 209:
-                    if len(self.recvbuf) < 4 + 12 + 4:
-                        return
-                    command = self.recvbuf[4:4 + 12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4 + 12:4 + 12 + 4])[0]
-                    checksum = None
-                    if len(self.recvbuf) < 4 + 12 + 4 + msglen:
-                        return
-                    msg = self.recvbuf[4 + 12 + 4:4 + 12 + 4 + msglen]
-                    self.recvbuf = self.recvbuf[4 + 12 + 4 + msglen:]
-                else:
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                        return
-                    command = self.recvbuf[4:4 + 12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4 + 12:4 + 12 + 4])[0]
-                    checksum = self.recvbuf[4 + 12 + 4:4 + 12 + 4 + 4]
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                        return
-                    msg = self.recvbuf[4 + 12 + 4 + 4:4 + 12 + 4 + 4 + msglen]
-                    th = sha256(msg)
-                    h = sha256(th)
-                    if checksum != h[:4]:
-                        raise ValueError("got bad checksum " + repr(self.recvbuf))
-                    self.recvbuf = self.recvbuf[4 + 12 + 4 + 4 + msglen:]
-                if command in self.messagemap:
-                    f = BytesIO(msg)
-                    t = self.messagemap[command]()
-                    t.deserialize(f)
+                # the payload is checksummed and decoded in place
+                with memoryview(buf)[off + hdr.size:end] as msg:
+                    if hdr is _MSGHEADER and hash256(msg)[:4] != fields[3]:
+                        raise ValueError("got bad checksum " + repr(bytes(buf[off:])))
+                    self.recvoff = end
+                    if command in self.messagemap:
+                        t = self.messagemap[command]()
+                        f = BufferReader(msg)
+                        try:
+                            t.deserialize(f)
+                        finally:
+                            f.view.release()
+                    else:
+                        t = None
+                        print("Unknown command: '" + str(command) + "' ")
+                        self.show_debug_msg("Unknown command: '" + str(command) + "' " +
+                                            repr(msg.tobytes()))
+                if t is not None:
                     self.got_message(t)
-                else:
-                    print("Unknown command: '" + str(command) + "' ")
-                    self.show_debug_msg("Unknown command: '" + str(command) + "' " +
-                                        repr(msg))
-                    # pdb.set_trace()
+                self.curIndex += end - off
+                if self.recvbuf is not buf:
+                    return  # the connection was closed while delivering
         except Exception as e:
             print('got_data:', repr(e))
             #import traceback
             #traceback.print_tb(sys.exc_info()[2])
             #pdb.post_mortem(e.__traceback__)
-
-    def send_message(self, message, pushbuf=False):
-        if self.state != "connected" and not pushbuf:
+        finally:
+            if self.recvbuf is buf:
+                self.compact_recvbuf()
+
+    def compact_recvbuf(self):
+        off = self.recvoff
+        # A large message arrives in many reads; moving the part received so
+        # far after each of them would copy it over and over
+        if not off or off * 2 < len(self.recvbuf):
             return
-        self.show_debug_msg("Send %s" % repr(message))
+        try:
+            del self.recvbuf[:off]
+        except BufferError:
+            return  # something still holds a view of the buffer, try next time
+        self.recvoff = 0
+
+    def format_message(self, message):
+        """Return message framed for the wire"""
         command = message.command
         data = message.serialize()
         tmsg = self.MAGIC_BYTES[self.network]
@@ -370,13 +367,23 @@ class NodeConn(asyncore.dispatcher):
         tmsg += b"\x00" * (12 - len(command))
         tmsg += struct.pack("<I", len(data))
         if self.ver_send >= 209:
-            th = sha256(data)
-            h = sha256(th)
-            tmsg += h[:4]
+            checksum = getattr(message, "checksum", None)  # see msg_serialized
+            if checksum is None:
+                checksum = sha256(sha256(data))[:4]
+            tmsg += checksum
         tmsg += data
-        with mininode_lock:
-            self.sendbuf += tmsg
-            self.last_sent = time.time()
+        return tmsg
+
+    def send_message(self, message, pushbuf=False):
+        if self.state != "connected" and not pushbuf:
+            return
+        if self.log.isEnabledFor(logging.DEBUG):  # repr of a big block is expensive
+            self.show_debug_msg("Send %s" % repr(message))
+        self.send_data(self.format_message(message))
+
+    def send_data(self, data):
+        """Queue framed data for sending; implemented by the transport"""
+        raise NotImplementedError
 
     def got_message(self, message):
         if message.command == b"version":
@@ -384,25 +391,276 @@ class NodeConn(asyncore.dispatcher):
                 self.messagemap[b'ping'] = msg_ping_prebip31
         if self.last_sent + 30 * 60 < time.time():
             self.send_message(self.messagemap[b'ping']())
-        self.show_debug_msg("Recv %s" % repr(message))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.show_debug_msg("Recv %s" % repr(message))
         self.cb.deliver(self, message)
 
     def disconnect_node(self):
         self.disconnect = True
 
+    def notify_closed(self):
+        # wake up wait_until()s that wait for this connection to close
+        cond = getattr(self.cb, "cond", mininode_cond)
+        with cond:
+            cond.notify_all()
+
+
+# The network event loop shared by all NodeConns.  It is created on first use
+# and run by NetworkThread for as long as there are open connections.
+network_loop = None
+network_thread = None
+mininode_connections = set()
+# guards the three above
+network_lock = RLock()
+
+
+def get_network_loop():
+    global network_loop
+    with network_lock:
+        if network_loop is None:
+            network_loop = asyncio.new_event_loop()
+        return network_loop
+
+
+def run_coroutine(coro, timeout=None):
+    """Run coro on the network loop from another thread and return its result.
+
+    This is how the test thread uses the coroutine helpers of NodeConn, e.g.
+    run_coroutine(conn.wait_for_message(b"pong")).  NetworkThread must be
+    running.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_network_loop()).result(timeout)
+
+
+class NodeConn(NodeConnBase, asyncio.Protocol):
+    """A p2p connection driven by the asyncio network loop.
+
+    Connections made before NetworkThread is started are opened when it
+    starts, later ones right away.  Callbacks run in the network thread,
+    exactly as they did with asyncore.
+    """
+
+    def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=1):
+        self.transport = None
+        self.opening = False
+        self.addr = (dstaddr, dstport)
+        self.last_message = {}
+        self.waiters = []
+        NodeConnBase.__init__(self, dstaddr, dstport, rpc, callback, net, services)
+        loop = get_network_loop()
+        with network_lock:
+            mininode_connections.add(self)
+            if network_thread is not None:
+                asyncio.run_coroutine_threadsafe(self.open(), loop)
+
+    async def open(self):
+        if self.opening:
+            return
+        self.opening = True
+        if self.disconnect:
+            self.handle_close()
+            return
+        try:
+            await asyncio.get_running_loop().create_connection(lambda: self, self.dstaddr, self.dstport)
+        except OSError:
+            self.handle_close()
+
+    def connection_made(self, transport):
+        self.show_debug_msg("MiniNode: Connected & Listening: \n")
+        with self.sendlock:
+            self.transport = transport
+            self.state = "connected"
+            data, self.sendbuf = self.sendbuf, b""
+        if data:
+            transport.write(data)
+
+    def data_received(self, data):
+        self.recvbuf += data
+        self.got_data()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.handle_close()
+
+    def handle_close(self):
+        with network_lock:
+            if self not in mininode_connections:
+                return
+            mininode_connections.discard(self)
+            last = not mininode_connections
+        self.show_debug_msg("MiniNode: Closing Connection to %s:%d... "
+                            % (self.dstaddr, self.dstport))
+        self.state = "closed"
+        self.recvbuf = bytearray()
+        self.recvoff = 0
+        self.sendbuf = b""
+        if self.transport is not None:
+            self.transport.close()
+        self.cb.on_close(self)
+        self.notify_closed()
+        self.wake_waiters()
+        if last and network_thread is not None:
+            network_loop.call_soon_threadsafe(network_loop.stop)
+
+    def send_data(self, data):
+        with self.sendlock:
+            if self.transport is None:
+                self.sendbuf += data
+            elif current_thread() is network_thread:
+                self.transport.write(data)
+            else:
+                network_loop.call_soon_threadsafe(self.write, data)
+            self.last_sent = time.time()
+
+    def write(self, data):
+        if self.transport is not None:
+            self.transport.write(data)
+
+    def disconnect_node(self):
+        self.disconnect = True
+        with network_lock:
+            if network_thread is not None:
+                network_loop.call_soon_threadsafe(self.handle_close)
+
+    def got_message(self, message):
+        self.last_message[message.command] = message
+        NodeConnBase.got_message(self, message)
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        waiters, self.waiters = self.waiters, []
+        for w in waiters:
+            if not w.done():
+                w.set_result(None)
+
+    async def wait_for(self, predicate, timeout=60):
+        """Wait until predicate() is true, checking it (under the callback's lock)
+        whenever this connection delivers a message.  Returns False on timeout.
+        Must run on the network loop, see run_coroutine()."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self.cb.lock:
+                if predicate():
+                    return True
+            remaining = deadline - loop.time()
+            if remaining <= 0 or self.state == "closed":
+                return False
+            waiter = loop.create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_for_message(self, command, timeout=60):
+        """Wait for the next message with this command and return it (None on timeout)"""
+        previous = self.last_message.get(command)
+        if await self.wait_for(lambda: self.last_message.get(command) is not previous, timeout):
+            return self.last_message[command]
+        return None
+
+    async def wait_for_verack(self, timeout=60):
+        return await self.wait_for(lambda: self.cb.verack_received, timeout)
+
 
 class NetworkThread(Thread):
+    """Runs the network loop until every NodeConn has closed"""
+
     def run(self):
-        while mininode_socket_map:
-            # We check for whether to disconnect outside of the asyncore
-            # loop to workaround the behavior of asyncore when using
-            # select
-            disconnected = []
-            for fd, obj in mininode_socket_map.items():
-                if obj.disconnect:
-                    disconnected.append(obj)
-            [obj.handle_close() for obj in disconnected]
-            asyncore.loop(0.1, use_poll=True, map=mininode_socket_map, count=1)
+        global network_thread
+        loop = get_network_loop()
+        asyncio.set_event_loop(loop)
+        with network_lock:
+            if not mininode_connections or network_thread is not None:
+                return
+            network_thread = self
+            pending = list(mininode_connections)
+        for c in pending:
+            loop.create_task(c.open())
+        while True:
+            loop.run_forever()
+            with network_lock:
+                # a connection may have been made while the loop was stopping
+                if not mininode_connections:
+                    network_thread = None
+                    return
+
+
+if asyncore is not None:
+    class AsyncoreNodeConn(NodeConnBase, asyncore.dispatcher):
+        """The original asyncore p2p connection, run by AsyncoreNetworkThread"""
+
+        def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=1):
+            asyncore.dispatcher.__init__(self, map=mininode_socket_map)
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            NodeConnBase.__init__(self, dstaddr, dstport, rpc, callback, net, services)
+            try:
+                self.connect((dstaddr, dstport))
+            except:
+                self.handle_close()
+
+        def handle_connect(self):
+            self.show_debug_msg("MiniNode: Connected & Listening: \n")
+            self.state = "connected"
+
+        def handle_close(self):
+            self.show_debug_msg("MiniNode: Closing Connection to %s:%d... "
+                                % (self.dstaddr, self.dstport))
+            self.state = "closed"
+            self.recvbuf = bytearray()
+            self.recvoff = 0
+            self.sendbuf = b""
+            try:
+                self.close()
+            except:
+                pass
+            self.cb.on_close(self)
+            self.notify_closed()
+
+        def handle_read(self):
+            try:
+                t = self.recv(8192)
+                if len(t) > 0:
+                    self.recvbuf += t
+                    self.got_data()
+            except:
+                pass
+
+        def readable(self):
+            return True
+
+        def writable(self):
+            with self.sendlock:
+                length = len(self.sendbuf)
+            return (length > 0)
+
+        def handle_write(self):
+            with self.sendlock:
+                try:
+                    sent = self.send(self.sendbuf)
+                except:
+                    self.handle_close()
+                    return
+                self.sendbuf = self.sendbuf[sent:]
+
+        def send_data(self, data):
+            with self.sendlock:
+                self.sendbuf += data
+                self.last_sent = time.time()
+
+    class AsyncoreNetworkThread(Thread):
+        def run(self):
+            while mininode_socket_map:
+                # We check for whether to disconnect outside of the asyncore
+                # loop to workaround the behavior of asyncore when using
+                # select
+                disconnected = []
+                for fd, obj in mininode_socket_map.items():
+                    if obj.disconnect:
+                        disconnected.append(obj)
+                [obj.handle_close() for obj in disconnected]
+                asyncore.loop(0.1, use_poll=True, map=mininode_socket_map, count=1)
 
 
 # An exception we can raise if we detect a potential disconnect
@@ -1,3 +1,4 @@
+import copy
 import socket
 import struct
 import random
@@ -5,37 +6,58 @@ import hashlib
 from binascii import hexlify, unhexlify
 import time
 from codecs import encode
-from threading import RLock
+from threading import Condition, RLock
 from io import BytesIO
 MY_VERSION = 60001  # past bip-31 for ping/pong
 MY_SUBVERSION = b"/python-mininode-tester:0.0.3/"
 
 COIN = 100000000  # 1 btc in satoshis
 
-# One lock for synchronizing all data access between the networking thread (see
-# NetworkThread below) and the thread running the test logic.  For simplicity,
-# NodeConn acquires this lock whenever delivering a message to to a NodeConnCB,
-# and whenever adding anything to the send buffer (in send_message()).  This
-# lock should be acquired in the thread running the test logic to synchronize
-# access to any data shared with the NodeConnCB or NodeConn.
+# The lock for synchronizing access to NodeConnCB state between the networking
+# thread (see NetworkThread in mininode) and the thread running the test logic.
+# NodeConnCB.deliver() holds the callback's lock while running its handlers, and
+# unless a callback is given a lock of its own that lock is this one, so tests
+# that acquire mininode_lock to read callback state stay correct.  Send buffers
+# are protected by a lock per connection.
 mininode_lock = RLock()
 
+# Notified (with mininode_lock held) whenever a message has been delivered or a
+# connection closed, so that wait_until() can re-check its predicate right away.
+mininode_cond = Condition(mininode_lock)
+
+# How often wait_until() re-checks its predicate when nothing is delivered, for
+# predicates that depend on more than the p2p messages.  One attempt is counted
+# per interval, as when wait_until() simply polled.
+WAIT_UNTIL_INTERVAL = 0.05
+
 # Helper function
 
 
-def wait_until(predicate, attempts=float('inf'), timeout=float('inf')):
-    attempt = 0
-    elapsed = 0
+def wait_until(predicate, attempts=float('inf'), timeout=float('inf'), cond=None):
+    """Wait until predicate() returns true, evaluating it with mininode_lock held.
+
+    To wait on a NodeConnCB that has its own lock pass its cond (or use
+    NodeConnCB.wait_until()); predicate is then evaluated under that lock.
 
-    while attempt < attempts and elapsed < timeout:
-        with mininode_lock:
-            if predicate():
-                return True
-        attempt += 1
-        elapsed += 0.05
-        time.sleep(0.05)
+    Gives up (returning False) after timeout seconds or attempts polling
+    intervals, whichever is shorter.  The predicate is re-evaluated as soon as
+    a message is delivered, and at least every WAIT_UNTIL_INTERVAL seconds.
 
-    return False
+    >>> wait_until(lambda: True)
+    True
+    >>> wait_until(lambda: False, attempts=2)
+    False
+    """
+    if cond is None:
+        cond = mininode_cond
+    deadline = time.time() + min(timeout, attempts * WAIT_UNTIL_INTERVAL)
+    with cond:
+        while not predicate():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            cond.wait(min(remaining, WAIT_UNTIL_INTERVAL))
+    return True
 
 
 # Serialization/deserialization tools
@@ -57,21 +79,148 @@ def hash256(s):
     return sha256(sha256(s))
 
 
+# Precompiled structs for the fixed size fields of the wire format
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_I32 = struct.Struct("<i")
+_U32 = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_U64 = struct.Struct("<Q")
+_U256 = struct.Struct("<32s")
+_OUTPOINT = struct.Struct("<32sI")
+_HEADER = struct.Struct("<i32s32sIII")
+
+UINT256_MASK = (1 << 256) - 1
+
+
+class BufferReader(object):
+    """A read cursor over a memoryview of serialized data.
+
+    This is a drop-in replacement for BytesIO wherever a deserialize(f)
+    function is called.  Unlike BytesIO it does not copy the underlying
+    buffer, and fixed size fields are decoded in place with
+    struct.unpack_from instead of slicing out a temporary bytes object.
+
+    >>> f = BufferReader(ser_compact_size(300) + ser_uint256(7) + b"tail")
+    >>> f.read_compact_size(), f.read_uint256(), f.read()
+    (300, 7, b'tail')
+    >>> f.read(4)
+    b''
+    >>> f.read_compact_size()
+    Traceback (most recent call last):
+        ...
+    struct.error: compact size needs at least 1 byte
+    """
+    __slots__ = ("view", "pos")
+
+    def __init__(self, data):
+        view = memoryview(data)
+        if view.format != "B" or view.ndim != 1:
+            view = view.cast("B")
+        self.view = view
+        self.pos = 0
+
+    def read(self, n=-1):
+        start = self.pos
+        end = len(self.view)
+        if n >= 0 and start + n < end:
+            end = start + n
+        self.pos = end
+        return self.view[start:end].tobytes()
+
+    def tell(self):
+        return self.pos
+
+    def remaining(self):
+        return len(self.view) - self.pos
+
+    def read_struct(self, st):
+        """Decode a precompiled struct.Struct at the cursor"""
+        r = st.unpack_from(self.view, self.pos)
+        self.pos += st.size
+        return r
+
+    def read_compact_size(self):
+        view = self.view
+        pos = self.pos
+        if pos >= len(view):
+            raise struct.error("compact size needs at least 1 byte")
+        nit = view[pos]
+        if nit < 253:
+            self.pos = pos + 1
+            return nit
+        if nit == 253:
+            st = _U16
+        elif nit == 254:
+            st = _U32
+        else:
+            st = _U64
+        r = st.unpack_from(view, pos + 1)[0]
+        self.pos = pos + 1 + st.size
+        return r
+
+    def read_uint256(self):
+        pos = self.pos
+        if pos + 32 > len(self.view):
+            raise struct.error("uint256 needs 32 bytes")
+        self.pos = pos + 32
+        return int.from_bytes(self.view[pos:pos + 32], "little")
+
+
+def read_struct(f, st):
+    """Decode the precompiled struct.Struct st from the file-like object f"""
+    if type(f) is BufferReader:
+        pos = f.pos
+        r = st.unpack_from(f.view, pos)
+        f.pos = pos + st.size
+        return r
+    return st.unpack(f.read(st.size))
+
+
+def deser_compact_size(f):
+    if type(f) is BufferReader:
+        return f.read_compact_size()
+    nit = _U8.unpack(f.read(1))[0]
+    if nit == 253:
+        nit = _U16.unpack(f.read(2))[0]
+    elif nit == 254:
+        nit = _U32.unpack(f.read(4))[0]
+    elif nit == 255:
+        nit = _U64.unpack(f.read(8))[0]
+    return nit
+
+
+def ser_compact_size(l):
+    if l < 253:
+        return _U8.pack(l)
+    elif l < 0x10000:
+        return struct.pack("<BH", 253, l)
+    elif l < 0x100000000:
+        return struct.pack("<BI", 254, l)
+    return struct.pack("<BQ", 255, l)
+
+
 def deser_string(f):
     """Convert an array of bytes in the bitcoin P2P protocol format into a string
 
     >>> import io
     >>> deser_string(io.BytesIO(ser_string("The grid bug bites!  You get zapped!".encode()))).decode()
     'The grid bug bites!  You get zapped!'
+    >>> deser_string(BufferReader(ser_string(b"x" * 300)))[-3:]
+    b'xxx'
+    >>> deser_string(BufferReader(ser_string(b"x" * 300)[:-1]))
+    Traceback (most recent call last):
+        ...
+    struct.error: string of 300 bytes but only 299 left
     """
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    return f.read(nit)
+    if type(f) is BufferReader:
+        nit = f.read_compact_size()
+        pos = f.pos
+        if pos + nit > len(f.view):
+            raise struct.error("string of %d bytes but only %d left" % (nit, len(f.view) - pos))
+        f.pos = pos + nit
+        return f.view[pos:pos + nit].tobytes()
+    return f.read(deser_compact_size(f))
 
 
 def ser_string(s):
@@ -90,27 +239,28 @@ def ser_string(s):
 
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    """
+    >>> deser_uint256(BufferReader(ser_uint256(0x1234 << 200))) == 0x1234 << 200
+    True
+    """
+    if type(f) is BufferReader:
+        return f.read_uint256()
+    s = f.read(32)
+    if len(s) != 32:
+        raise struct.error("uint256 needs 32 bytes")
+    return int.from_bytes(s, "little")
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    """
+    >>> hexlify(ser_uint256(1 << 255 | 0x0102))
+    b'0201000000000000000000000000000000000000000000000000000000000080'
+    """
+    return (u & UINT256_MASK).to_bytes(32, "little")
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], "little")
 
 
 def uint256_from_compact(c):
@@ -120,13 +270,7 @@ def uint256_from_compact(c):
 
 
 def deser_vector(f, c):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+    nit = deser_compact_size(f)
     r = []
     for i in range(nit):
         t = c()
@@ -135,29 +279,29 @@ def deser_vector(f, c):
     return r
 
 
-def ser_vector(l):
-    r = b""
-    if len(l) < 253:
-        r = struct.pack("B", len(l))
-    elif len(l) < 0x10000:
-        r = struct.pack("<BH", 253, len(l))
-    elif len(l) < 0x100000000:
-        r = struct.pack("<BI", 254, len(l))
-    else:
-        r = struct.pack("<BQ", 255, len(l))
+def ser_vector_into(buf, l):
+    """Append the serialization of a vector of objects to the bytearray buf.
+
+    Every element is written with its serialize_into() method, so the whole
+    vector is produced in one growing buffer instead of by concatenating
+    immutable bytes objects.  Returns buf.
+    """
+    buf += ser_compact_size(len(l))
     for i in l:
-        r += i.serialize()
-    return r
+        i.serialize_into(buf)
+    return buf
+
+
+def ser_vector(l):
+    """
+    >>> hexlify(ser_vector([CInv(1, 2)]))
+    b'01010000000200000000000000000000000000000000000000000000000000000000000000'
+    """
+    return bytes(ser_vector_into(bytearray(), l))
 
 
 def deser_uint256_vector(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+    nit = deser_compact_size(f)
     r = []
     for i in range(nit):
         t = deser_uint256(f)
@@ -166,28 +310,14 @@ def deser_uint256_vector(f):
 
 
 def ser_uint256_vector(l):
-    r = b""
-    if len(l) < 253:
-        r = struct.pack("B", len(l))
-    elif len(l) < 0x10000:
-        r = struct.pack("<BH", 253, len(l))
-    elif len(l) < 0x100000000:
-        r = struct.pack("<BI", 254, len(l))
-    else:
-        r = struct.pack("<BQ", 255, len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
         r += ser_uint256(i)
-    return r
+    return bytes(r)
 
 
 def deser_string_vector(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+    nit = deser_compact_size(f)
     r = []
     for i in range(nit):
         t = deser_string(f)
@@ -196,54 +326,32 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = b""
-    if len(l) < 253:
-        r = struct.pack("B", len(l))
-    elif len(l) < 0x10000:
-        r = struct.pack("<BH", 253, len(l))
-    elif len(l) < 0x100000000:
-        r = struct.pack("<BI", 254, len(l))
-    else:
-        r = struct.pack("<BQ", 255, len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for sv in l:
         r += ser_string(sv)
-    return r
+    return bytes(r)
 
 
 def deser_int_vector(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+    nit = deser_compact_size(f)
     r = []
     for i in range(nit):
-        t = struct.unpack("<i", f.read(4))[0]
+        t = read_struct(f, _I32)[0]
         r.append(t)
     return r
 
 
 def ser_int_vector(l):
-    r = b""
-    if len(l) < 253:
-        r = struct.pack("B", len(l))
-    elif len(l) < 0x10000:
-        r = struct.pack("<BH", 253, len(l))
-    elif len(l) < 0x100000000:
-        r = struct.pack("<BI", 254, len(l))
-    else:
-        r = struct.pack("<BQ", 255, len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
-        r += struct.pack("<i", i)
-    return r
+        r += _I32.pack(i)
+    return bytes(r)
 
 # Deserialize from a hex string representation (eg from RPC)
 
 
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(unhexlify(hex_string.encode('ascii'))))
+    obj.deserialize(BufferReader(unhexlify(hex_string.encode('ascii'))))
     return obj
 
 # Convert a binary-serializable object to hex (eg for submission via RPC)
@@ -263,18 +371,20 @@ class CAddress(object):
         self.port = 0
 
     def deserialize(self, f):
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
+        self.nServices = read_struct(f, _U64)[0]
         self.pchReserved = f.read(12)
         self.ip = socket.inet_ntoa(f.read(4))
         self.port = struct.unpack(">H", f.read(2))[0]
 
+    def serialize_into(self, buf):
+        buf += _U64.pack(self.nServices)
+        buf += self.pchReserved
+        buf += socket.inet_aton(self.ip)
+        buf += struct.pack(">H", self.port)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nServices)
-        r += self.pchReserved
-        r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "CAddress(nServices=%i ip=%s port=%i)" % (self.nServices,
@@ -301,14 +411,16 @@ class CInv(object):
         self.hash = h
 
     def deserialize(self, f):
-        self.type = struct.unpack("<i", f.read(4))[0]
+        self.type = read_struct(f, _I32)[0]
         self.hash = deser_uint256(f)
 
+    def serialize_into(self, buf):
+        buf += _I32.pack(self.type)
+        buf += ser_uint256(self.hash)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.type)
-        r += ser_uint256(self.hash)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
@@ -321,40 +433,81 @@ class CBlockLocator(object):
         self.vHave = []
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = read_struct(f, _I32)[0]
         self.vHave = deser_uint256_vector(f)
 
+    def serialize_into(self, buf):
+        buf += _I32.pack(self.nVersion)
+        buf += ser_uint256_vector(self.vHave)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256_vector(self.vHave)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "CBlockLocator(nVersion=%i vHave=%s)" \
             % (self.nVersion, repr(self.vHave))
 
 
-class COutPoint(object):
+# Count of changes to the fields of transactions and of their inputs, outputs
+# and outpoints.  A transaction's cached serialization (see CTransaction) is
+# only used while no such change has been made since it was filled.
+_tx_edits = 0
+
+
+class TxPart(object):
+    """Base of COutPoint, CTxIn and CTxOut: assigning to any of their fields
+    counts as a change to every transaction (see CTransaction).  A bytearray
+    assigned to a field is stored as bytes, so that it cannot change later
+    without going through here."""
+    def __setattr__(self, name, value):
+        global _tx_edits
+        _tx_edits += 1
+        if type(value) is bytearray:
+            value = bytes(value)
+        object.__setattr__(self, name, value)
+
+
+def deser_tx_parts(f, c):
+    """deser_vector() for TxPart classes, whose deserialize() sets every field"""
+    nit = deser_compact_size(f)
+    new = c.__new__
+    r = []
+    for i in range(nit):
+        t = new(c)
+        t.deserialize(f)
+        r.append(t)
+    return r
+
+
+class COutPoint(TxPart):
     def __init__(self, hash=0, n=0):
         self.hash = hash
         self.n = n
 
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        # fields are set through __dict__, and counted as one change, to
+        # keep this receive path fast
+        global _tx_edits
+        _tx_edits += 1
+        (h, n) = read_struct(f, _OUTPOINT)
+        d = self.__dict__
+        d["hash"] = int.from_bytes(h, "little")
+        d["n"] = n
+
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.hash)
+        buf += _U32.pack(self.n)
+        return buf
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
 
-class CTxIn(object):
+class CTxIn(TxPart):
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
             self.prevout = COutPoint()
@@ -364,17 +517,24 @@ class CTxIn(object):
         self.nSequence = nSequence
 
     def deserialize(self, f):
-        self.prevout = COutPoint()
-        self.prevout.deserialize(f)
-        self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        global _tx_edits
+        _tx_edits += 1
+        prevout = COutPoint.__new__(COutPoint)
+        prevout.deserialize(f)
+        d = self.__dict__
+        d["prevout"] = prevout
+        d["scriptSig"] = deser_string(f)
+        d["nSequence"] = read_struct(f, _U32)[0]
+
+    def serialize_into(self, buf):
+        self.prevout.serialize_into(buf)
+        buf += ser_compact_size(len(self.scriptSig))
+        buf += self.scriptSig
+        buf += _U32.pack(self.nSequence)
+        return buf
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -382,20 +542,26 @@ class CTxIn(object):
                self.nSequence)
 
 
-class CTxOut(object):
+class CTxOut(TxPart):
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
         self.scriptPubKey = scriptPubKey
 
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
-        self.scriptPubKey = deser_string(f)
+        global _tx_edits
+        _tx_edits += 1
+        d = self.__dict__
+        d["nValue"] = read_struct(f, _I64)[0]
+        d["scriptPubKey"] = deser_string(f)
+
+    def serialize_into(self, buf):
+        buf += _I64.pack(int(self.nValue))
+        buf += ser_compact_size(len(self.scriptPubKey))
+        buf += self.scriptPubKey
+        return buf
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", int(self.nValue))
-        r += ser_string(self.scriptPubKey)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -404,6 +570,48 @@ class CTxOut(object):
 
 
 class CTransaction(object):
+    """A bitcoin transaction.
+
+    The transaction keeps its wire serialization, and the double SHA256 of
+    it, between calls to serialize(), calc_sha256() and the serialization of
+    blocks and messages that contain it.  The cache is dropped when vin or
+    vout no longer hold the same inputs and outputs, and after any field of
+    any transaction, input, output or outpoint has been assigned (see
+    TxPart), so edits made in place are seen too.  Scripts are bytes and are
+    replaced, never changed in place.
+
+    A finished transaction is therefore serialized once however many blocks
+    it goes into or peers it is sent to, while a test that is still editing
+    transactions pays for one serialization after each change.
+
+    calc_sha256() keeps sha256 until rehash() and sets hash from the current
+    fields, as it always has.
+
+    >>> tx = CTransaction()
+    >>> tx.vin.append(CTxIn(COutPoint(7, 0), b"\x51"))
+    >>> tx.vout.append(CTxOut(1, b"\x51"))
+    >>> def uncached(t):  # a copy has no cache yet
+    ...     return CTransaction(t).serialize()
+    >>> tx.serialize() is tx.serialize()
+    True
+    >>> tx.vin[0].scriptSig = b"\x52"; tx.vin[0].prevout.n = 3
+    >>> tx.vout.append(CTxOut(2, bytearray(b"\x53")))
+    >>> tx.vout[0].nValue += 5
+    >>> tx.serialize() == uncached(tx), tx.serialize()[37]
+    (True, 3)
+    >>> block = CBlock(); block.vtx.append(tx); size = len(block.serialize())
+    >>> tx.vout.pop()
+    CTxOut(nValue=0.00000002 scriptPubKey=b'53')
+    >>> len(block.serialize()) == size - 10 and tx.serialize() == uncached(tx)
+    True
+    >>> tx.rehash(); tx.nLockTime = 5; tx.calc_sha256(); tx.hash == "%064x" % tx.sha256
+    False
+    >>> tx.rehash(); tx.hash == "%064x" % tx.sha256
+    True
+    """
+    # The fields that are serialized
+    FIELDS = frozenset(("nVersion", "vin", "vout", "nLockTime"))
+
     def __init__(self, tx=None):
         if tx is None:
             self.nVersion = 1
@@ -420,30 +628,63 @@ class CTransaction(object):
             self.sha256 = None
             self.hash = None
 
+    def __setattr__(self, name, value):
+        if name in self.FIELDS:
+            global _tx_edits
+            _tx_edits += 1
+        object.__setattr__(self, name, value)
+
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.vin = deser_vector(f, CTxIn)
-        self.vout = deser_vector(f, CTxOut)
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
-        self.sha256 = None
-        self.hash = None
+        global _tx_edits
+        _tx_edits += 1
+        start = f.tell() if type(f) is BufferReader else None
+        d = self.__dict__
+        d["nVersion"] = read_struct(f, _I32)[0]
+        d["vin"] = deser_tx_parts(f, CTxIn)
+        d["vout"] = deser_tx_parts(f, CTxOut)
+        d["nLockTime"] = read_struct(f, _U32)[0]
+        d["sha256"] = None
+        d["hash"] = None
+        if start is not None:
+            # the bytes just read are the serialization
+            d["_wire"] = [_tx_edits, d["vin"][:], d["vout"][:], f.view[start:f.pos].tobytes(), None]
+        else:
+            d["_wire"] = None
+
+    def wire(self):
+        """[change count, vin, vout, serialization, double SHA256 or None]
+        for the current fields, from the cache if it is still valid"""
+        c = self.__dict__.get("_wire")
+        if c is not None and c[0] == _tx_edits and c[1] == self.vin and c[2] == self.vout:
+            return c
+        edits = _tx_edits  # read first: a change made meanwhile invalidates
+        buf = bytearray()
+        buf += _I32.pack(self.nVersion)
+        ser_vector_into(buf, self.vin)
+        ser_vector_into(buf, self.vout)
+        buf += _U32.pack(self.nLockTime)
+        c = [edits, self.vin[:], self.vout[:], bytes(buf), None]
+        self.__dict__["_wire"] = c
+        return c
+
+    def serialize_into(self, buf):
+        buf += self.wire()[3]
+        return buf
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        return self.wire()[3]
 
     def rehash(self):
         self.sha256 = None
         self.calc_sha256()
 
     def calc_sha256(self):
+        c = self.wire()
+        if c[4] is None:
+            c[4] = hash256(c[3])
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize()))
-        self.hash = encode(hash256(self.serialize())[::-1], 'hex_codec').decode('ascii')
+            self.sha256 = uint256_from_str(c[4])
+        self.hash = encode(c[4][::-1], 'hex_codec').decode('ascii')
 
     def is_valid(self):
         self.calc_sha256()
@@ -494,36 +735,29 @@ class CBlockHeader(object):
         self.hash = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        # the whole 80 byte header is decoded with a single unpack
+        (self.nVersion, prev, merkle, self.nTime, self.nBits,
+         self.nNonce) = read_struct(f, _HEADER)
+        self.hashPrevBlock = int.from_bytes(prev, "little")
+        self.hashMerkleRoot = int.from_bytes(merkle, "little")
         self.sha256 = None
         self.hash = None
 
+    def serialize_into(self, buf):
+        buf += _HEADER.pack(self.nVersion,
+                            ser_uint256(self.hashPrevBlock),
+                            ser_uint256(self.hashMerkleRoot),
+                            self.nTime, self.nBits, self.nNonce)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
+            h = hash256(CBlockHeader.serialize_into(self, bytearray()))
+            self.sha256 = uint256_from_str(h)
+            self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
 
     def gethash(self):
         self.calc_sha256()
@@ -551,35 +785,289 @@ class CBlockHeader(object):
                time.ctime(self.nTime), self.nBits, self.nNonce)
 
 
+def merkle_root_from_branch(leaf, branch, index):
+    """Fold a merkle branch (as returned by MerkleTree.branch) into a root.
+
+    leaf and the branch entries are 32 byte serialized hashes, the result is
+    the root as an integer, comparable to CBlockHeader.hashMerkleRoot.
+    """
+    h = leaf
+    for sibling in branch:
+        if index & 1:
+            h = hash256(sibling + h)
+        else:
+            h = hash256(h + sibling)
+        index >>= 1
+    return uint256_from_str(h)
+
+
+class MerkleTree(object):
+    """Bitcoin merkle tree that keeps its interior levels.
+
+    levels[0] holds the leaves (32 byte serialized hashes) and the last level
+    holds the root.  As in bitcoind, a level with an odd number of nodes pairs
+    its last node with itself.  Changing leaves only recomputes the nodes on
+    the paths from those leaves to the root.
+
+    >>> leaves = [ser_uint256(i) for i in range(1, 6)]
+    >>> t = MerkleTree(leaves[:4])
+    >>> t.append(leaves[4])
+    >>> t.root() == MerkleTree(leaves).root()
+    True
+    >>> all(merkle_root_from_branch(leaves[i], t.branch(i), i) == t.root() for i in range(5))
+    True
+    >>> t.replace(2, ser_uint256(7)); t.truncate(3)
+    >>> t.root() == MerkleTree([leaves[0], leaves[1], ser_uint256(7)]).root()
+    True
+    """
+
+    def __init__(self, leaves=None):
+        self.levels = [[]]
+        if leaves:
+            self.update(leaves)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def leaves(self):
+        return self.levels[0]
+
+    def append(self, leaf):
+        leaves = self.levels[0]
+        leaves.append(leaf)
+        self._rehash([len(leaves) - 1])
+
+    def replace(self, index, leaf):
+        self.levels[0][index] = leaf
+        self._rehash([index])
+
+    def truncate(self, n):
+        leaves = self.levels[0]
+        if n < len(leaves):
+            del leaves[n:]
+            # the new last leaf may have lost its right hand sibling
+            self._rehash([n - 1] if n else [])
+
+    def update(self, leaves):
+        """Make the tree hold leaves, recomputing only what changed.
+
+        Returns the number of leaves that differed.
+        """
+        cur = self.levels[0]
+        n = len(leaves)
+        dirty = [i for i in range(min(n, len(cur))) if cur[i] != leaves[i]]
+        for i in dirty:
+            cur[i] = leaves[i]
+        if n > len(cur):
+            dirty.extend(range(len(cur), n))
+            cur.extend(leaves[len(cur):])
+        elif n < len(cur):
+            del cur[n:]
+            if n and (not dirty or dirty[-1] != n - 1):
+                dirty.append(n - 1)
+        elif not dirty:
+            return 0
+        self._rehash(dirty)
+        return len(dirty)
+
+    def _rehash(self, dirty):
+        """Recompute the ancestors of the (sorted) dirty node indexes"""
+        levels = self.levels
+        k = 0
+        while len(levels[k]) > 1:
+            cur = levels[k]
+            if k + 1 == len(levels):
+                levels.append([])
+            up = levels[k + 1]
+            n = (len(cur) + 1) // 2
+            if len(up) > n:
+                del up[n:]
+            elif len(up) < n:
+                up.extend([None] * (n - len(up)))
+            last = len(cur) - 1
+            parents = []
+            for i in dirty:
+                p = i >> 1
+                if parents and parents[-1] == p:
+                    continue
+                parents.append(p)
+                left = cur[2 * p]
+                up[p] = hash256(left + (cur[2 * p + 1] if 2 * p < last else left))
+            dirty = parents
+            k += 1
+        del levels[k + 1:]
+
+    def root(self):
+        """The root as an integer, 0 for an empty tree"""
+        top = self.levels[-1]
+        if top:
+            return uint256_from_str(top[0])
+        return 0
+
+    def branch(self, index):
+        """The sibling hashes from leaf index up to (excluding) the root"""
+        result = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling >= len(level):
+                sibling = index
+            result.append(level[sibling])
+            index >>= 1
+        return result
+
+
+def _search_nonces(midstate, target, start, stop):
+    """Scan nonces [start, stop), returning the first that meets target or None.
+
+    midstate is a sha256 object that has already hashed the 76 header bytes
+    that precede the nonce.
+    """
+    pack = _U32.pack
+    new = hashlib.sha256
+    for nonce in range(start, stop):
+        h = midstate.copy()
+        h.update(pack(nonce))
+        if int.from_bytes(new(h.digest()).digest(), "little") <= target:
+            return nonce
+    return None
+
+
+def _nonce_search_worker(prefix, target, first, step, batch, stop, best, counter):
+    # Runs in a child process: scan every step'th batch of nonces starting at
+    # first, recording a nonce that meets target in best unless a lower one
+    # is there already.  Batches that start above best need not be scanned,
+    # but every batch below it is, by one worker or another, so best ends up
+    # as the lowest solution, exactly what a single process would find.
+    midstate = hashlib.sha256(prefix)
+    start = first
+    while start < min(best.value, stop):
+        end = min(start + batch, stop)
+        nonce = _search_nonces(midstate, target, start, end)
+        with counter.get_lock():
+            counter.value += (end - start) if nonce is None else (nonce - start + 1)
+        if nonce is not None:
+            with best.get_lock():
+                if nonce < best.value:
+                    best.value = nonce
+            return
+        start += step
+
+
+class NonceSearch(object):
+    """Search for a header nonce that meets the target encoded in nBits.
+
+    The 76 header bytes in front of the nonce are fixed for the search, so
+    they are hashed once and each candidate only costs the last sha256 block
+    plus the second sha256.  With processes > 1 the nonce space is split into
+    batches that are handed out round robin to that many worker processes.
+    Either way the result is the lowest nonce that meets the target: workers
+    stop once they are past a solution, but finish the batches below it.
+
+    After search(), hashes holds the number of nonces tried and elapsed the
+    wall clock time taken.
+
+    >>> header = CBlockHeader()
+    >>> header.nBits = 0x207fffff
+    >>> search = NonceSearch(header)
+    >>> nonce = search.search()
+    >>> header.nNonce = nonce; header.rehash() <= uint256_from_compact(header.nBits)
+    True
+    >>> search.hashes == nonce + 1
+    True
+    """
+    BATCH = 1 << 14
+
+    def __init__(self, header, processes=1):
+        self.prefix = bytes(CBlockHeader.serialize_into(header, bytearray())[:76])
+        self.target = uint256_from_compact(header.nBits)
+        self.start = header.nNonce
+        self.processes = processes
+        self.hashes = 0
+        self.elapsed = 0.0
+
+    def hashes_per_second(self):
+        if self.elapsed:
+            return self.hashes / self.elapsed
+        return 0.0
+
+    def search(self, stop=1 << 32):
+        """Return the lowest nonce in [start, stop) that meets the target, or None"""
+        begin = time.perf_counter()
+        try:
+            if self.processes <= 1:
+                nonce = _search_nonces(hashlib.sha256(self.prefix), self.target, self.start, stop)
+                self.hashes = (stop if nonce is None else nonce + 1) - self.start
+                return nonce
+            return self._search_parallel(stop)
+        finally:
+            self.elapsed = time.perf_counter() - begin
+
+    def _search_parallel(self, stop):
+        import multiprocessing
+        best = multiprocessing.Value("Q", stop)
+        counter = multiprocessing.Value("Q", 0)
+        step = self.BATCH * self.processes
+        workers = [multiprocessing.Process(target=_nonce_search_worker,
+                                           args=(self.prefix, self.target, self.start + i * self.BATCH,
+                                                 step, self.BATCH, stop, best, counter))
+                   for i in range(self.processes)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        try:
+            running = True
+            while running:
+                running = False
+                for w in workers:
+                    w.join(0.05)
+                    if w.exitcode:
+                        # the batches it had left are unscanned, so there
+                        # is no telling whether a lower nonce exists
+                        raise RuntimeError("nonce search worker %d exited with code %d" % (w.pid, w.exitcode))
+                    running = running or w.exitcode is None
+        finally:
+            for w in workers:
+                if w.is_alive():
+                    w.terminate()
+                w.join()
+            self.hashes = counter.value
+        if best.value < stop:
+            return best.value
+        return None
+
+
 class CBlock(CBlockHeader):
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
+        self.merkle_tree = MerkleTree()
 
     def deserialize(self, f):
         super(CBlock, self).deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
 
+    def serialize_into(self, buf):
+        super(CBlock, self).serialize_into(buf)
+        ser_vector_into(buf, self.vtx)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += super(CBlock, self).serialize()
-        r += ser_vector(self.vtx)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def calc_merkle_root(self):
+        # vtx is a plain list that tests edit freely, so bring the tree up to
+        # date with it here; only the paths of changed transactions are rehashed
         hashes = []
         for tx in self.vtx:
             tx.calc_sha256()
             hashes.append(ser_uint256(tx.sha256))
-        while len(hashes) > 1:
-            newhashes = []
-            for i in range(0, len(hashes), 2):
-                i2 = min(i + 1, len(hashes) - 1)
-                newhashes.append(hash256(hashes[i] + hashes[i2]))
-            hashes = newhashes
-        if hashes:
-            return uint256_from_str(hashes[0])
-        return 0
+        self.merkle_tree.update(hashes)
+        return self.merkle_tree.root()
+
+    def get_merkle_branch(self, index):
+        """Merkle branch proving that vtx[index] is in this block"""
+        self.calc_merkle_root()
+        return self.merkle_tree.branch(index)
 
     def is_valid(self):
         self.calc_sha256()
@@ -593,12 +1081,22 @@ class CBlock(CBlockHeader):
             return False
         return True
 
-    def solve(self):
+    def solve(self, processes=1):
+        """Find a nonce that meets nBits, starting the search at nNonce.
+
+        If the nonce space runs out nTime is bumped and the search restarted
+        from 0.  Returns the NonceSearch used, for its hash rate.
+        """
+        while True:
+            search = NonceSearch(self, processes)
+            nonce = search.search()
+            if nonce is not None:
+                break
+            self.nTime += 1
+            self.nNonce = 0
+        self.nNonce = nonce
         self.rehash()
-        target = uint256_from_compact(self.nBits)
-        while self.sha256 > target:
-            self.nNonce += 1
-            self.rehash()
+        return search
 
     def __str__(self):
         return "CBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx_len=%d)" \
@@ -628,36 +1126,38 @@ class CUnsignedAlert(object):
         self.strReserved = b""
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.nRelayUntil = struct.unpack("<q", f.read(8))[0]
-        self.nExpiration = struct.unpack("<q", f.read(8))[0]
-        self.nID = struct.unpack("<i", f.read(4))[0]
-        self.nCancel = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = read_struct(f, _I32)[0]
+        self.nRelayUntil = read_struct(f, _I64)[0]
+        self.nExpiration = read_struct(f, _I64)[0]
+        self.nID = read_struct(f, _I32)[0]
+        self.nCancel = read_struct(f, _I32)[0]
         self.setCancel = deser_int_vector(f)
-        self.nMinVer = struct.unpack("<i", f.read(4))[0]
-        self.nMaxVer = struct.unpack("<i", f.read(4))[0]
+        self.nMinVer = read_struct(f, _I32)[0]
+        self.nMaxVer = read_struct(f, _I32)[0]
         self.setSubVer = deser_string_vector(f)
-        self.nPriority = struct.unpack("<i", f.read(4))[0]
+        self.nPriority = read_struct(f, _I32)[0]
         self.strComment = deser_string(f)
         self.strStatusBar = deser_string(f)
         self.strReserved = deser_string(f)
 
+    def serialize_into(self, buf):
+        buf += _I32.pack(self.nVersion)
+        buf += _I64.pack(self.nRelayUntil)
+        buf += _I64.pack(self.nExpiration)
+        buf += _I32.pack(self.nID)
+        buf += _I32.pack(self.nCancel)
+        buf += ser_int_vector(self.setCancel)
+        buf += _I32.pack(self.nMinVer)
+        buf += _I32.pack(self.nMaxVer)
+        buf += ser_string_vector(self.setSubVer)
+        buf += _I32.pack(self.nPriority)
+        buf += ser_string(self.strComment)
+        buf += ser_string(self.strStatusBar)
+        buf += ser_string(self.strReserved)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<q", self.nRelayUntil)
-        r += struct.pack("<q", self.nExpiration)
-        r += struct.pack("<i", self.nID)
-        r += struct.pack("<i", self.nCancel)
-        r += ser_int_vector(self.setCancel)
-        r += struct.pack("<i", self.nMinVer)
-        r += struct.pack("<i", self.nMaxVer)
-        r += ser_string_vector(self.setSubVer)
-        r += struct.pack("<i", self.nPriority)
-        r += ser_string(self.strComment)
-        r += ser_string(self.strStatusBar)
-        r += ser_string(self.strReserved)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "CUnsignedAlert(nVersion %d, nRelayUntil %d, nExpiration %d, nID %d, nCancel %d, nMinVer %d, nMaxVer %d, nPriority %d, strComment %s, strStatusBar %s, strReserved %s)" \
@@ -675,11 +1175,13 @@ class CAlert(object):
         self.vchMsg = deser_string(f)
         self.vchSig = deser_string(f)
 
+    def serialize_into(self, buf):
+        buf += ser_string(self.vchMsg)
+        buf += ser_string(self.vchSig)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += ser_string(self.vchMsg)
-        r += ser_string(self.vchSig)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "CAlert(vchMsg.sz %d, vchSig.sz %d)" \
@@ -701,20 +1203,20 @@ class msg_version(object):
         self.nStartingHeight = -1
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = read_struct(f, _I32)[0]
         if self.nVersion == 10300:
             self.nVersion = 300
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.nTime = struct.unpack("<q", f.read(8))[0]
+        self.nServices = read_struct(f, _U64)[0]
+        self.nTime = read_struct(f, _I64)[0]
         self.addrTo = CAddress()
         self.addrTo.deserialize(f)
         if self.nVersion >= 106:
             self.addrFrom = CAddress()
             self.addrFrom.deserialize(f)
-            self.nNonce = struct.unpack("<Q", f.read(8))[0]
+            self.nNonce = read_struct(f, _U64)[0]
             self.strSubVer = deser_string(f)
             if self.nVersion >= 209:
-                self.nStartingHeight = struct.unpack("<i", f.read(4))[0]
+                self.nStartingHeight = read_struct(f, _I32)[0]
             else:
                 self.nStartingHeight = None
         else:
@@ -723,17 +1225,19 @@ class msg_version(object):
             self.strSubVer = None
             self.nStartingHeight = None
 
+    def serialize_into(self, buf):
+        buf += _I32.pack(self.nVersion)
+        buf += _U64.pack(self.nServices)
+        buf += _I64.pack(self.nTime)
+        self.addrTo.serialize_into(buf)
+        self.addrFrom.serialize_into(buf)
+        buf += _U64.pack(self.nNonce)
+        buf += ser_string(self.strSubVer)
+        buf += _I32.pack(self.nStartingHeight)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<Q", self.nServices)
-        r += struct.pack("<q", self.nTime)
-        r += self.addrTo.serialize()
-        r += self.addrFrom.serialize()
-        r += struct.pack("<Q", self.nNonce)
-        r += ser_string(self.strSubVer)
-        r += struct.pack("<i", self.nStartingHeight)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return 'msg_version(nVersion=%i nServices=%i nTime=%s addrTo=%s addrFrom=%s nNonce=0x%016X strSubVer=%s nStartingHeight=%i)' \
@@ -751,8 +1255,11 @@ class msg_verack(object):
     def deserialize(self, f):
         pass
 
+    def serialize_into(self, buf):
+        return buf
+
     def serialize(self):
-        return b""
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_verack()"
@@ -767,8 +1274,11 @@ class msg_addr(object):
     def deserialize(self, f):
         self.addrs = deser_vector(f, CAddress)
 
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.addrs)
+
     def serialize(self):
-        return ser_vector(self.addrs)
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_addr(addrs=%s)" % (repr(self.addrs))
@@ -784,10 +1294,12 @@ class msg_alert(object):
         self.alert = CAlert()
         self.alert.deserialize(f)
 
+    def serialize_into(self, buf):
+        self.alert.serialize_into(buf)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += self.alert.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_alert(alert=%s)" % (repr(self.alert), )
@@ -805,8 +1317,11 @@ class msg_inv(object):
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.inv)
+
     def serialize(self):
-        return ser_vector(self.inv)
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_inv(inv=%s)" % (repr(self.inv))
@@ -826,8 +1341,11 @@ class msg_getdata(object):
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.inv)
+
     def serialize(self):
-        return ser_vector(self.inv)
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_getdata(inv=%s)" % (repr(self.inv))
@@ -845,11 +1363,13 @@ class msg_getblocks(object):
         self.locator.deserialize(f)
         self.hashstop = deser_uint256(f)
 
+    def serialize_into(self, buf):
+        self.locator.serialize_into(buf)
+        buf += ser_uint256(self.hashstop)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_getblocks(locator=%s hashstop=%064x)" \
@@ -865,8 +1385,11 @@ class msg_tx(object):
     def deserialize(self, f):
         self.tx.deserialize(f)
 
+    def serialize_into(self, buf):
+        return self.tx.serialize_into(buf)
+
     def serialize(self):
-        return self.tx.serialize()
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_tx(tx=%s)" % (repr(self.tx))
@@ -884,8 +1407,11 @@ class msg_block(object):
     def deserialize(self, f):
         self.block.deserialize(f)
 
+    def serialize_into(self, buf):
+        return self.block.serialize_into(buf)
+
     def serialize(self):
-        return self.block.serialize()
+        return bytes(self.serialize_into(bytearray()))
 
     def __str__(self):
         return "msg_block(block=%s)" % (str(self.block))
@@ -894,6 +1420,24 @@ class msg_block(object):
         return "msg_block(block=%s)" % (repr(self.block))
 
 
+class msg_serialized(object):
+    """A message whose payload was serialized ahead of time, for sending the
+    same block or transaction to many peers without encoding or hashing it
+    again.  obj is the decoded object, only kept for __repr__."""
+
+    def __init__(self, command, data, obj=None):
+        self.command = command
+        self.data = bytes(data)
+        self.checksum = hash256(self.data)[:4]
+        self.obj = obj
+
+    def serialize(self):
+        return self.data
+
+    def __repr__(self):
+        return "msg_serialized(command=%s obj=%s)" % (self.command, repr(self.obj))
+
+
 class msg_getaddr(object):
     command = b"getaddr"
 
@@ -903,8 +1447,11 @@ class msg_getaddr(object):
     def deserialize(self, f):
         pass
 
+    def serialize_into(self, buf):
+        return buf
+
     def serialize(self):
-        return b""
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_getaddr()"
@@ -919,8 +1466,11 @@ class msg_ping_prebip31(object):
     def deserialize(self, f):
         pass
 
+    def serialize_into(self, buf):
+        return buf
+
     def serialize(self):
-        return b""
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_ping() (pre-bip31)"
@@ -933,12 +1483,14 @@ class msg_ping(object):
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = read_struct(f, _U64)[0]
+
+    def serialize_into(self, buf):
+        buf += _U64.pack(self.nonce)
+        return buf
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
@@ -951,12 +1503,14 @@ class msg_pong(object):
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = read_struct(f, _U64)[0]
+
+    def serialize_into(self, buf):
+        buf += _U64.pack(self.nonce)
+        return buf
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
@@ -971,8 +1525,11 @@ class msg_mempool(object):
     def deserialize(self, f):
         pass
 
+    def serialize_into(self, buf):
+        return buf
+
     def serialize(self):
-        return b""
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_mempool()"
@@ -987,8 +1544,11 @@ class msg_sendheaders(object):
     def deserialize(self, f):
         pass
 
+    def serialize_into(self, buf):
+        return buf
+
     def serialize(self):
-        return b""
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_sendheaders()"
@@ -1012,11 +1572,13 @@ class msg_getheaders(object):
         self.locator.deserialize(f)
         self.hashstop = deser_uint256(f)
 
+    def serialize_into(self, buf):
+        self.locator.serialize_into(buf)
+        buf += ser_uint256(self.hashstop)
+        return buf
+
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_getheaders(locator=%s, stop=%064x)" \
@@ -1039,9 +1601,16 @@ class msg_headers(object):
         for x in blocks:
             self.headers.append(CBlockHeader(x))
 
+    def serialize_into(self, buf):
+        # headers go on the wire as blocks with an empty transaction vector
+        buf += ser_compact_size(len(self.headers))
+        for x in self.headers:
+            CBlockHeader.serialize_into(x, buf)
+            buf += b"\x00"
+        return buf
+
     def serialize(self):
-        blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_headers(headers=%s)" % repr(self.headers)
@@ -1059,20 +1628,23 @@ class msg_reject(object):
 
     def deserialize(self, f):
         self.message = deser_string(f)
-        self.code = struct.unpack("<B", f.read(1))[0]
+        self.code = read_struct(f, _U8)[0]
         self.reason = deser_string(f)
         if (self.code != self.REJECT_MALFORMED and
                 (self.message == b"block" or self.message == b"tx")):
             self.data = deser_uint256(f)
 
-    def serialize(self):
-        r = ser_string(self.message)
-        r += struct.pack("<B", self.code)
-        r += ser_string(self.reason)
+    def serialize_into(self, buf):
+        buf += ser_string(self.message)
+        buf += _U8.pack(self.code)
+        buf += ser_string(self.reason)
         if (self.code != self.REJECT_MALFORMED and
                 (self.message == b"block" or self.message == b"tx")):
-            r += ser_uint256(self.data)
-        return r
+            buf += ser_uint256(self.data)
+        return buf
+
+    def serialize(self):
+        return bytes(self.serialize_into(bytearray()))
 
     def __repr__(self):
         return "msg_reject: %s %d %s [%064x]" \
@@ -17,6 +17,7 @@ Functionality to build scripts, as well as SignatureHash().
 
 from .mininode import CTransaction, CTxOut, hash256
 from binascii import hexlify
+import hashlib
 
 import sys
 bchr = chr
@@ -30,6 +31,9 @@ import struct
 
 from .bignum import bn2vch
 
+def hash160(s):
+    return hashlib.new('ripemd160', hashlib.sha256(s).digest()).digest()
+
 MAX_SCRIPT_SIZE = 10000
 MAX_SCRIPT_ELEMENT_SIZE = 520
 MAX_SCRIPT_OPCODES = 201
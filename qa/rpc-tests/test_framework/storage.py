@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Unlimited developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Key/value storage for BlockStore and TxStore
+
+Keys are block or transaction hashes (ints), values the serialized objects.
+Every backend offers put(key, value), get(key) (None if absent), `key in`,
+and close():
+
+    memory  a dict; nothing reaches the disk, for short tests
+    ndbm    dbm.ndbm, the original store; not in every Python build and
+            slow (or limited in value size) for multi-MB blocks
+    sqlite  one table in an sqlite database in WAL mode
+    log     an append-only file of records with an index of offsets, read
+            through mmap; the index is rebuilt by scanning the file when
+            it is opened again
+
+open_storage(name, path) opens one by name; DEFAULT_BACKEND is ndbm where it
+exists, as before, otherwise log.
+
+>>> import os, tempfile
+>>> d = tempfile.mkdtemp()
+>>> for name in sorted(available_backends()):
+...     db = open_storage(name, os.path.join(d, name))
+...     db.put(1 << 200, b"block")
+...     db.put(7, b"tx" * 1000)
+...     assert db.get(1 << 200) == b"block" and len(db.get(7)) == 2000, name
+...     assert 7 in db and db.get(8) is None and 8 not in db, name
+...     db.close()
+>>> db = LogStorage(os.path.join(d, "log"))
+>>> db.get(1 << 200)
+b'block'
+>>> db.close()
+
+A record cut short (say by a crash) is dropped when the log is opened again:
+
+>>> with open(os.path.join(d, "log.log"), "ab") as f:
+...     _ = f.write(b"\x05" * 50)
+>>> db = LogStorage(os.path.join(d, "log"))
+>>> db.put(9, b"after")
+>>> db.close()
+>>> db = LogStorage(os.path.join(d, "log"))
+>>> db.get(9), db.get(7) is not None
+(b'after', True)
+>>> db.close()
+"""
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import dbm.ndbm
+except ImportError:  # Python built without ndbm
+    ndbm = None
+else:
+    ndbm = dbm.ndbm
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+class MemoryStorage(object):
+    def __init__(self, path=None):
+        self.db = {}
+
+    def put(self, key, value):
+        self.db[key] = bytes(value)
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def __contains__(self, key):
+        return key in self.db
+
+    def close(self):
+        self.db = {}
+
+
+class NdbmStorage(object):
+    def __init__(self, path):
+        if ndbm is None:
+            raise RuntimeError("this Python has no dbm.ndbm, choose another storage backend")
+        self.db = ndbm.open(path, 'c')
+
+    # keys are repr(hash), as in the stores written before the other backends
+    def put(self, key, value):
+        self.db[repr(key)] = bytes(value)
+
+    def get(self, key):
+        try:
+            return self.db[repr(key)]
+        except KeyError:
+            return None
+
+    def __contains__(self, key):
+        return repr(key) in self.db
+
+    def close(self):
+        self.db.close()
+
+
+def key_bytes(key):
+    return key.to_bytes(32, "little")
+
+
+class SqliteStorage(object):
+    def __init__(self, path):
+        if sqlite3 is None:
+            raise RuntimeError("this Python has no sqlite3, choose another storage backend")
+        # the network thread reads while the test thread writes
+        self.db = sqlite3.connect(path + ".sqlite", check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects (hash BLOB PRIMARY KEY, data BLOB) WITHOUT ROWID")
+
+    def put(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?)", (key_bytes(key), bytes(value)))
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM objects WHERE hash = ?", (key_bytes(key),)).fetchone()
+        return row[0] if row is not None else None
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM objects WHERE hash = ?", (key_bytes(key),)).fetchone() is not None
+
+    def close(self):
+        self.db.close()
+
+
+# A log record is the 32 byte key, the length of the value and the value
+_LOG_RECORD = struct.Struct("<32sQ")
+
+
+class LogStorage(object):
+    def __init__(self, path):
+        self.file = open(path + ".log", "a+b")
+        self.lock = threading.Lock()
+        self.index = {}  # key: (offset of the value, length)
+        self.map = None
+        self.end = self.file.seek(0, os.SEEK_END)
+        self.remap()
+        offset = 0
+        while offset + _LOG_RECORD.size <= self.end:
+            key, length = _LOG_RECORD.unpack_from(self.map, offset)
+            if offset + _LOG_RECORD.size + length > self.end:
+                break
+            self.index[int.from_bytes(key, "little")] = (offset + _LOG_RECORD.size, length)
+            offset += _LOG_RECORD.size + length
+        if offset < self.end:
+            # the last record was cut short; drop it, or records appended
+            # after it would be lost when the file is scanned again
+            self.file.truncate(offset)
+            self.end = offset
+            self.remap()
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.flush()
+        if self.end:
+            self.map = mmap.mmap(self.file.fileno(), self.end, access=mmap.ACCESS_READ)
+
+    def put(self, key, value):
+        with self.lock:
+            self.file.write(_LOG_RECORD.pack(key_bytes(key), len(value)))
+            self.file.write(value)
+            self.index[key] = (self.end + _LOG_RECORD.size, len(value))
+            self.end += _LOG_RECORD.size + len(value)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            offset, length = entry
+            if self.map is None or offset + length > len(self.map):
+                self.remap()  # written since the file was last mapped
+            return self.map[offset:offset + length]
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.close()
+
+
+BACKENDS = {
+    "memory": MemoryStorage,
+    "ndbm": NdbmStorage,
+    "sqlite": SqliteStorage,
+    "log": LogStorage,
+}
+
+DEFAULT_BACKEND = "ndbm" if ndbm is not None else "log"
+
+
+def available_backends():
+    """Names of the backends this Python can open"""
+    return [name for name in BACKENDS
+            if not (name == "ndbm" and ndbm is None) and not (name == "sqlite" and sqlite3 is None)]
+
+
+def open_storage(backend, path):
+    """Open the backend called backend (None for DEFAULT_BACKEND) at path"""
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    try:
+        cls = BACKENDS[backend]
+    except KeyError:
+        raise ValueError("unknown storage backend %s, choose from %s" % (backend, ", ".join(sorted(BACKENDS))))
+    return cls(path)
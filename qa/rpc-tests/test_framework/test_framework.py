@@ -27,6 +27,7 @@ from .util import (
     enable_coverage,
     check_json_precision,
     initialize_chain_clean,
+    CACHE_DIR,
 )
 from .authproxy import AuthServiceProxy, JSONRPCException
 
@@ -249,6 +250,18 @@ class ComparisonTestFramework(BitcoinTestFramework):
         parser.add_option("--refbinary", dest="refbinary",
                           default=os.getenv("BITCOIND", "bitcoind"),
                           help="bitcoind binary to use for reference nodes (if any)")
+        parser.add_option("--storage", dest="storage", default=None,
+                          help="where comptool keeps blocks and transactions: memory, ndbm, sqlite or log"
+                               " (default: ndbm if this Python has it, otherwise log)")
+        parser.add_option("--pipeline", dest="pipeline", default=1, type="int",
+                          help="blocks comptool may have in flight at once, when each is expected to become"
+                               " the new tip, for tests that allow it (default: %default, at most 16)")
+        parser.add_option("--vector-cache", dest="vector_cache", default="",
+                          help="directory where comptool records the test vectors of generators that allow it,"
+                               " and replays them from on later runs, e.g. %s (default: off)"
+                               % os.path.join(CACHE_DIR, "comptool"))
+        parser.add_option("--vector-seed", dest="vector_seed", default=0, type="int",
+                          help="seed for the random module while test vectors are generated (default: %default)")
 
     def setup_chain(self,bitcoinConfDict=None, wallets=None):  # BU add config params
         print("Initializing test directory ", self.options.tmpdir)
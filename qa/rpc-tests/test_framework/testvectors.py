@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Unlimited developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+On-disk cache of the TestInstances a comptool test generator produces
+
+Generators such as p2p-fullblocktest.py build, sign and solve every block
+while the test runs.  With a TestVectorCache, TestManager records each
+TestInstance as the generator yields it, and a later run with the same
+generator source, random seed and starting chain replays the file instead
+of running the generator at all.
+
+Only generators that declare cache_test_vectors = True are cached: the
+generator must not depend on anything but its own code, the random module
+(which is seeded) and the hash of the best block when the test starts, and
+it must not act on the nodes, since a replay does not run it.  Even for
+those, nothing is cached unless the test is given a directory with
+--vector-cache (for example --vector-cache=cache/comptool).
+
+The file is a header (magic, format version, creation time) followed by one
+record per TestInstance: its sync flags and objects, each object being a
+kind (block, header or transaction), its hash as the generator had it, its
+serialization, the expected outcome and the optional tip to compare against.
+A trailer with the number of instances marks the file complete; files are
+written under a temporary name and renamed when the generator is done.
+
+Generators stamp their blocks with the time they run, so a file is only
+replayed for MAX_AGE seconds after it was recorded.  After that its tip would
+be older than the node's maximum tip age, and the node would treat the whole
+test as initial block download; the file is recorded again instead.
+
+>>> import tempfile
+>>> class Gen(object):
+...     cache_test_vectors = True
+...     def get_tests(self):
+...         tx = CTransaction()
+...         tx.vout.append(CTxOut(random.randint(1, 1000), b"\\x51"))
+...         tx.rehash()
+...         block = CBlock()
+...         block.vtx.append(tx)
+...         block.rehash()
+...         yield TestInstance([[block, True], [CBlockHeader(block), None]])
+...         yield TestInstance([[tx, RejectResult(16, b"bad")], [block, False, 5]], sync_every_block=False)
+>>> cache = TestVectorCache(tempfile.mkdtemp(), seed=1)
+>>> live = [describe(t) for t in cache.test_instances(Gen())]
+>>> os.path.exists(cache.path(Gen()))
+True
+>>> replayed = [describe(t) for t in cache.test_instances(Gen())]  # doctest: +ELLIPSIS
+Replaying test vectors from .../testvectors-....vec
+>>> replayed == live, cache.replayed
+(True, True)
+>>> replayed[1]
+(False, False, [('CTransaction', "16:b'bad'"), ('CBlock', False, 5)])
+
+A recording is not replayed once it is older than MAX_AGE:
+
+>>> cache.complete(cache.path(Gen())), cache.complete(cache.path(Gen()), max_age=0)
+(True, False)
+"""
+import hashlib
+import inspect
+import mmap
+import os
+import random
+import struct
+import time
+
+from .nodemessages import *
+from .comptool import TestInstance, RejectResult
+
+FORMAT_VERSION = 1
+MAGIC = b"CTVEC"
+_FILE_HEADER = struct.Struct("<5sBQ")
+_TRAILER = struct.Struct("<cI")
+
+# Kinds of object
+BLOCK = 0
+HEADER = 1
+TRANSACTION = 2
+
+# Outcomes
+OUTCOME_NONE = 0
+OUTCOME_TRUE = 1
+OUTCOME_FALSE = 2
+OUTCOME_REJECT = 3
+
+# Tip to compare against: not given, given as None, or a hash
+TIP_ABSENT = 0
+TIP_NONE = 1
+TIP_HASH = 2
+
+# How long after it was recorded a file is replayed, in seconds; well within
+# the node's default maximum tip age of 24 hours
+MAX_AGE = 12 * 60 * 60
+
+# Framework modules whose code shapes the generated objects; a change to any
+# of them invalidates every cached file
+SOURCE_MODULES = ["blocktools.py", "script.py", "nodemessages.py", "key.py", "testvectors.py"]
+
+
+def describe(test_instance):
+    """Summary of a TestInstance that two equivalent instances share"""
+    objs = []
+    for test_obj in test_instance.blocks_and_transactions:
+        outcome = test_obj[1]
+        if isinstance(outcome, RejectResult):
+            outcome = repr(outcome)
+        objs.append((type(test_obj[0]).__name__, outcome) + tuple(test_obj[2:]))
+    return (test_instance.sync_every_block, test_instance.sync_every_tx, objs)
+
+
+def write_instance(f, test_instance):
+    flags = (1 if test_instance.sync_every_block else 0) | (2 if test_instance.sync_every_tx else 0)
+    buf = bytearray(b"I")
+    buf += struct.pack("<B", flags)
+    buf += ser_compact_size(len(test_instance.blocks_and_transactions))
+    for test_obj in test_instance.blocks_and_transactions:
+        obj, outcome = test_obj[0], test_obj[1]
+        if isinstance(obj, CBlock):
+            kind = BLOCK
+        elif isinstance(obj, CBlockHeader):
+            kind = HEADER
+        else:
+            kind = TRANSACTION
+        buf += struct.pack("<B", kind)
+        obj.calc_sha256()
+        buf += ser_uint256(obj.sha256)
+        if kind == HEADER:
+            CBlockHeader.serialize_into(obj, buf)
+        else:
+            obj.serialize_into(buf)
+        if outcome is None:
+            buf += struct.pack("<B", OUTCOME_NONE)
+        elif isinstance(outcome, RejectResult):
+            buf += struct.pack("<BB", OUTCOME_REJECT, outcome.code)
+            buf += ser_string(outcome.reason)
+        else:
+            buf += struct.pack("<B", OUTCOME_TRUE if outcome else OUTCOME_FALSE)
+        if len(test_obj) < 3:
+            buf += struct.pack("<B", TIP_ABSENT)
+        elif test_obj[2] is None:
+            buf += struct.pack("<B", TIP_NONE)
+        else:
+            buf += struct.pack("<B", TIP_HASH)
+            buf += ser_uint256(test_obj[2])
+    f.write(buf)
+
+
+def read_instance(f):
+    flags = f.read(1)[0]
+    objects = []
+    for i in range(deser_compact_size(f)):
+        kind = f.read(1)[0]
+        sha256 = deser_uint256(f)
+        obj = {BLOCK: CBlock, HEADER: CBlockHeader, TRANSACTION: CTransaction}[kind]()
+        obj.deserialize(f)
+        obj.calc_sha256()
+        # the hash the generator had, even if it forgot to rehash after a change
+        obj.sha256 = sha256
+        outcome_kind = f.read(1)[0]
+        if outcome_kind == OUTCOME_NONE:
+            outcome = None
+        elif outcome_kind == OUTCOME_REJECT:
+            code = f.read(1)[0]
+            outcome = RejectResult(code, deser_string(f))
+        else:
+            outcome = outcome_kind == OUTCOME_TRUE
+        test_obj = [obj, outcome]
+        tip_kind = f.read(1)[0]
+        if tip_kind == TIP_NONE:
+            test_obj.append(None)
+        elif tip_kind == TIP_HASH:
+            test_obj.append(deser_uint256(f))
+        objects.append(test_obj)
+    return TestInstance(objects, sync_every_block=bool(flags & 1), sync_every_tx=bool(flags & 2))
+
+
+class TestVectorCache(object):
+    """Directory of recorded test vectors, see the module documentation"""
+    def __init__(self, directory, seed=0):
+        self.directory = directory
+        self.seed = seed
+        self.replayed = None  # whether the last test_instances() came from a file
+
+    def key(self, testgen):
+        h = hashlib.sha256()
+        h.update(struct.pack("<BQ", FORMAT_VERSION, self.seed))
+        with open(inspect.getsourcefile(type(testgen)), "rb") as f:
+            h.update(f.read())
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in SOURCE_MODULES:
+            with open(os.path.join(here, name), "rb") as f:
+                h.update(f.read())
+        nodes = getattr(testgen, "nodes", None)
+        if nodes:
+            # the generator builds on the chain the nodes start with
+            h.update(nodes[0].getbestblockhash().encode())
+        return h.hexdigest()
+
+    def path(self, testgen):
+        name = os.path.splitext(os.path.basename(inspect.getsourcefile(type(testgen))))[0]
+        return os.path.join(self.directory, "%s-%s.vec" % (name, self.key(testgen)[:32]))
+
+    def test_instances(self, testgen):
+        """The TestInstances of testgen, replayed from the cache or generated and recorded"""
+        path = self.path(testgen)
+        if self.complete(path):
+            print("Replaying test vectors from %s" % path)
+            self.replayed = True
+            return self.replay(path)
+        self.replayed = False
+        return self.record(testgen, path)
+
+    @staticmethod
+    def complete(path, max_age=MAX_AGE):
+        """Whether path holds a finished recording made less than max_age seconds ago"""
+        try:
+            with open(path, "rb") as f:
+                magic, version, created = _FILE_HEADER.unpack(f.read(_FILE_HEADER.size))
+                if (magic, version) != (MAGIC, FORMAT_VERSION) or not 0 <= time.time() - created < max_age:
+                    return False
+                f.seek(-_TRAILER.size, os.SEEK_END)
+                return _TRAILER.unpack(f.read(_TRAILER.size))[0] == b"E"
+        except (OSError, struct.error):
+            return False
+
+    @staticmethod
+    def replay(path):
+        with open(path, "rb") as fd:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        f = BufferReader(data)
+        try:
+            f.read(_FILE_HEADER.size)
+            count = 0
+            while True:
+                kind = f.read(1)
+                if kind != b"I":
+                    break
+                yield read_instance(f)
+                count += 1
+            if kind + f.read(_TRAILER.size - 1) != _TRAILER.pack(b"E", count):
+                raise ValueError("%s is corrupt: replayed %d test instances, not the recorded number" % (path, count))
+        finally:
+            f.view.release()  # deserialized objects hold copies, not views
+            data.close()
+
+    def record(self, testgen, path):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = "%s.tmp%d" % (path, os.getpid())
+        count = 0
+        random.seed(self.seed)
+        with open(tmp, "wb") as f:
+            f.write(_FILE_HEADER.pack(MAGIC, FORMAT_VERSION, int(time.time())))
+            try:
+                for test_instance in testgen.get_tests():
+                    # recorded before TestManager runs it, since generators
+                    # change blocks they have already yielded
+                    write_instance(f, test_instance)
+                    count += 1
+                    yield test_instance
+                f.write(_TRAILER.pack(b"E", count))
+            except:
+                f.close()
+                os.remove(tmp)
+                raise
+        os.replace(tmp, path)
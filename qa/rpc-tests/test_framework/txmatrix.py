@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Unlimited developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""
+Transactions built and signed offline, for benchmarks that sweep the shape
+of a transaction (see txPerf.py --matrix)
+
+A MatrixSigner holds the keys for a few kinds of output script.  It makes the
+scriptPubKey of each kind, so that a node's wallet can fund outputs of that
+kind, and signs transactions spending them with any sighash type, without
+asking the node to sign:
+
+    signer = MatrixSigner()
+    tx = spending_transaction([(txid, n, amount), ...], signer.script_pubkey("p2pkh"), 10, fee)
+    signer.sign(tx, "p2pkh", SIGHASH_SINGLE | SIGHASH_ANYONECANPAY)
+    node.sendrawtransaction(tx_hex(tx))
+
+>>> signer = MatrixSigner()
+>>> prevouts = [(0x1234, n, 100000) for n in range(3)]
+>>> for script_type in SCRIPT_TYPES:
+...     for name, hashtype in SIGHASH_TYPES:
+...         tx = spending_transaction(prevouts, signer.script_pubkey(script_type), 2, 1000)
+...         assert signer.sign(tx, script_type, hashtype) is tx
+...         assert all(signer.verify(tx, i, script_type) for i in range(len(tx.vin))), (script_type, name)
+>>> [o.nValue for o in tx.vout]
+[149500, 149500]
+>>> [len(signer.signing_keys(t)) for t in SCRIPT_TYPES]
+[1, 1, 2]
+>>> len(list(cells([1, 10], [1], ["ALL", "NONE"], ["p2pkh"])))
+4
+"""
+import itertools
+from binascii import hexlify
+
+from .key import CECKey
+from .nodemessages import COutPoint, CTxIn, CTxOut, CTransaction, hash256
+from .script import *
+
+# The kinds of output script that can be signed for; p2sh is a 2 of 3 multisig
+SCRIPT_TYPES = ["p2pkh", "p2pk", "p2sh"]
+
+SIGHASH_TYPES = [
+    ("ALL", SIGHASH_ALL),
+    ("NONE", SIGHASH_NONE),
+    ("SINGLE", SIGHASH_SINGLE),
+    ("ALL|ANYONECANPAY", SIGHASH_ALL | SIGHASH_ANYONECANPAY),
+    ("NONE|ANYONECANPAY", SIGHASH_NONE | SIGHASH_ANYONECANPAY),
+    ("SINGLE|ANYONECANPAY", SIGHASH_SINGLE | SIGHASH_ANYONECANPAY),
+]
+
+# Rough serialized size in bytes of an input spending each script type, and
+# of an output, for estimating fees before the transaction is signed
+INPUT_SIZE = {"p2pkh": 150, "p2pk": 115, "p2sh": 300}
+OUTPUT_SIZE = 40
+TX_OVERHEAD = 10
+
+
+def estimated_size(script_type, inputs, outputs):
+    return TX_OVERHEAD + inputs * INPUT_SIZE[script_type] + outputs * OUTPUT_SIZE
+
+
+def cells(inputs, outputs, sighashes=None, script_types=None):
+    """Every (inputs, outputs, sighash name, script type) combination to measure"""
+    if sighashes is None:
+        sighashes = [name for name, hashtype in SIGHASH_TYPES]
+    if script_types is None:
+        script_types = SCRIPT_TYPES
+    return itertools.product(inputs, outputs, sighashes, script_types)
+
+
+def sighash_type(name):
+    return dict(SIGHASH_TYPES)[name]
+
+
+def tx_hex(tx):
+    return hexlify(tx.serialize()).decode("ascii")
+
+
+class MatrixSigner(object):
+    """Keys for every script type in SCRIPT_TYPES, and the scripts that use them"""
+    def __init__(self, seed=b"txmatrix"):
+        self.keys = []
+        for i in range(3):
+            k = CECKey()
+            k.set_secretbytes(hash256(seed + bytes([i])))
+            k.set_compressed(True)
+            self.keys.append(k)
+        self.pubkeys = [k.get_pubkey() for k in self.keys]
+        self.redeem_script = CScript([OP_2] + self.pubkeys + [OP_3, OP_CHECKMULTISIG])
+
+    def script_pubkey(self, script_type):
+        if script_type == "p2pkh":
+            return CScript([OP_DUP, OP_HASH160, hash160(self.pubkeys[0]), OP_EQUALVERIFY, OP_CHECKSIG])
+        if script_type == "p2pk":
+            return CScript([self.pubkeys[0], OP_CHECKSIG])
+        if script_type == "p2sh":
+            return CScript([OP_HASH160, hash160(self.redeem_script), OP_EQUAL])
+        raise ValueError("unknown script type %s" % script_type)
+
+    def script_code(self, script_type):
+        """The script whose signature hash the signatures commit to"""
+        if script_type == "p2sh":
+            return self.redeem_script
+        return self.script_pubkey(script_type)
+
+    def signing_keys(self, script_type):
+        """The keys whose signatures a script_type input needs: one, or 2 of 3 for p2sh"""
+        if script_type == "p2sh":
+            return self.keys[:2]
+        return self.keys[:1]
+
+    def sign(self, tx, script_type, hashtype):
+        """Sign every input of tx, all of which spend script_type outputs"""
+        script_code = self.script_code(script_type)
+        for i, txin in enumerate(tx.vin):
+            # SIGHASH_SINGLE on an input without a matching output signs the
+            # hash 1 (the "SIGHASH_SINGLE bug"), which the node accepts too
+            h, err = SignatureHash(script_code, tx, i, hashtype)
+            sigs = [k.sign(h, low_s=True) + bytes([hashtype]) for k in self.signing_keys(script_type)]
+            if script_type == "p2pkh":
+                txin.scriptSig = CScript([sigs[0], self.pubkeys[0]])
+            elif script_type == "p2pk":
+                txin.scriptSig = CScript([sigs[0]])
+            else:
+                txin.scriptSig = CScript([OP_0, sigs[0], sigs[1], self.redeem_script])
+        tx.rehash()
+        return tx
+
+    def verify(self, tx, i, script_type):
+        """Check the signatures of input i (only the ones this signer made)"""
+        items = list(CScript(tx.vin[i].scriptSig))
+        sigs = [items[0]] if script_type != "p2sh" else items[1:3]
+        for sig, k in zip(sigs, self.signing_keys(script_type)):
+            h, err = SignatureHash(self.script_code(script_type), tx, i, sig[-1])
+            if not k.verify(h, sig[:-1]):
+                return False
+        return True
+
+
+def spending_transaction(prevouts, script_pubkey, outputs, fee):
+    """
+    An unsigned transaction spending prevouts, a list of (txid, n, satoshis),
+    into outputs equal outputs paying to script_pubkey
+    """
+    tx = CTransaction()
+    tx.vin = [CTxIn(COutPoint(txid if isinstance(txid, int) else int(txid, 16), n), b"", 0xffffffff)
+              for txid, n, amount in prevouts]
+    each = (sum(amount for txid, n, amount in prevouts) - fee) // outputs
+    tx.vout = [CTxOut(each, script_pubkey) for i in range(outputs)]
+    return tx
@@ -26,10 +26,12 @@ import time
 import re
 import urllib.parse as urlparse
 import errno
+import hashlib
 import logging
 
 from . import coverage
 from .authproxy import AuthServiceProxy, JSONRPCException
+from .asyncproxy import rpc_all
 
 COVERAGE_DIR = None
 
@@ -92,10 +94,19 @@ def get_rpc_proxy(url, node_number, timeout=None):
     return coverage.AuthServiceProxyWrapper(proxy, coverage_logfile)
 
 
+# Environment variable through which qa/pull-tester/rpc-tests.py gives each
+# test it runs in parallel a range of ports of its own
+PORT_OFFSET_ENV = "RPC_TESTS_PORT_OFFSET"
+
 def p2p_port(n):
     #If port is already defined then return port
     if os.getenv("node" + str(n)):
         return int(os.getenv("node" + str(n)))
+    #If the test runner assigned us a port range, use it
+    if os.getenv(PORT_OFFSET_ENV):
+        port = 11000 + int(os.getenv(PORT_OFFSET_ENV)) + n
+        os.environ["node" + str(n)] = str(port)
+        return port
     #If no port defined then find an available port
     if n == 0:
         port = 11000 + n + os.getpid()%990
@@ -116,6 +127,11 @@ def rpc_port(n):
     #If port is already defined then return port
     if os.getenv("rpcnode" + str(n)):
         return int(os.getenv("rpcnode" + str(n)))
+    #If the test runner assigned us a port range, use it
+    if os.getenv(PORT_OFFSET_ENV):
+        port = 12000 + int(os.getenv(PORT_OFFSET_ENV)) + n
+        os.environ["rpcnode" + str(n)] = str(port)
+        return port
     #If no port defined then find an available port
     if n == 0:
         port = 12000 + n + os.getpid()%990
@@ -151,37 +167,159 @@ def hex_str_to_bytes(hex_str):
 def str_to_b64str(string):
     return b64encode(string.encode('utf-8')).decode('ascii')
 
-def sync_blocks(rpc_connections, wait=1,verbose=1):
+# sync_blocks and sync_mempools check again after this many seconds, then
+# back off exponentially up to their wait argument
+SYNC_FIRST_WAIT = 0.005
+
+# sync_blocks and sync_mempools give up after this many seconds by default
+SYNC_TIMEOUT = 300
+
+# SyncNotifier used by sync_blocks and sync_mempools when they are not given one
+sync_notifier = None
+
+def zmq_port(n):
+    """Port for node n's ZMQ notifications (see zmq_sync_args)"""
+    return rpc_port(n) + 1000
+
+def zmq_sync_args(n):
+    """bitcoind arguments that publish node n's hashblock and hashtx notifications"""
+    return ["-zmqpubhashblock=tcp://127.0.0.1:%d" % zmq_port(n),
+            "-zmqpubhashtx=tcp://127.0.0.1:%d" % zmq_port(n)]
+
+class SyncNotifier(object):
     """
-    Wait until everybody has the same block count
+    Subscribes to the hashblock and hashtx ZMQ notifications of some nodes
+    (started with zmq_sync_args), so that sync_blocks and sync_mempools wake up
+    as soon as a chain or mempool changes instead of sleeping.  Needs pyzmq,
+    unless an already connected subscriber socket is passed in.
+
+    Here a stub subscriber stands in for the ZMQ socket: the first time
+    sync_blocks waits, the lagging node catches up and announces its new tip,
+    and sync_blocks returns without sleeping out the interval.
+
+    >>> class StubNode(object):
+    ...     def __init__(self, tip): self.tip = tip
+    ...     def getbestblockhash(self): return self.tip
+    >>> a, b = StubNode("a1"), StubNode("b0")
+    >>> class StubSubscriber(object):
+    ...     def __init__(self): self.polls, self.queue = [], []
+    ...     def poll(self, ms):
+    ...         self.polls.append(ms)
+    ...         if ms:
+    ...             b.tip = a.tip
+    ...             self.queue.append([b"hashblock", b"a1", b"seq"])
+    ...         return len(self.queue)
+    ...     def recv_multipart(self): return self.queue.pop()
+    >>> notifier = SyncNotifier([], socket=StubSubscriber())
+    >>> sync_blocks([a, b], wait=60, verbose=0, notifier=notifier)
+    >>> notifier.socket.polls
+    [5.0, 0, 0]
+
+    Nodes that never agree make sync_blocks fail with their tips:
+
+    >>> b.tip = "b2"
+    >>> sync_blocks([a, b], verbose=0, timeout=0.05)
+    Traceback (most recent call last):
+      ...
+    AssertionError: sync_blocks timed out after 0.05s, tips: ['a1', 'b2']
     """
+    def __init__(self, node_numbers, socket=None):
+        self.context = None
+        self.socket = socket
+        if socket is None:
+            import zmq
+            self.context = zmq.Context()
+            self.socket = self.context.socket(zmq.SUB)
+            self.socket.setsockopt(zmq.SUBSCRIBE, b"hashblock")
+            self.socket.setsockopt(zmq.SUBSCRIBE, b"hashtx")
+            self.socket.linger = 0
+        for n in node_numbers:
+            self.socket.connect("tcp://127.0.0.1:%d" % zmq_port(n))
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for notifications, and consume all that
+        have arrived.  Returns True if there were any."""
+        if not self.socket.poll(timeout * 1000):
+            return False
+        while self.socket.poll(0):
+            self.socket.recv_multipart()
+        return True
+
+    def close(self):
+        self.socket.close()
+        if self.context is not None:
+            self.context.term()
+
+def enable_sync_notifications(node_numbers):
+    """Make sync_blocks and sync_mempools wake on the ZMQ notifications of these nodes"""
+    global sync_notifier
+    if sync_notifier is not None:
+        sync_notifier.close()
+    sync_notifier = SyncNotifier(node_numbers)
+    return sync_notifier
+
+def sync_waits(wait, first=SYNC_FIRST_WAIT):
+    """The intervals to wait between polls: first, doubling up to wait"""
+    interval = first
     while True:
-        counts = [ x.getblockcount() for x in rpc_connections ]
-        if verbose:
-            logging.info("sync blocks: " + str(counts))
-        if counts == [ counts[0] ]*len(counts):
+        yield min(interval, wait)
+        interval *= 2
+
+def sync_sleep(interval, notifier=None):
+    notifier = notifier or sync_notifier
+    if notifier is None:
+        time.sleep(interval)
+    else:
+        notifier.wait(interval)
+
+def sync_blocks(rpc_connections, wait=1, verbose=1, notifier=None, timeout=SYNC_TIMEOUT):
+    """
+    Wait until everybody has the same best block.  Polls the nodes again after
+    a few milliseconds, backing off to every wait seconds, and, given a
+    SyncNotifier (or after enable_sync_notifications), as soon as a node
+    announces a new block.  Raises AssertionError listing the tips if the
+    nodes still disagree after timeout seconds.
+    """
+    waits = sync_waits(wait)
+    deadline = time.time() + timeout
+    last = None
+    while True:
+        tips = rpc_all(rpc_connections, "getbestblockhash")
+        if verbose and tips != last:
+            logging.info("sync blocks: " + str([tip[-8:] for tip in tips]))
+        if tips == [ tips[0] ]*len(tips):
             break
-        time.sleep(wait)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise AssertionError("sync_blocks timed out after %ss, tips: %s" % (timeout, tips))
+        last = tips
+        sync_sleep(min(next(waits), remaining), notifier)
 
-def sync_mempools(rpc_connections, wait=1,verbose=1):
+def sync_mempools(rpc_connections, wait=1, verbose=1, notifier=None, timeout=SYNC_TIMEOUT):
     """
     Wait until everybody has the same transactions in their memory
-    pools
+    pools.  Only once the pools have the same number of transactions and
+    bytes are their txid lists fetched and compared.  Polls, wakes up and
+    times out like sync_blocks.
     """
+    waits = sync_waits(wait)
+    deadline = time.time() + timeout
+    last = None
     while True:
-        pool = set(rpc_connections[0].getrawmempool())
-        num_match = 1
-        poolLen = [len(pool)]
-        for i in range(1, len(rpc_connections)):
-            tmp = set(rpc_connections[i].getrawmempool())
-            if tmp == pool:
-                num_match = num_match+1
-            poolLen.append(len(tmp))
-        if verbose:
-            logging.info("sync mempool: " + str(poolLen))
-        if num_match == len(rpc_connections):
-            break
-        time.sleep(wait)
+        infos = rpc_all(rpc_connections, "getmempoolinfo")
+        digests = [(info["size"], info["bytes"]) for info in infos]
+        if verbose and digests != last:
+            logging.info("sync mempool: " + str([size for (size, nbytes) in digests]))
+        if digests == [ digests[0] ]*len(digests):
+            pools = rpc_all(rpc_connections, "getrawmempool")
+            pool = set(pools[0])
+            if all(set(p) == pool for p in pools[1:]):
+                break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise AssertionError("sync_mempools timed out after %ss, (size, bytes): %s" % (timeout, digests))
+        last = digests
+        sync_sleep(min(next(waits), remaining), notifier)
 
 bitcoind_processes = {}
 
@@ -214,92 +352,171 @@ def initialize_datadir(dirname, n,bitcoinConfDict=None,wallet=None):
 def rpc_url(i, rpchost=None):
     return "http://rt:rt@%s:%d" % (rpchost or '127.0.0.1', rpc_port(i))
 
+def bitcoind_started(process, url, i):
+    '''
+    Check once whether bitcoind has started, i.e. its RPC is accessible and fully initialized.
+    Raise an exception if bitcoind has exited.
+    '''
+    if process.poll() is not None:
+        raise Exception('bitcoind exited with status %i during initialization' % process.returncode)
+    try:
+        rpc = get_rpc_proxy(url, i)
+        blocks = rpc.getblockcount()
+        return True
+    except IOError as e:
+        if e.errno != errno.ECONNREFUSED: # Port not yet open?
+            raise # unknown IO error
+    except JSONRPCException as e: # Initialization phase
+        if e.error['code'] != -28: # RPC in warmup?
+            raise # unkown JSON RPC exception
+    return False
+
+def wait_for_bitcoinds_start(starting):
+    '''
+    Wait for several bitcoinds to start, polling all of them from one loop.
+    starting maps node number to (process, url).  If any fail, raise an
+    exception naming each of them and why, once the others are up.
+    '''
+    pending = dict(starting)
+    failures = {}
+    waits = sync_waits(0.25, 0.01)
+    while pending:
+        for i, (process, url) in sorted(pending.items()):
+            try:
+                if bitcoind_started(process, url, i):
+                    del pending[i]
+            except Exception as e:
+                failures[i] = e
+                del pending[i]
+        if pending:
+            time.sleep(next(waits))
+    if failures:
+        raise Exception("; ".join("node %d: %s" % (i, failures[i]) for i in sorted(failures)))
+
 def wait_for_bitcoind_start(process, url, i):
     '''
     Wait for bitcoind to start. This means that RPC is accessible and fully initialized.
     Raise an exception if bitcoind exits during initialization.
     '''
-    while True:
-        if process.poll() is not None:
-            raise Exception('bitcoind exited with status %i during initialization' % process.returncode)
+    wait_for_bitcoinds_start({i: (process, url)})
+
+# Directory holding the pre-mined chains, one subdirectory per cache_key()
+CACHE_DIR = "cache"
+
+# Bump to invalidate existing caches when the way they are built changes
+CACHE_VERSION = 1
+
+# Files that bitcoind never modifies in place (leveldb tables), so a test
+# datadir can hard link them from the cache instead of copying
+CACHE_IMMUTABLE_FILES = re.compile(r".*\.(ldb|sst)$")
+
+# Linux ioctl that makes a file share the data of another (copy-on-write)
+FICLONE = 0x40049409
+
+def cache_key(bitcoinConfDict=None, num_nodes=4, chain_length=200):
+    """
+    Name of the cache directory for a chain built with these parameters: a hash
+    of everything that goes into building it, so that different configurations
+    never share a cache
+    """
+    params = {"version": CACHE_VERSION, "conf": bitcoinConfDict or {},
+              "nodes": num_nodes, "length": chain_length}
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return "chain%d-%dnodes-%s" % (chain_length, num_nodes, digest[:16])
+
+def clone_file(src, dst):
+    """
+    Copy src to dst for a test datadir.  Files bitcoind only ever replaces are
+    hard linked; others are reflinked where the filesystem supports it
+    (btrfs, xfs), so no data is copied, and copied otherwise.
+    """
+    if CACHE_IMMUTABLE_FILES.match(os.path.basename(src)):
         try:
-            rpc = get_rpc_proxy(url, i)
-            blocks = rpc.getblockcount()
-            break # break out of loop on success
-        except IOError as e:
-            if e.errno != errno.ECONNREFUSED: # Port not yet open?
-                raise # unknown IO error
-        except JSONRPCException as e: # Initialization phase
-            if e.error['code'] != -28: # RPC in warmup?
-                raise # unkown JSON RPC exception
-        time.sleep(0.25)
-
-def initialize_chain(test_dir,bitcoinConfDict=None,wallets=None):
-    """
-    Create (or copy from cache) a 200-block-long chain and
-    4 wallets.
-    """
-
-    if (not os.path.isdir(os.path.join("cache","node0"))
-        or not os.path.isdir(os.path.join("cache","node1"))
-        or not os.path.isdir(os.path.join("cache","node2"))
-        or not os.path.isdir(os.path.join("cache","node3"))):
-
-        #find and delete old cache directories if any exist
-        for i in range(4):
-            if os.path.isdir(os.path.join("cache","node"+str(i))):
-                shutil.rmtree(os.path.join("cache","node"+str(i)))
-
-        # Create cache directories, run bitcoinds:
-        for i in range(4):
-            datadir=initialize_datadir("cache", i,bitcoinConfDict)
-            args = [ os.getenv("BITCOIND", "bitcoind"), "-keypool=1", "-datadir="+datadir ]
-            if i > 0:
-                args.append("-connect=127.0.0.1:"+str(p2p_port(0)))
-            bitcoind_processes[i] = subprocess.Popen(args)
-            if os.getenv("PYTHON_DEBUG", ""):
-                print("initialize_chain: bitcoind started, waiting for RPC to come up")
-            wait_for_bitcoind_start(bitcoind_processes[i], rpc_url(i), i)
-            if os.getenv("PYTHON_DEBUG", ""):
-                print("initialize_chain: RPC succesfully started")
-
-        rpcs = []
-        for i in range(4):
-            try:
-                rpcs.append(get_rpc_proxy(rpc_url(i), i))
-            except:
-                sys.stderr.write("Error connecting to "+url+"\n")
-                sys.exit(1)
-
-        # Create a 200-block-long chain; each of the 4 nodes
-        # gets 25 mature blocks and 25 immature.
-        # blocks are created with timestamps 10 minutes apart
-        # starting from 2010 minutes in the past
-        enable_mocktime()
-        block_time = get_mocktime() - (201 * 10 * 60)
-        for i in range(2):
-            for peer in range(4):
-                for j in range(25):
-                    set_node_times(rpcs, block_time)
-                    rpcs[peer].generate(1)
-                    block_time += 10*60
-                # Must sync before next peer starts generating blocks
-                sync_blocks(rpcs)
-
-        # Shut them down, and clean up cache directories:
-        stop_nodes(rpcs)
-        wait_bitcoinds()
-        disable_mocktime()
-        for i in range(4):
-            os.remove(log_filename("cache", i, "debug.log"))
-            os.remove(log_filename("cache", i, "db.log"))
-            os.remove(log_filename("cache", i, "peers.dat"))
-            os.remove(log_filename("cache", i, "fee_estimates.dat"))
-
-    for i in range(4):
-        from_dir = os.path.join("cache", "node"+str(i))
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    try:
+        import fcntl
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return dst
+    except (ImportError, OSError):
+        return shutil.copy2(src, dst)
+
+def build_chain_cache(cache_dir, bitcoinConfDict=None, num_nodes=4, chain_length=200):
+    """
+    Mine a chain_length block chain with num_nodes nodes and leave their
+    (stopped) datadirs in cache_dir
+    """
+    # Create cache directories, run bitcoinds:
+    for i in range(num_nodes):
+        datadir=initialize_datadir(cache_dir, i,bitcoinConfDict)
+        args = [ os.getenv("BITCOIND", "bitcoind"), "-keypool=1", "-datadir="+datadir ]
+        if i > 0:
+            args.append("-connect=127.0.0.1:"+str(p2p_port(0)))
+        bitcoind_processes[i] = subprocess.Popen(args)
+    if os.getenv("PYTHON_DEBUG", ""):
+        print("initialize_chain: bitcoinds started, waiting for RPC to come up")
+    wait_for_bitcoinds_start({ i: (bitcoind_processes[i], rpc_url(i)) for i in range(num_nodes) })
+    if os.getenv("PYTHON_DEBUG", ""):
+        print("initialize_chain: RPC succesfully started")
+
+    rpcs = [ get_rpc_proxy(rpc_url(i), i) for i in range(num_nodes) ]
+
+    # Create the chain in runs of 25 blocks, each mined by the next node in
+    # turn; with the default 4 nodes and 200 blocks each node gets 25 mature
+    # blocks and 25 immature.
+    # blocks are created with timestamps 10 minutes apart, the last one
+    # 10 minutes before the mocktime
+    enable_mocktime()
+    block_time = get_mocktime() - ((chain_length + 1) * 10 * 60)
+    for run, start in enumerate(range(0, chain_length, 25)):
+        peer = run % num_nodes
+        for j in range(min(25, chain_length - start)):
+            set_node_times(rpcs, block_time)
+            rpcs[peer].generate(1)
+            block_time += 10*60
+        # Must sync before next peer starts generating blocks
+        sync_blocks(rpcs)
+
+    # Shut them down, and clean up cache directories:
+    stop_nodes(rpcs)
+    wait_bitcoinds()
+    disable_mocktime()
+    for i in range(num_nodes):
+        for name in ("debug.log", "db.log", "peers.dat", "fee_estimates.dat"):
+            if os.path.exists(log_filename(cache_dir, i, name)):
+                os.remove(log_filename(cache_dir, i, name))
+
+def initialize_chain(test_dir,bitcoinConfDict=None,wallets=None,num_nodes=4,chain_length=200):
+    """
+    Create (or copy from cache) a chain_length (default 200) block long chain
+    and num_nodes (default 4) wallets.
+
+    Each combination of bitcoinConfDict, num_nodes and chain_length is mined
+    once and kept under CACHE_DIR.  The test datadirs share the cached
+    files where the filesystem allows (see clone_file), so only the first
+    test to use a configuration pays for it.
+    """
+    cache_dir = os.path.join(CACHE_DIR, cache_key(bitcoinConfDict, num_nodes, chain_length))
+    if not os.path.isdir(cache_dir):
+        # Build under a private name and rename it into place, so tests
+        # running at the same time never see a half built cache
+        build_dir = "%s.tmp%d" % (cache_dir, os.getpid())
+        if os.path.isdir(build_dir):
+            shutil.rmtree(build_dir)
+        build_chain_cache(build_dir, bitcoinConfDict, num_nodes, chain_length)
+        try:
+            os.rename(build_dir, cache_dir)
+        except OSError: # someone else built it first
+            shutil.rmtree(build_dir)
+
+    for i in range(num_nodes):
+        from_dir = os.path.join(cache_dir, "node"+str(i))
         to_dir = os.path.join(test_dir,  "node"+str(i))
-        shutil.copytree(from_dir, to_dir)
+        shutil.copytree(from_dir, to_dir, copy_function=clone_file)
         initialize_datadir(test_dir, i,bitcoinConfDict,wallets[i] if wallets else None) # Overwrite port/rpcport in bitcoin.conf
 
 def initialize_chain_clean(test_dir, num_nodes, bitcoinConfDict=None, wallets=None):
@@ -331,9 +548,9 @@ def _rpchost_to_args(rpchost):
         rv += ['-rpcport=' + rpcport]
     return rv
 
-def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None):
+def launch_bitcoind(i, dirname, extra_args=None, binary=None):
     """
-    Start a bitcoind and return RPC connection to it
+    Start a bitcoind process without waiting for it to come up
     """
     datadir = os.path.join(dirname, "node"+str(i))
     if binary is None:
@@ -342,12 +559,9 @@ def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=
     args = [ binary, "-datadir="+datadir, "-rest", "-mocktime="+str(get_mocktime()) ] # // BU removed, "-keypool=1","-blockprioritysize=50000" ]
     if extra_args is not None: args.extend(extra_args)
     bitcoind_processes[i] = subprocess.Popen(args)
-    if os.getenv("PYTHON_DEBUG", ""):
-        print("start_node: bitcoind started, waiting for RPC to come up")
-    url = rpc_url(i, rpchost)
-    wait_for_bitcoind_start(bitcoind_processes[i], url, i)
-    if os.getenv("PYTHON_DEBUG", ""):
-        print("start_node: RPC succesfully started")
+    return bitcoind_processes[i]
+
+def started_node_proxy(i, url, timewait=None):
     proxy = get_rpc_proxy(url, i, timeout=timewait)
 
     if COVERAGE_DIR:
@@ -355,20 +569,44 @@ def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=
 
     return proxy
 
+def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None):
+    """
+    Start a bitcoind and return RPC connection to it
+    """
+    process = launch_bitcoind(i, dirname, extra_args, binary)
+    if os.getenv("PYTHON_DEBUG", ""):
+        print("start_node: bitcoind started, waiting for RPC to come up")
+    url = rpc_url(i, rpchost)
+    wait_for_bitcoind_start(process, url, i)
+    if os.getenv("PYTHON_DEBUG", ""):
+        print("start_node: RPC succesfully started")
+    return started_node_proxy(i, url, timewait)
+
 def start_nodes(num_nodes, dirname, extra_args=None, rpchost=None, binary=None,timewait=None):
     """
-    Start multiple bitcoinds, return RPC connections to them
+    Start multiple bitcoinds, return RPC connections to them.  All are
+    launched at once and then waited for together, so this takes about as
+    long as the slowest node.
     """
     if extra_args is None: extra_args = [ None for i in range(num_nodes) ]
     if binary is None: binary = [ None for i in range(num_nodes) ]
-    rpcs = []
+    starting = {}
     try:
         for i in range(num_nodes):
-            rpcs.append(start_node(i, dirname, extra_args[i], rpchost, binary=binary[i],timewait=timewait))
-    except: # If one node failed to start, stop the others
-        stop_nodes(rpcs)
+            starting[i] = (launch_bitcoind(i, dirname, extra_args[i], binary[i]), rpc_url(i, rpchost))
+        if os.getenv("PYTHON_DEBUG", ""):
+            print("start_nodes: bitcoinds started, waiting for RPC to come up")
+        wait_for_bitcoinds_start(starting)
+        if os.getenv("PYTHON_DEBUG", ""):
+            print("start_nodes: RPC succesfully started")
+    except: # If a node failed to start, stop the others
+        running = [ i for i, (process, url) in sorted(starting.items()) if process.poll() is None ]
+        try:
+            stop_nodes([ get_rpc_proxy(starting[i][1], i) for i in running ])
+        except Exception as e:
+            print("start_nodes: could not stop all nodes: %s" % e)
         raise
-    return rpcs
+    return [ started_node_proxy(i, starting[i][1], timewait) for i in range(num_nodes) ]
 
 def log_filename(dirname, n_node, logname):
     return os.path.join(dirname, "node"+str(n_node), "regtest", logname)
@@ -379,9 +617,15 @@ def stop_node(node, i):
     del bitcoind_processes[i]
 
 def stop_nodes(nodes):
-    for node in nodes:
-        node.stop()
+    """
+    Ask all nodes to stop at once (wait_bitcoinds waits for them to exit).
+    Every node is asked even if some fail; those failures are then raised together.
+    """
+    results = rpc_all(nodes, "stop", return_exceptions=True)
     del nodes[:] # Emptying array closes connections as a side effect
+    failures = [ "nodes[%d]: %s" % (i, r) for i, r in enumerate(results) if isinstance(r, Exception) ]
+    if failures:
+        raise Exception("stop failed on " + "; ".join(failures))
 
 def set_node_times(nodes, t):
     for node in nodes:
@@ -691,6 +935,9 @@ def create_confirmed_utxos(fee, node, count):
     addr2 = node.getnewaddress()
     if iterations <= 0:
         return utxos
+    # The transactions spend distinct utxos, so each step is done for all of
+    # them in one batch of RPC calls
+    create = node.batch()
     for i in range(iterations):
         t = utxos.pop()
         inputs = []
@@ -699,9 +946,14 @@ def create_confirmed_utxos(fee, node, count):
         send_value = t['amount'] - fee
         outputs[addr1] = satoshi_round(send_value/2)
         outputs[addr2] = satoshi_round(send_value/2)
-        raw_tx = node.createrawtransaction(inputs, outputs)
-        signed_tx = node.signrawtransaction(raw_tx)["hex"]
-        txid = node.sendrawtransaction(signed_tx)
+        create.createrawtransaction(inputs, outputs)
+    sign = node.batch()
+    for raw_tx in create.results():
+        sign.signrawtransaction(raw_tx)
+    send = node.batch()
+    for signed_tx in sign.results():
+        send.sendrawtransaction(signed_tx["hex"])
+    send.results()
 
     while (node.getmempoolinfo()['size'] > 0):
         node.generate(1)
@@ -17,17 +17,44 @@ logging.basicConfig(format='%(asctime)s.%(levelname)s: %(message)s', level=loggi
 
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import *
+from test_framework.benchmark import Benchmark
+from test_framework.nodemessages import CTransaction, CTxOut
+from test_framework.txmatrix import *
+
+# Value of each output of the --matrix transactions, in satoshis (well above dust)
+MATRIX_OUTPUT_VALUE = 10000
 
 
 # Create one-input, one-output, no-fee transaction:
 class TransactionPerformanceTest(BitcoinTestFramework):
 
+    def add_options(self, parser):
+        parser.add_option("--benchout", dest="benchout", default="txPerf",
+                          help="Write the timings to BENCHOUT.json and BENCHOUT.csv (default: %default)")
+        parser.add_option("--baseline", dest="baseline", default=None,
+                          help="Compare the timings against this earlier BENCHOUT.json")
+        parser.add_option("--matrix", dest="matrix", default=False, action="store_true",
+                          help="Time transactions signed offline over every combination of the --matrix-* options")
+        parser.add_option("--matrix-inputs", dest="matrix_inputs", default="1,10,100,300",
+                          help="Comma separated input counts (default: %default)")
+        parser.add_option("--matrix-outputs", dest="matrix_outputs", default="1,10,100,300",
+                          help="Comma separated output counts (default: %default)")
+        parser.add_option("--matrix-sighash", dest="matrix_sighash", default=",".join(n for n, h in SIGHASH_TYPES),
+                          help="Comma separated sighash types (default: %default)")
+        parser.add_option("--matrix-scripts", dest="matrix_scripts", default=",".join(SCRIPT_TYPES),
+                          help="Comma separated script types (default: %default)")
+        parser.add_option("--matrix-sign-repetitions", dest="matrix_sign_repetitions", default=5, type="int",
+                          help="Times to sign each transaction; its signing time is the distribution of these (default: %default)")
+
     def setup_chain(self,bitcoinConfDict=None, wallets=None):
         logging.info("Initializing test directory "+self.options.tmpdir)
         initialize_chain_clean(self.options.tmpdir, 3, bitcoinConfDict, wallets)
 
     def setup_network(self, split=False):
-        self.nodes = start_nodes(3, self.options.tmpdir,timewait=60*60)
+        # In --matrix mode node 1 keeps no signature cache, so that it checks every
+        # signature of a block even though it already accepted the transactions
+        extra_args = [[], ["-maxsigcachesize=0"] if self.options.matrix else [], []]
+        self.nodes = start_nodes(3, self.options.tmpdir, extra_args, timewait=60*60)
 
         #connect to a local machine for debugging
         #url = "http://bitcoinrpc:DP6DvqZtqXarpeNWyN3LZTFchCCyCUuHwNF7E8pX99x1@%s:%d" % ('127.0.0.1', 18332)
@@ -47,54 +74,44 @@ class TransactionPerformanceTest(BitcoinTestFramework):
       if type(node) == type(0):  # Convert a node index to a node object
         node = self.nodes[node]
 
-      addrs = []
-      for i in range(0,count):
-        addr = node.getnewaddress()
-        addrs.append(addr)
-        node.sendtoaddress(addr, amt)
+      with node.batch() as b:
+        addrs = [b.getnewaddress() for i in range(0,count)]
+      send = node.batch()
+      for addr in addrs:
+        send.sendtoaddress(addr.result(), amt)
+      send.results()  # raises if any send failed
       node.generate(1)
       self.sync_all()
 
     def signingPerformance(self,node, inputs,outputs,skip=100):
-        fil = open("signPerf.csv","w")
-        logging.info("tx len, # inputs, # outputs, time")
-        print ("fieldNames = ['tx len', '# inputs', '# outputs', 'time']", file=fil)
-        print ("data = [", file=fil)
+        logging.info("tx len, # inputs, # outputs, median signing time")
         for i in range(0,len(inputs),skip):
           for j in range(0,len(outputs),skip):
+            if i==0: i=1
+            if j==0: j=1
             try:
-              if i==0: i=1
-              if j==0: j=1
               (txn,inp,outp,txid) = split_transaction(node, inputs[0:i], outputs[0:j], txfee=DEFAULT_TX_FEE_PER_BYTE*10, sendtx=False)
-            except e:
-              logging.info("%d, %d, %d, split error" % (txLen,len(inp),len(outp)))
-              print("[",txLen,",",len(inp),",",len(outp),",",'"split error:"', str(e),'"],', file=fil)
+            except Exception as e:
+              logging.info("%d, %d, split error: %s" % (i,j,str(e)))
+              self.bench.error("signrawtransaction", "split error: %s" % str(e), inputs=i, outputs=j)
               continue
+            s = str(txn)
             try:
-              s = str(txn)
-	      #print ("tx len: ", len(s))
-              start=time.time()
+              # the first signature gives the real size and warms up; signing
+              # does not change any state, so it can be repeated
               signedtxn = node.signrawtransaction(s)
-              end=time.time()
-              txLen = len(binascii.unhexlify(signedtxn["hex"]))  # Get the actual transaction size for better tx fee estimation the next time around
-              logging.info("%d, %d, %d, %f" % (txLen,len(inp),len(outp),end-start))
-              print("[",txLen,",",len(inp),",",len(outp),",",end-start,"],",file=fil)
-            except:
-              logging.info("%d, %d, %d, %s" % (txLen,len(inp),len(outp),'"timeout"'))
-              print (txLen,",",len(inp),",",len(outp),",","timeout")
-              print ("[",txLen,",",len(inp),",",len(outp),",",'"timeout"],',file=fil)
-            fil.flush()
-        print("]",file=fil)
-        fil.close()
+              txLen = len(binascii.unhexlify(signedtxn["hex"]))
+              r = self.bench.measure("signrawtransaction", lambda: node.signrawtransaction(s), warmup=0, repetitions=3,
+                                     txlen=txLen, inputs=len(inp), outputs=len(outp))
+              logging.info("%d, %d, %d, %f" % (txLen,len(inp),len(outp),r.stats()["median"]))
+            except Exception as e:
+              logging.info("%d, %d, %s" % (len(inp),len(outp),str(e)))
+              self.bench.error("signrawtransaction", e, inputs=len(inp), outputs=len(outp))
 
     def validatePerformance(self,node, inputCount,outputs,skip=100):
-        fil = open("validatePerf.csv","w")
-        print("tx len, # inputs, # outputs, time")
-        print ("fieldNames = ['tx len', '# inputs', '# outputs', 'time']",file=fil)
-        print ("data = [",file=fil)
         for i in range(0,inputCount,skip):
           for j in range(0,len(outputs),skip):
-            print("ITER: ", i, " x ", j)
+            logging.info("ITER: %d x %d" % (i, j))
             wallet = node.listunspent()
             wallet.sort(key=lambda x: x["amount"],reverse=True)
             while len(wallet) < i:  # Make a bunch more inputs
@@ -103,77 +120,122 @@ class TransactionPerformanceTest(BitcoinTestFramework):
               wallet = node.listunspent()
               wallet.sort(key=lambda x: x["amount"],reverse=True)
 
+            if i==0: i=1
+            if j==0: j=1
             try:
-              if i==0: i=1
-              if j==0: j=1
               (txn,inp,outp,txid) = split_transaction(node, wallet[0:i], outputs[0:j], txfee=DEFAULT_TX_FEE_PER_BYTE*10, sendtx=True)
-            except e:
+            except Exception as e:
               logging.info("split error: %s" % str(e))
-              print("[ 'sign',",0,",",i,",",j,",","'split error:", str(e),"'],",file=fil)
-              pdb.set_trace()
+              self.bench.error("generate", "split error: %s" % str(e), inputs=i, outputs=j)
               continue
 
             time.sleep(4) # give the transaction time to propagate so we generate tx validation data separately from block validation data
-            startTime = time.time()
-            node.generate(1)
-            elapsedTime = time.time() - startTime
-            logging.info("generate time: %f" % elapsedTime)
             txLen = len(binascii.unhexlify(txn))  # Get the actual transaction size for better tx fee estimation the next time around
-            print("[ 'gen',",txLen,",",len(inp),",",len(outp),",",elapsedTime,"],",file=fil)
-
-            startTime = time.time()
-            self.sync_all()
-            elapsedTime = time.time() - startTime
-            logging.info("Sync time: %f" % elapsedTime)
-            print("[ 'sync',",txLen,",",len(inp),",",len(outp),",",elapsedTime,"],",file=fil)
-            
-        print("]",file=fil)
-        fil.close()
-
+            # generating and syncing change the chain, so each is timed once
+            with self.bench.timer("generate", txlen=txLen, inputs=len(inp), outputs=len(outp)) as r:
+              node.generate(1)
+            logging.info("generate time: %f" % r.samples[-1])
+            with self.bench.timer("sync", txlen=txLen, inputs=len(inp), outputs=len(outp)) as r:
+              self.sync_all()
+            logging.info("Sync time: %f" % r.samples[-1])
+
+    def fundScript(self, node, script, count, satoshis):
+      """Confirm count outputs of satoshis each paying to script, funded by node's wallet.
+         Returns them as (txid, n, satoshis) prevouts"""
+      tx = CTransaction()
+      tx.vout = [CTxOut(satoshis, script) for i in range(count)]
+      funded = node.fundrawtransaction(tx_hex(tx))
+      signed = node.signrawtransaction(funded["hex"])
+      txid = node.sendrawtransaction(signed["hex"])
+      node.generate(1)
+      self.sync_all()
+      script_hex = hexlify(script).decode("ascii")
+      return [(txid, o["n"], satoshis) for o in node.decoderawtransaction(signed["hex"])["vout"]
+              if o["scriptPubKey"]["hex"] == script_hex]
+
+    def signatureMatrix(self, node, inputs, outputs, sighashes, script_types):
+      """Time the signing, acceptance (sendrawtransaction) and block validation of transactions
+         signed offline, for every combination of input count, output count, sighash type and script type.
+         This maps out where signature hashing grows quadratically with the size of the transaction."""
+      signer = MatrixSigner()
+      validator = self.nodes[1]
+      logging.info("inputs, outputs, sighash, script, tx len, sendrawtransaction, block sync")
+      for (nin, nout, sighash, script_type) in cells(inputs, outputs, sighashes, script_types):
+        cell = dict(inputs=nin, outputs=nout, sighash=sighash, script=script_type)
+        script = signer.script_pubkey(script_type)
+        fee = estimated_size(script_type, nin, nout) * DEFAULT_TX_FEE_PER_BYTE
+        try:
+          prevouts = self.fundScript(node, script, nin, (fee + nout * MATRIX_OUTPUT_VALUE) // nin + 1)
+        except JSONRPCException as e:
+          logging.info("%s: funding error: %s" % (cell, e.error["message"]))
+          self.bench.error("sendrawtransaction", "funding error: %s" % e.error["message"], **cell)
+          continue
+
+        tx = spending_transaction(prevouts, script, nout, fee)
+        hashtype = sighash_type(sighash)
+        signer.sign(tx, script_type, hashtype)  # the first signature gives the real size
+        params = dict(cell, txlen=len(tx.serialize()))
+        self.bench.measure("sign", lambda: signer.sign(tx, script_type, hashtype), warmup=0,
+                           repetitions=self.options.matrix_sign_repetitions, **params)
+        try:
+          with self.bench.timer("sendrawtransaction", **params) as send:
+            node.sendrawtransaction(tx_hex(tx))
+        except JSONRPCException as e:  # too big, too many sigops...
+          logging.info("%s: rejected: %s" % (params, e.error["message"]))
+          self.bench.error("sendrawtransaction", e.error["message"], **params)
+          continue
+        # let the validator accept the transaction first, so the block sync below times block validation only
+        sync_mempools([node, validator])
+        with self.bench.timer("generate", **params):
+          node.generate(1)
+        with self.bench.timer("block_sync", **params) as block:
+          sync_blocks([node, validator])
+        self.sync_all()
+        logging.info("%d, %d, %s, %s, %d, %f, %f" % (nin, nout, sighash, script_type, params["txlen"],
+                                                      send.samples[-1], block.samples[-1]))
 
     def largeOutput(self):
         """This times the validation of 1 to many and many to 1 transactions.  Its not needed to be run as a daily unit test"""
         print("synchronizing")
-        self.sync_all()    
-        node = self.nodes[0]        
-        start = time.time()
+        self.sync_all()
+        node = self.nodes[0]
         print("generating addresses")
-        if 1:
-          addrs = [ node.getnewaddress() for _ in range(20000)]
-          f = open("addrs.txt","w")
-          f.write(str(addrs))
-          f.close()
-          print("['Benchmark', 'generate 20000 addresses', %f]" % (time.time()-start))
-        else:
-          import addrlist
-          addrs = addrlist.addrlist
+        with self.bench.timer("getnewaddress", count=20000):
+          with node.batch() as b:
+            addrs = [ b.getnewaddress() for _ in range(20000)]
+          addrs = [ a.result() for a in addrs ]
 
         wallet = node.listunspent()
         wallet.sort(key=lambda x: x["amount"],reverse=True)
 
         (txn,inp,outp,txid) = split_transaction(node, wallet[0], addrs[0:10000], txfee=DEFAULT_TX_FEE_PER_BYTE, sendtx=True)
         txLen = len(binascii.unhexlify(txn))  # Get the actual transaction size for better tx fee estimation the next time around
-        print("[ 'gen',",txLen,",",len(inp),",",len(outp), "],")
-
-        startTime = time.time()          
-        node.generate(1)
-        elapsedTime = time.time() - startTime
-        print ("Generate time: ", elapsedTime)
-        startTime = time.time()
-        print ("synchronizing")
-        self.sync_all()
-        elapsedTime = time.time() - startTime
-        print("Sync     time: ", elapsedTime)
-        
+        with self.bench.timer("generate", txlen=txLen, inputs=len(inp), outputs=len(outp)):
+          node.generate(1)
+        print("synchronizing")
+        with self.bench.timer("sync", txlen=txLen, inputs=len(inp), outputs=len(outp)):
+          self.sync_all()
+
         # Now join with a tx with a huge number of inputs
-       	wallet = self.nodes[0].listunspent()
+        wallet = self.nodes[0].listunspent()
         wallet.sort(key=lambda x: x["amount"])
 
         (txn,inp,outp,txid) = split_transaction(node, wallet[0:10000], [addrs[0]], txfee=DEFAULT_TX_FEE_PER_BYTE, sendtx=True)
         txLen = len(binascii.unhexlify(txn))  # Get the actual transaction size for better tx fee estimation the next time around
-        print("[ 'gen',",txLen,",",len(inp),",",len(outp), "],")
-      
-            
+        with self.bench.timer("generate", txlen=txLen, inputs=len(inp), outputs=len(outp)):
+          node.generate(1)
+        with self.bench.timer("sync", txlen=txLen, inputs=len(inp), outputs=len(outp)):
+          self.sync_all()
+
+    def write_results(self):
+        baseline = Benchmark.load(self.options.baseline) if self.options.baseline else None
+        self.bench.report(baseline)
+        self.bench.write_json(self.options.benchout + ".json")
+        self.bench.write_csv(self.options.benchout + ".csv")
+        logging.info("Results written to %s.json and %s.csv" % (self.options.benchout, self.options.benchout))
+        if baseline:
+          for r, old, new in self.bench.regressions(baseline):
+            logging.info("REGRESSION %s %s: median %f s, baseline %f s" % (r.name, r.params, new, old))
 
     def run_test(self):
         TEST_SIZE=200  # To collect a lot of data points, set the TEST_SIZE to 2000
@@ -189,10 +251,18 @@ class TransactionPerformanceTest(BitcoinTestFramework):
         # This times the validation of 1 to many and many to 1 transactions.  Its not needed to be run as a unit test
         # self.largeOutput()
     
+        self.bench = Benchmark("txPerf")
+
+        if self.options.matrix:
+          self.signatureMatrix(self.nodes[0], [int(x) for x in self.options.matrix_inputs.split(",")],
+                               [int(x) for x in self.options.matrix_outputs.split(",")],
+                               self.options.matrix_sighash.split(","), self.options.matrix_scripts.split(","))
+          self.write_results()
+          return
+
         print("Generating new addresses... will take awhile")
-        start = time.time()
-        addrs = [ self.nodes[0].getnewaddress() for _ in range(TEST_SIZE+1)]
-        print("['Benchmark', 'generate 2001 addresses', %f]" % (time.time()-start))
+        with self.bench.timer("getnewaddress", count=TEST_SIZE+1):
+          addrs = [ self.nodes[0].getnewaddress() for _ in range(TEST_SIZE+1)]
 
         wallet = self.nodes[0].listunspent()
         wallet.sort(key=lambda x: x["amount"],reverse=True)
@@ -222,6 +292,7 @@ class TransactionPerformanceTest(BitcoinTestFramework):
 
         # self.signingPerformance(self.nodes[0], wallet[0:TEST_SIZE],addrs[0:TEST_SIZE],interval)
         self.validatePerformance(self.nodes[0], TEST_SIZE,addrs,interval)
+        self.write_results()
 
 
 if __name__ == '__main__':
@@ -230,7 +301,7 @@ if __name__ == '__main__':
     "debug":["net","blk","thin","lck","mempool","req","bench","evict"],
     "blockprioritysize":2000000  # we don't want any transactions rejected due to insufficient fees...
     }
-    tpt.main(["--nocleanup"],bitcoinConf)
+    tpt.main(["--nocleanup"] + sys.argv[1:],bitcoinConf)
 
 def Test():    
     tpt = TransactionPerformanceTest()